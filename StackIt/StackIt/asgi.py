@@ -9,8 +9,24 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "StackIt.settings")
 
-application = get_asgi_application()
+
+class ForumASGIHandler(ASGIHandler):
+    """With ``FORUM_ASYNC_READS``, routes requests through StackIt.asgi_urls, where the forum's busiest reads are async views"""
+    urlconf = 'StackIt.asgi_urls'
+
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None and getattr(settings, 'FORUM_ASYNC_READS', False):
+            request.urlconf = self.urlconf
+        return request, error_response
+
+
+# What get_asgi_application() does, with the handler above
+django.setup(set_prefix=False)
+application = ForumASGIHandler()
@@ -0,0 +1,12 @@
+"""
+URL configuration of the ASGI application (StackIt.asgi): the forum's async
+read views (forum.async_views) ahead of the routes of StackIt.urls.
+"""
+from django.urls import path, include
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path('api/forum/', include('forum.async_urls')),
+    *sync_urlpatterns,
+]
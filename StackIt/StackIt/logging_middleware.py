@@ -0,0 +1,255 @@
+"""
+Per-request timing and SQL instrumentation.
+
+``RequestTimingMiddleware`` measures every request: wall time, time spent
+in the database and number of queries, time spent building serializer
+data, and response size. It writes one record per request to the
+``stackit.requests`` logger. With ``REQUEST_TIMING_HEADER`` it also
+returns the timings in a ``Server-Timing`` header, which browser dev tools
+show next to the request.
+
+Every request gets an id: the incoming ``X-Request-ID`` if it looks like
+one, otherwise a new one. The id is returned in the ``X-Request-ID``
+response header. ``RequestContextFilter`` adds it, with the method, path
+and user, to every log record written while the request is handled.
+
+Set ``REQUEST_TIMING=False`` to remove the middleware and its hooks.
+"""
+import logging
+import logging.handlers
+import queue
+import re
+import time
+import uuid
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from urllib.parse import urlencode
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.functional import empty
+
+logger = logging.getLogger('stackit.requests')
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+VALID_REQUEST_ID = re.compile(r'^[\w.-]{8,64}$')
+# Query parameters that carry credentials, e.g. the notification stream's ?token=
+CREDENTIAL_PARAMS = {'token', 'access_token', 'refresh', 'password'}
+
+current_request = ContextVar('current_request', default=None)
+
+
+@dataclass
+class RequestMetrics:
+    request: object
+    request_id: str
+    started: float = field(default_factory=time.perf_counter)
+    db_seconds: float = 0.0
+    queries: int = 0
+    serializer_seconds: float = 0.0
+    # Set while a serializer builds its data, so nested ones aren't counted twice
+    serializing: bool = False
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper adding each query's time to the current request"""
+    metrics = current_request.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_seconds += time.perf_counter() - started
+        metrics.queries += 1
+
+
+def install_query_timer(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def instrument_serializers():
+    """Time ``serializer.data`` for the current request"""
+    from rest_framework.serializers import BaseSerializer
+
+    data = BaseSerializer.data
+    if getattr(data.fget, 'timed', False):
+        return
+
+    def timed_data(self):
+        metrics = current_request.get()
+        if metrics is None or metrics.serializing:
+            return data.fget(self)
+        metrics.serializing = True
+        started = time.perf_counter()
+        try:
+            return data.fget(self)
+        finally:
+            metrics.serializer_seconds += time.perf_counter() - started
+            metrics.serializing = False
+
+    timed_data.timed = True
+    BaseSerializer.data = property(timed_data)
+
+
+def route_template(route):
+    """``questions/{id}/`` for a resolver route such as ``^questions/(?P<id>[^/.]+)/$``"""
+    route = re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', route)
+    route = re.sub(r'<(?:\w+:)?(\w+)>', r'{\1}', route)
+    return '/' + route.replace('^', '').replace('$', '').replace('\\', '')
+
+
+def logged_path(request):
+    """Path and query string of ``request``, without credential parameters"""
+    params = [
+        (name, value) for name, values in request.GET.lists() if name.lower() not in CREDENTIAL_PARAMS
+        for value in values
+    ]
+    return f'{request.path}?{urlencode(params)}' if params else request.path
+
+
+def request_user_id(request):
+    """Id of the request's user, without loading a user nobody has looked at yet"""
+    user = getattr(request, 'user', None)
+    if getattr(user, '_wrapped', None) is empty:
+        return None
+    return getattr(user, 'pk', None)
+
+
+class RequestTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_TIMING', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.send_header = getattr(settings, 'REQUEST_TIMING_HEADER', False)
+        instrument_serializers()
+        # Connections opened from now on get the timer when they connect
+        connection_created.connect(install_query_timer, dispatch_uid='request_timing_query_timer')
+        for connection in connections.all(initialized_only=True):
+            install_query_timer(connection)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, metrics)
+
+    def start(self, request):
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')
+        if not VALID_REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        request.request_id = request_id
+        metrics = RequestMetrics(request, request_id)
+        return metrics, current_request.set(metrics)
+
+    def finish(self, request, response, metrics):
+        total = time.perf_counter() - metrics.started
+        response[REQUEST_ID_HEADER] = metrics.request_id
+        if self.send_header:
+            response['Server-Timing'] = (
+                f'app;dur={total * 1000:.1f}, '
+                f'db;dur={metrics.db_seconds * 1000:.1f};desc="{metrics.queries} queries", '
+                f'serializer;dur={metrics.serializer_seconds * 1000:.1f}'
+            )
+        if logger.isEnabledFor(logging.INFO):
+            self.log(request, response, metrics, total)
+        return response
+
+    def log(self, request, response, metrics, total):
+        match = getattr(request, 'resolver_match', None)
+        size = None if response.streaming else len(response.content)
+        path = logged_path(request)
+        logger.info(
+            '%s %s %s %.1fms db=%.1fms/%dq serializer=%.1fms',
+            request.method, path, response.status_code, total * 1000,
+            metrics.db_seconds * 1000, metrics.queries, metrics.serializer_seconds * 1000,
+            extra={
+                'request_id': metrics.request_id,
+                'user_id': request_user_id(request),
+                'method': request.method,
+                'path': path,
+                'route': route_template(match.route) if match else None,
+                'status_code': response.status_code,
+                'duration_ms': round(total * 1000, 2),
+                'db_ms': round(metrics.db_seconds * 1000, 2),
+                'queries': metrics.queries,
+                'serializer_ms': round(metrics.serializer_seconds * 1000, 2),
+                'response_bytes': size,
+            },
+        )
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds the current request's id, method, path and user to log records ('-' outside requests)"""
+
+    def filter(self, record):
+        metrics = current_request.get()
+        # django.request logs responses after the middleware has returned
+        request = metrics.request if metrics else getattr(record, 'request', None)
+        defaults = {
+            'request_id': getattr(request, 'request_id', '-'),
+            'method': request.method if request else '-',
+            'path': logged_path(request) if request else '-',
+            'user_id': (request_user_id(request) if request else None) or '-',
+        }
+        for name, value in defaults.items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class BackgroundRotatingFileHandler(logging.handlers.QueueHandler):
+    """
+    RotatingFileHandler whose records are formatted and written on a
+    background thread, keeping both off the request path. Filters still run
+    in the logging thread, where the request context is available.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.handlers.RotatingFileHandler(filename, **kwargs)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # The target formats the record, QueueHandler.prepare would do it here
+        return record
+
+    def close(self):
+        # logging.shutdown() and dictConfig may both close the handler
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        self.target.close()
+        super().close()
+
+
+class ExcludeAutoreloadFilter(logging.Filter):
+    """Drops the autoreloader's file-change chatter"""
+
+    def filter(self, record):
+        return not record.name.startswith('django.utils.autoreload')
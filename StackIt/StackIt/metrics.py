@@ -0,0 +1,440 @@
+"""
+In-process metrics: counters, gauges and fixed-bucket histograms.
+
+Metrics are module-level objects, registered with ``REGISTRY`` when they
+are created and updated with their label values as keyword arguments::
+
+    questions_viewed = Counter('forum_questions_viewed_total', 'Question pages served', ['source'])
+    questions_viewed.inc(source='cache')
+
+``MetricsView`` renders the registry in the Prometheus text format for
+staff users. ``MetricsMixin`` counts and times the requests of a DRF view.
+
+Values live in this process's memory, unless ``METRICS_MULTIPROCESS_DIR``
+names a directory. Then every process writes its values to memory-mapped
+files there, and a scrape in any worker adds up the files of all of them.
+Counters and histograms of exited workers keep counting towards the
+totals. Gauges only count while their process is alive. Empty the
+directory when the server starts, e.g. in the service's start script.
+"""
+import bisect
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.permissions import IsAdminUser
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
+
+from .logging_middleware import current_request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+VALID_NAME = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+
+
+class MemoryStore:
+    """Sample values of this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, updates, live=False):
+        """Add ``amount`` to each ``(key, amount)`` of ``updates``, atomically"""
+        with self._lock:
+            for key, amount in updates:
+                self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set(self, key, value, live=True):
+        with self._lock:
+            self._values[key] = value
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class MmapValues:
+    """
+    Sample values in a memory-mapped file, written by one process and read
+    by any. The file starts with the number of bytes in use, followed by
+    entries of a key length, the key (padded to 8 bytes) and a double.
+    Entries are complete before the length in use covers them.
+    """
+    initial_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(self.initial_size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._positions = {}
+        self._used = struct.unpack_from('i', self._map, 0)[0] or 8
+        for key, value, position in self.read_entries(self._map, self._used):
+            self._positions[key] = position
+
+    @staticmethod
+    def read_entries(data, used):
+        position = 8
+        while position < used:
+            length = struct.unpack_from('i', data, position)[0]
+            start = position + 4
+            value_position = start + length + (-(4 + length) % 8)
+            key = bytes(data[start:start + length]).decode()
+            yield key, struct.unpack_from('d', data, value_position)[0], value_position
+            position = value_position + 8
+
+    @classmethod
+    def read(cls, path):
+        """``{key: value}`` of the file at ``path``"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < 8:
+            return {}
+        used = struct.unpack_from('i', data, 0)[0]
+        return {key: value for key, value, _ in cls.read_entries(data, used)}
+
+    def position(self, key):
+        position = self._positions.get(key)
+        if position is None:
+            encoded = key.encode()
+            padding = -(4 + len(encoded)) % 8
+            size = 4 + len(encoded) + padding + 8
+            while self._used + size > len(self._map):
+                self._grow()
+            struct.pack_into(f'i{len(encoded)}s{padding}xd', self._map, self._used, len(encoded), encoded, 0.0)
+            position = self._used + size - 8
+            self._used += size
+            struct.pack_into('i', self._map, 0, self._used)
+            self._positions[key] = position
+        return position
+
+    def _grow(self):
+        size = len(self._map) * 2
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def get(self, position):
+        return struct.unpack_from('d', self._map, position)[0]
+
+    def put(self, position, value):
+        struct.pack_into('d', self._map, position, value)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class FileStore:
+    """
+    Sample values shared by the processes using ``directory``. Each process
+    writes its own files: ``total_<pid>.db`` for counters and histograms,
+    ``live_<pid>.db`` for gauges.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._reset()
+        # A forked worker must not write to its parent's files
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def _values(self, live):
+        kind = 'live' if live else 'total'
+        if kind not in self._files:
+            path = os.path.join(self.directory, f'{kind}_{os.getpid()}.db')
+            if live and os.path.exists(path):
+                # Gauges of an exited process that had the same pid
+                os.remove(path)
+            self._files[kind] = MmapValues(path)
+        return self._files[kind]
+
+    def inc(self, updates, live=False):
+        with self._lock:
+            values = self._values(live)
+            for key, amount in updates:
+                position = values.position(key)
+                values.put(position, values.get(position) + amount)
+
+    def set(self, key, value, live=True):
+        with self._lock:
+            values = self._values(live)
+            values.put(values.position(key), value)
+
+    def collect(self):
+        totals = defaultdict(float)
+        for name in os.listdir(self.directory):
+            match = re.match(r'^(total|live)_(\d+)\.db$', name)
+            if match is None or (match.group(1) == 'live' and not pid_alive(int(match.group(2)))):
+                continue
+            try:
+                values = MmapValues.read(os.path.join(self.directory, name))
+            except OSError:
+                # Removed since the listing
+                continue
+            for key, value in values.items():
+                totals[key] += value
+        return dict(totals)
+
+
+def sample_key(name, suffix, labels):
+    return json.dumps([name, suffix, labels], separators=(',', ':'))
+
+
+def format_value(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        if not VALID_NAME.match(name):
+            raise ValueError(f'Invalid metric name {name!r}')
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self._keys = {}
+        self.registry.register(self)
+
+    def label_values(self, labels):
+        """Values of ``labels`` in the order of the label names"""
+        try:
+            values = tuple([labels[name] for name in self.labelnames])
+        except KeyError:
+            values = None
+        if values is None or len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} takes the labels {", ".join(self.labelnames) or "(none)"}')
+        return values
+
+    def keys(self, labels):
+        """Store keys of the samples with ``labels``, built once per label set"""
+        values = self.label_values(labels)
+        keys = self._keys.get(values)
+        if keys is None:
+            pairs = [(name, str(value)) for name, value in zip(self.labelnames, values)]
+            keys = self._keys[values] = self.sample_keys(pairs)
+        return keys
+
+    def sample_keys(self, labels):
+        return sample_key(self.name, '', labels)
+
+    def value(self, **labels):
+        """Current value with ``labels``, 0 when it was never set"""
+        return self.registry.store.collect().get(self.keys(labels), 0.0)
+
+    def render(self, samples):
+        """Exposition lines of ``samples``, ``(suffix, labels, value)`` tuples"""
+        for suffix, labels, value in sorted(samples):
+            yield f'{self.name}{suffix}{format_labels(labels)} {format_value(value)}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters only go up')
+        self.registry.store.inc([(self.keys(labels), amount)])
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.registry.store.set(self.keys(labels), value)
+
+    def inc(self, amount=1, **labels):
+        self.registry.store.inc([(self.keys(labels), amount)], live=True)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        if 'le' in labelnames:
+            raise ValueError('"le" is reserved for the bucket bounds')
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets if not math.isinf(bound)))
+        self._bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+
+    def sample_keys(self, labels):
+        buckets = [sample_key(self.name, '_bucket', labels + [('le', bound)]) for bound in self._bounds]
+        return buckets, sample_key(self.name, '_sum', labels), sample_key(self.name, '_count', labels)
+
+    def observe(self, value, **labels):
+        # Buckets are stored by themselves and added up when rendered
+        buckets, sum_key, count_key = self.keys(labels)
+        bucket = buckets[bisect.bisect_left(self.buckets, value)]
+        self.registry.store.inc([(bucket, 1), (sum_key, value), (count_key, 1)])
+
+    def value(self, **labels):
+        """Number of observations with ``labels``"""
+        return self.registry.store.collect().get(self.keys(labels)[2], 0.0)
+
+    def render(self, samples):
+        series = defaultdict(lambda: {'buckets': defaultdict(float), 'sum': 0.0, 'count': 0.0})
+        for suffix, labels, value in samples:
+            if suffix == '_bucket':
+                *labels, (_, bound) = labels
+                series[tuple(map(tuple, labels))]['buckets'][bound] += value
+            else:
+                series[tuple(map(tuple, labels))][suffix[1:]] += value
+        for labels, values in sorted(series.items()):
+            cumulative = 0.0
+            for bound in self._bounds:
+                cumulative += values['buckets'].get(bound, 0.0)
+                yield f'{self.name}_bucket{format_labels(labels + (("le", bound),))} {format_value(cumulative)}'
+            yield f'{self.name}_sum{format_labels(labels)} {format_value(values["sum"])}'
+            yield f'{self.name}_count{format_labels(labels)} {format_value(values["count"])}'
+
+
+class Registry:
+    def __init__(self, store=None):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._store = store
+
+    @property
+    def store(self):
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    directory = getattr(settings, 'METRICS_MULTIPROCESS_DIR', '')
+                    self._store = FileStore(directory) if directory else MemoryStore()
+        return self._store
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'A metric named {metric.name} already exists')
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        samples = defaultdict(list)
+        for key, value in self.store.collect().items():
+            name, suffix, labels = json.loads(key)
+            samples[name].append((suffix, [tuple(label) for label in labels], value))
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            documentation = metric.documentation.replace('\\', '\\\\').replace('\n', '\\n')
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            lines.extend(metric.render(samples.get(name, [])))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+requests_total = Counter(
+    'stackit_http_requests_total', 'API requests handled, by view, action, method and status',
+    ['view', 'action', 'method', 'status'],
+)
+request_duration = Histogram(
+    'stackit_http_request_duration_seconds', 'Time spent in API views', ['view', 'action'],
+)
+requests_in_progress = Gauge(
+    'stackit_http_requests_in_progress', 'API requests being handled', ['view'],
+)
+request_db_duration = Histogram(
+    'stackit_http_request_db_seconds', 'Database time of each API request', ['view', 'action'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+db_queries = Counter(
+    'stackit_db_queries_total', 'Database queries run by API views', ['view', 'action'],
+)
+
+
+class RequestTracker:
+    """
+    Counts, times and tracks the database time of one request to ``view``.
+    Database time needs the request timing middleware (``REQUEST_TIMING``).
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.timing = current_request.get()
+        self.db_seconds, self.queries = (self.timing.db_seconds, self.timing.queries) if self.timing else (0.0, 0)
+        requests_in_progress.inc(view=view)
+        self.started = time.perf_counter()
+
+    def finish(self, action, method, status_code):
+        seconds = time.perf_counter() - self.started
+        view = self.view
+        requests_in_progress.dec(view=view)
+        requests_total.inc(view=view, action=action, method=method, status=status_code)
+        request_duration.observe(seconds, view=view, action=action)
+        if self.timing is not None:
+            request_db_duration.observe(self.timing.db_seconds - self.db_seconds, view=view, action=action)
+            db_queries.inc(self.timing.queries - self.queries, view=view, action=action)
+
+
+class MetricsMixin:
+    """Records the requests of a DRF view with RequestTracker"""
+
+    def dispatch(self, request, *args, **kwargs):
+        tracker = RequestTracker(type(self).__name__)
+        status_code = 500
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+            status_code = response.status_code
+            return response
+        finally:
+            # Viewsets set the action while dispatching
+            tracker.finish(getattr(self, 'action', None) or request.method.lower(), request.method, status_code)
+
+
+class MetricsView(APIView):
+    """The registry in the Prometheus text format, for staff users"""
+    # Basic auth lets a scraper sign in with a staff account's password
+    authentication_classes = [*api_settings.DEFAULT_AUTHENTICATION_CLASSES, BasicAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
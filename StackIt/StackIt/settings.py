@@ -101,6 +101,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the other middleware
+    "StackIt.logging_middleware.RequestTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -150,6 +152,18 @@ DATABASES = {
 }
 
 
+# Cache
+# Shared Redis cache when REDIS_URL is set, so cache versions bumped by one
+# worker are seen by all of them; per-process memory otherwise
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache"
+        if os.getenv('REDIS_URL') else "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": os.getenv('REDIS_URL', 'stackit'),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -202,6 +216,36 @@ CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 minutes
 
+# Forum settings
+# Seconds between batched writes of buffered question view counts (0 writes every view)
+FORUM_VIEW_COUNT_FLUSH_INTERVAL = int(os.getenv('FORUM_VIEW_COUNT_FLUSH_INTERVAL', 10))
+# Also flush from a background thread, so idle workers don't hold counts
+FORUM_VIEW_COUNT_FLUSH_THREAD = os.getenv('FORUM_VIEW_COUNT_FLUSH_THREAD', 'False') == 'True'
+# Seconds anonymous question/tag responses stay cached (0 disables the cache)
+FORUM_RESPONSE_CACHE_TIMEOUT = int(os.getenv('FORUM_RESPONSE_CACHE_TIMEOUT', 60))
+# Whether all workers share the cache. The response cache and the tag catalogue
+# only run with it, since a version bump in LocMemCache reaches one process;
+# set it for a single-process server or a shared backend other than Redis
+FORUM_SHARED_CACHE = os.getenv('FORUM_SHARED_CACHE', 'True' if os.getenv('REDIS_URL') else 'False') == 'True'
+# Create notifications in-process after commit instead of in the process_outbox worker
+FORUM_OUTBOX_EAGER = os.getenv('FORUM_OUTBOX_EAGER', 'False') == 'True'
+# Distinct @mentions per comment that notify anyone, later ones are ignored
+FORUM_MAX_MENTIONS_PER_COMMENT = int(os.getenv('FORUM_MAX_MENTIONS_PER_COMMENT', 10))
+# Pub/sub for the notification stream: in-process, or shared through Redis
+FORUM_EVENT_BACKEND = (
+    'forum.events.RedisEventBackend' if os.getenv('REDIS_URL') else 'forum.events.LocalEventBackend'
+)
+# Seconds between keepalive comments, and before a stream is closed for the client to reconnect
+FORUM_STREAM_KEEPALIVE = int(os.getenv('FORUM_STREAM_KEEPALIVE', 15))
+FORUM_STREAM_MAX_AGE = int(os.getenv('FORUM_STREAM_MAX_AGE', 300))
+# Questions older than this drop out of the hot feed (score 0) and the refresh_hot_scores sweep
+FORUM_HOT_WINDOW_DAYS = int(os.getenv('FORUM_HOT_WINDOW_DAYS', 7))
+# Days read notifications are kept before purge_notifications deletes them
+FORUM_NOTIFICATION_RETENTION_DAYS = int(os.getenv('FORUM_NOTIFICATION_RETENTION_DAYS', 90))
+# Serve the busiest reads from async views under ASGI (forum.async_views);
+# off until a benchmark shows them ahead of the sync views
+FORUM_ASYNC_READS = os.getenv('FORUM_ASYNC_READS', 'False') == 'True'
+
 # OpenAI API settings
 # OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
 # OPENAI_MODEL_NAME = os.getenv('OPENAI_MODEL_NAME', 'gpt-4-turbo-preview')
@@ -246,85 +290,104 @@ CLOUDINARY_STORAGE = {
 # Use Cloudinary's RawMediaCloudinaryStorage for raw files like PDFs
 DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.RawMediaCloudinaryStorage'
 
-# LOGGING = {
-#     'version': 1,
-#     'disable_existing_loggers': False,
-#     'filters': {
-#         'request_context': {
-#             '()': 'MedAudit.logging_middleware.RequestContextFilter',
-#         },
-#         'exclude_autoreload': {
-#             '()': 'MedAudit.logging_middleware.ExcludeAutoreloadFilter',
-#         },
-#     },
-#     'formatters': {
-#         'json': {
-#             '()': 'pythonjsonlogger.json.JsonFormatter',
-#             'format': '%(levelname)s %(asctime)s %(module)s %(message)s %(name)s %(process)d %(thread)d %(ip)s %(user_agent)s %(user_id)s %(username)s %(request_id)s %(type)s %(path)s %(status_code)d %(content_length)d',
-#             'json_ensure_ascii': False,
-#             'json_indent': None,
-#         },
-#         'verbose': {
-#             'format': '%(levelname)s [%(asctime)s] %(name)s - %(module)s.%(funcName)s:%(lineno)d - %(message)s',
-#             'datefmt': '%Y-%m-%d %H:%M:%S',
-#         },
-#         'simple': {
-#             'format': '%(levelname)s [%(asctime)s] %(message)s',
-#             'datefmt': '%Y-%m-%d %H:%M:%S',
-#         },
-#         'request': {
-#             'format': '%(levelname)s [%(asctime)s] %(request_id)s %(username)s - %(message)s',
-#             'datefmt': '%Y-%m-%d %H:%M:%S',
-#         },
-#     },
-#     'handlers': {
-#         'console': {
-#             'class': 'logging.StreamHandler',
-#             'formatter': 'simple' if not PROD else 'json',
-#             'filters': ['request_context', 'exclude_autoreload'],
-#         },
-#         'file': {
-#             'class': 'logging.handlers.RotatingFileHandler',
-#             'filename': os.path.join(LOG_DIR, 'app.log'),
-#             'formatter': 'verbose' if not PROD else 'json',
-#             'filters': ['request_context', 'exclude_autoreload'],
-#             'maxBytes': 100 * 1024 * 1024, # 100 MB
-#             'backupCount': 10,
-#             'delay': True,  # Add this to prevent immediate file creation
-#         },
-#         'request_file': {
-#             'class': 'logging.handlers.RotatingFileHandler',
-#             'filename': os.path.join(REQUEST_LOG_DIR, 'requests.log'),
-#             'formatter': 'request' if not PROD else 'json',
-#             'filters': ['request_context', 'exclude_autoreload'],
-#             'maxBytes': 100 * 1024 * 1024, # 100 MB
-#             'backupCount': 5,
-#         },
-#     },
-#     'loggers': {
-#         'django': {
-#             'handlers': ['console', 'file'],
-#             'level': 'INFO',
-#             'propagate': False,
-#         },
-#         'django.db.backends': {
-#             'level': 'DEBUG' if DEBUG else 'INFO',
-#             'handlers': ['file'],
-#             'propagate': False,
-#         },
-#         'django.request': {
-#             'handlers': ['request_file'],
-#             'level': 'INFO',
-#             'propagate': False,
-#         },
-#         'referral': {  # Add app-specific logger for referral app
-#             'handlers': ['console', 'file'],
-#             'level': 'DEBUG' if not PROD else 'INFO',
-#             'propagate': False,
-#         },
-#     },
-#     'root': {
-#         'handlers': ['console', 'file'],
-#         'level': 'DEBUG' if not PROD else 'INFO',
-#     },
-# }
+# Per-request timing log lines and request ids (StackIt.logging_middleware).
+# Off removes the middleware and its query/serializer hooks entirely
+REQUEST_TIMING = os.getenv('REQUEST_TIMING', 'True') == 'True'
+# Server-Timing headers expose internals, so they're sent in development only unless enabled
+REQUEST_TIMING_HEADER = os.getenv('REQUEST_TIMING_HEADER', str(DEBUG)) == 'True'
+# WARNING keeps the timings and headers but stops the per-request log lines
+REQUEST_LOG_LEVEL = os.getenv('REQUEST_LOG_LEVEL', 'INFO')
+# Directory where each worker process writes its metrics (StackIt.metrics), so
+# /metrics/ adds up all of them; empty keeps metrics in each process's memory
+METRICS_MULTIPROCESS_DIR = os.getenv('METRICS_MULTIPROCESS_DIR', '')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_context': {
+            '()': 'StackIt.logging_middleware.RequestContextFilter',
+        },
+        'exclude_autoreload': {
+            '()': 'StackIt.logging_middleware.ExcludeAutoreloadFilter',
+        },
+    },
+    'formatters': {
+        'json': {
+            '()': 'pythonjsonlogger.json.JsonFormatter',
+            'format': '%(levelname)s %(asctime)s %(name)s %(module)s %(message)s %(process)d %(thread)d %(request_id)s %(user_id)s %(method)s %(path)s',
+            'json_ensure_ascii': False,
+            'json_indent': None,
+        },
+        'verbose': {
+            'format': '%(levelname)s [%(asctime)s] %(name)s - %(module)s.%(funcName)s:%(lineno)d %(request_id)s - %(message)s',
+            'datefmt': '%Y-%m-%d %H:%M:%S',
+        },
+        'simple': {
+            'format': '%(levelname)s [%(asctime)s] %(message)s',
+            'datefmt': '%Y-%m-%d %H:%M:%S',
+        },
+        'request': {
+            'format': '%(levelname)s [%(asctime)s] %(request_id)s %(user_id)s - %(message)s',
+            'datefmt': '%Y-%m-%d %H:%M:%S',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'simple' if not PROD else 'json',
+            'filters': ['request_context', 'exclude_autoreload'],
+        },
+        'file': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': os.path.join(LOG_DIR, 'app.log'),
+            'formatter': 'verbose' if not PROD else 'json',
+            'filters': ['request_context', 'exclude_autoreload'],
+            'maxBytes': 100 * 1024 * 1024, # 100 MB
+            'backupCount': 10,
+            'delay': True,  # Add this to prevent immediate file creation
+        },
+        # Written from a background thread, see REQUEST_TIMING
+        'request_file': {
+            '()': 'StackIt.logging_middleware.BackgroundRotatingFileHandler',
+            'filename': os.path.join(REQUEST_LOG_DIR, 'requests.log'),
+            'formatter': 'request' if not PROD else 'json',
+            'filters': ['request_context', 'exclude_autoreload'],
+            'maxBytes': 100 * 1024 * 1024, # 100 MB
+            'backupCount': 5,
+            'delay': True,
+        },
+    },
+    'loggers': {
+        'django': {
+            'handlers': ['console', 'file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'django.db.backends': {
+            'level': 'DEBUG' if DEBUG else 'INFO',
+            'handlers': ['file'],
+            'propagate': False,
+        },
+        'django.request': {
+            'handlers': ['request_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        # One line per request, see REQUEST_TIMING
+        'stackit.requests': {
+            'handlers': ['request_file'],
+            'level': REQUEST_LOG_LEVEL,
+            'propagate': False,
+        },
+        'forum': {
+            'handlers': ['console', 'file'],
+            'level': 'DEBUG' if not PROD else 'INFO',
+            'propagate': False,
+        },
+    },
+    'root': {
+        'handlers': ['console', 'file'],
+        'level': 'DEBUG' if not PROD else 'INFO',
+    },
+}
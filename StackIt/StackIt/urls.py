@@ -18,9 +18,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include, re_path
 from django.conf import settings
+from .metrics import MetricsView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path('api/auth/', include('account.urls')),
     path('api/forum/', include('forum.urls')),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
@@ -10,10 +10,11 @@ from rest_framework.response import Response
 from rest_framework import status
 from .serializers import RegisterSerializer, LoginSerializer, ForgotPasswordSerializer, UserProfileSerializer, UserDetailSerializer
 from StackIt.exception_handler import custom_exception_handler
+from StackIt.metrics import MetricsMixin
 
 User = get_user_model()
 
-class RegisterView(APIView):
+class RegisterView(MetricsMixin, APIView):
     permission_classes = [AllowAny]
 
     def post(self, request):
@@ -41,7 +42,7 @@ class RegisterView(APIView):
             response = custom_exception_handler(exc, self.get_renderer_context())
             return response
 
-class LoginView(APIView):
+class LoginView(MetricsMixin, APIView):
     permission_classes = [AllowAny]
 
     def post(self, request):
@@ -79,7 +80,7 @@ class LoginView(APIView):
             response = custom_exception_handler(exc, self.get_renderer_context())
             return response
 
-class LogoutView(APIView):
+class LogoutView(MetricsMixin, APIView):
     def post(self, request):
         try:
             logout(request)
@@ -97,7 +98,7 @@ class LogoutView(APIView):
             response = custom_exception_handler(exc, self.get_renderer_context())
             return response
 
-class ForgotPasswordView(APIView):
+class ForgotPasswordView(MetricsMixin, APIView):
     permission_classes = [AllowAny]
 
     def post(self, request):
@@ -125,7 +126,7 @@ class ForgotPasswordView(APIView):
             response = custom_exception_handler(exc, self.get_renderer_context())
             return response
 
-class ProfileUpdateView(APIView):
+class ProfileUpdateView(MetricsMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
@@ -179,7 +180,7 @@ class ProfileUpdateView(APIView):
             return response
 
 
-class DoctorListView(APIView):
+class DoctorListView(MetricsMixin, APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
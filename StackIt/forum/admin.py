@@ -1,39 +1,28 @@
 from django.contrib import admin
-from .models import Question, Answer, Comment, Tag, Notification
+from .models import Question, Answer, Comment, Tag, Notification, OutboxEvent, Vote
 
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
     list_display = ('name', 'slug', 'question_count')
     search_fields = ('name', 'description')
     prepopulated_fields = {'slug': ('name',)}
-    
-    def question_count(self, obj):
-        return obj.questions.count()
-    question_count.short_description = 'Questions'
+    readonly_fields = ('question_count',)
 
 @admin.register(Question)
 class QuestionAdmin(admin.ModelAdmin):
-    list_display = ('title', 'author', 'created_at', 'answer_count', 'vote_count')
+    list_display = ('title', 'author', 'created_at', 'answer_count', 'score')
     list_filter = ('created_at', 'tags')
     search_fields = ('title', 'description', 'author__email')
-    readonly_fields = ('created_at', 'updated_at', 'views_count')
-    filter_horizontal = ('tags', 'upvotes', 'downvotes')
-    
-    def answer_count(self, obj):
-        return obj.answers.count()
-    answer_count.short_description = 'Answers'
-    
-    def vote_count(self, obj):
-        return obj.upvotes.count() - obj.downvotes.count()
-    vote_count.short_description = 'Votes'
+    readonly_fields = ('created_at', 'updated_at', 'views_count', 'score', 'upvote_count', 'downvote_count',
+                       'answer_count', 'hot_score')
+    filter_horizontal = ('tags',)
 
 @admin.register(Answer)
 class AnswerAdmin(admin.ModelAdmin):
-    list_display = ('answer_preview', 'author', 'question', 'created_at', 'is_accepted', 'vote_count')
+    list_display = ('answer_preview', 'author', 'question', 'created_at', 'is_accepted', 'score')
     list_filter = ('created_at', 'is_accepted')
     search_fields = ('content', 'author__email', 'question__title')
-    readonly_fields = ('created_at', 'updated_at')
-    filter_horizontal = ('upvotes', 'downvotes')
+    readonly_fields = ('created_at', 'updated_at', 'score', 'upvote_count', 'downvote_count')
     
     def answer_preview(self, obj):
         if len(obj.content) > 50:
@@ -41,9 +30,24 @@ class AnswerAdmin(admin.ModelAdmin):
         return obj.content
     answer_preview.short_description = 'Answer'
     
-    def vote_count(self, obj):
-        return obj.upvotes.count() - obj.downvotes.count()
-    vote_count.short_description = 'Votes'
+@admin.register(Vote)
+class VoteAdmin(admin.ModelAdmin):
+    list_display = ('user', 'value', 'question', 'answer', 'created_at')
+    list_filter = ('value', 'created_at')
+    search_fields = ('user__email',)
+    raw_id_fields = ('user', 'question', 'answer')
+    readonly_fields = ('created_at', 'updated_at')
+    
+    # Votes only change through Vote.objects.set_vote, which keeps the stored
+    # counters, hot scores and cached responses in step
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 @admin.register(Comment)
 class CommentAdmin(admin.ModelAdmin):
@@ -76,3 +80,9 @@ class NotificationAdmin(admin.ModelAdmin):
             return obj.message[:50] + '...'
         return obj.message
     message_preview.short_description = 'Message'
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'event_type', 'payload', 'created_at')
+    list_filter = ('event_type',)
+    readonly_fields = ('created_at',)
@@ -7,3 +7,29 @@ class ForumConfig(AppConfig):
 
     def ready(self):
         import forum.signals  # noqa
+        from django.db.models.signals import post_migrate
+        post_migrate.connect(setup_search, sender=self)
+        post_migrate.connect(create_tag_link_index, sender=self)
+
+
+def setup_search(using, **kwargs):
+    """Create the search engine's tables and indexes once the schema exists"""
+    from .search import get_search_backend
+    get_search_backend().setup()
+
+
+def create_tag_link_index(using, **kwargs):
+    """
+    Index the question/tag links by tag. The auto-created through table only
+    has the (question_id, tag_id) unique constraint, which doesn't serve
+    lookups of a tag's questions.
+    """
+    from django.db import connections
+    from .models import Question
+
+    through = Question.tags.through._meta
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS forum_question_tags_tag_question_idx '
+            f'ON {through.db_table} (tag_id, question_id)'
+        )
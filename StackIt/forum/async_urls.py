@@ -0,0 +1,11 @@
+from django.urls import re_path
+from . import async_views
+
+# Same names and patterns as the router's routes in forum.urls
+urlpatterns = [
+    re_path(r'^questions/$', async_views.question_list, name='question-list'),
+    re_path(r'^questions/(?P<id>[^/.]+)/$', async_views.question_detail, name='question-detail'),
+    re_path(r'^questions/(?P<question_id>[^/.]+)/answers/$', async_views.answer_list, name='answer-list'),
+    re_path(r'^notifications/$', async_views.notification_list, name='notification-list'),
+    re_path(r'^notifications/unread_count/$', async_views.notification_unread_count, name='notification-unread-count'),
+]
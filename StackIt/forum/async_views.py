@@ -0,0 +1,150 @@
+"""
+Async versions of the forum's busiest read endpoints, for the ASGI application.
+
+DRF views are sync, so under ASGI Django gives each request to one of them
+a thread for its whole duration. These views still use each endpoint's
+viewset for everything that doesn't touch the database: authentication
+and permission classes, filters, serializers, pagination links, exception
+handling and rendering, and the same conditional GET and response cache
+mixins through their async entry points (``aconditional_response``,
+``acached_response``). Only the reads go through Django's async ORM and
+cache API.
+
+StackIt.asgi_urls puts them ahead of the regular routes:
+
+- ``GET questions/`` and ``GET questions/{id}/``
+- ``GET questions/{question_id}/answers/``
+- ``GET notifications/`` and ``GET notifications/unread_count/``
+
+They are off by default (``FORUM_ASYNC_READS``): on the forum's read mix
+they haven't been faster than the sync views under ASGI, see
+``replay_requests --asgi``. Other methods on these URLs go to the sync
+viewset, and WSGI serves everything from the sync views.
+"""
+from asgiref.sync import sync_to_async
+from django.http import Http404
+from rest_framework import status
+from rest_framework.response import Response
+
+from StackIt.metrics import RequestTracker
+
+from . import views
+from .loaders import aattach_viewer_votes, aload_question_detail
+from .models import NotificationState, Question
+from .search import SEARCH_PARAM, get_search_backend
+from .view_counter import view_counter, viewer_key
+
+
+def async_read_view(viewset, actions, read, **initkwargs):
+    """
+    View answering GET with ``read(view, request, **kwargs)``, where ``view``
+    is an initialized ``viewset``; other methods go to its sync view
+    """
+    sync_view = viewset.as_view(actions, **initkwargs)
+
+    async def view(request, *args, **kwargs):
+        if request.method != 'GET':
+            return await sync_to_async(sync_view)(request, *args, **kwargs)
+        # What ViewSetMixin.as_view and APIView.dispatch set up
+        self = viewset(**initkwargs)
+        self.action_map = actions
+        self.args, self.kwargs = args, kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        tracker = RequestTracker(viewset.__name__)
+        status_code = 500
+        try:
+            try:
+                # The authentication classes are sync and load the user
+                await sync_to_async(lambda: request.user)()
+                self.initial(request, *args, **kwargs)
+                response = await read(self, request, **kwargs)
+            except Exception as exc:
+                response = self.handle_exception(exc)
+            # Rendered by Django, like any DRF response
+            self.response = self.finalize_response(request, response, *args, **kwargs)
+            status_code = self.response.status_code
+            return self.response
+        finally:
+            tracker.finish(self.action, request.method, status_code)
+
+    view.csrf_exempt = True
+    view.cls = viewset
+    view.actions = actions
+    return view
+
+
+async def list_page(view, prepare_page=None):
+    """ListModelMixin.list with the async ORM; ``prepare_page`` loads what the serializer needs"""
+    queryset = view.filter_queryset(view.get_queryset())
+    page = await view.paginator.apaginate_queryset(queryset, view.request, view=view)
+    if prepare_page is not None:
+        await prepare_page(page)
+    return view.get_paginated_response(view.get_serializer(page, many=True).data)
+
+
+async def read_question_list(view, request):
+    if request.query_params.get(SEARCH_PARAM):
+        # Picking the backend may query the database, once per process
+        await sync_to_async(get_search_backend)()
+    return await view.acached_response(lambda: list_page(view))
+
+
+async def read_question(view, request, id):
+    async def render():
+        try:
+            instance = await aload_question_detail(id, request.user, views.wants_personalized(request))
+        except (Question.DoesNotExist, ValueError):
+            raise Http404('No Question matches the given query.')
+        return view.detail_response(instance)
+
+    response = await view.acached_response(render)
+    # Cached copies and 304s count as views as well
+    if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+        await view_counter.aadd(int(id), viewer=viewer_key(request))
+    return response
+
+
+async def read_answer_list(view, request, question_id):
+    async def attach_votes(page):
+        # Vote state for the whole page in one query
+        if views.wants_personalized(request):
+            await aattach_viewer_votes(request.user, answers=page)
+
+    return await view.aconditional_response(lambda: list_page(view, attach_votes))
+
+
+async def read_notification_list(view, request):
+    async def render():
+        view.read_before = await NotificationState.objects.aread_before(request.user)
+        return await list_page(view)
+
+    return await view.aconditional_response(render)
+
+
+async def read_unread_count(view, request):
+    return Response({'count': await NotificationState.objects.aunread_count(request.user)})
+
+
+question_list = async_read_view(
+    views.QuestionViewSet, {'get': 'list', 'post': 'create'}, read_question_list,
+    basename='question', detail=False, suffix='List',
+)
+question_detail = async_read_view(
+    views.QuestionViewSet,
+    {'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'},
+    read_question, basename='question', detail=True, suffix='Instance',
+)
+answer_list = async_read_view(
+    views.AnswerViewSet, {'get': 'list', 'post': 'create'}, read_answer_list,
+    basename='answer', detail=False, suffix='List',
+)
+notification_list = async_read_view(
+    views.NotificationViewSet, {'get': 'list'}, read_notification_list,
+    basename='notification', detail=False, suffix='List',
+)
+notification_unread_count = async_read_view(
+    views.NotificationViewSet, {'get': 'unread_count'}, read_unread_count,
+    basename='notification', detail=False,
+)
@@ -0,0 +1,191 @@
+"""
+Caching for the forum's read paths.
+
+Invalidation works through version counters kept in Django's cache. Writers
+bump a version once their transaction commits, and readers compare the
+version they see with the one their cached copy was built from. A version
+key that was evicted is recreated from the clock, so it never repeats a
+value an old copy may still carry.
+
+Anonymous question and tag reads are served from ``response_cache``, keyed
+by the request URL and the versions the response depends on: the question
+list version, a question's own version, or the tag version. The receivers
+in ``forum.signals`` bump them when questions, answers, comments, votes and
+tags change. ``FORUM_RESPONSE_CACHE_TIMEOUT`` bounds how stale the parts
+that are not versioned (view counts) can get; 0 disables the cache.
+
+Versions only invalidate other workers' copies when every worker sees the
+same cache, so both caches stay off unless ``FORUM_SHARED_CACHE`` says so.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .metrics import cache_requests
+from .models import Tag
+
+TAG_VERSION_KEY = 'forum:tags:version'
+QUESTION_LIST_VERSION_KEY = 'forum:questions:version'
+
+
+def question_version_key(question_id):
+    return f'forum:question:{question_id}:version'
+
+
+def get_version(key):
+    return get_versions([key])[0]
+
+
+def get_versions(keys):
+    """Current versions of ``keys`` with a single cache round trip when they all exist"""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+async def aget_versions(keys):
+    """get_versions for async views"""
+    versions = await cache.aget_many(keys)
+    for key in keys:
+        if key not in versions:
+            await cache.aadd(key, time.time_ns(), timeout=None)
+            versions[key] = await cache.aget(key)
+    return [versions[key] for key in keys]
+
+
+def shared_cache():
+    """Whether version bumps reach every worker, see ``FORUM_SHARED_CACHE``"""
+    return getattr(settings, 'FORUM_SHARED_CACHE', False)
+
+
+def bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=None)
+
+
+def bump_version_on_commit(*keys):
+    def bump():
+        for key in keys:
+            bump_version(key)
+    transaction.on_commit(bump)
+
+
+def invalidate_question(question_id):
+    """Drop cached responses showing the question: its page and the question lists"""
+    bump_version_on_commit(question_version_key(question_id), QUESTION_LIST_VERSION_KEY)
+
+
+class TagCatalogue:
+    """Process-local copy of the serialized tag list, reloaded when the tag version changes"""
+
+    def __init__(self):
+        # (version, data), replaced as a whole so threads never see a mix
+        self._entry = (None, None)
+
+    def get(self):
+        if not shared_cache():
+            # Other workers' tag changes would never reach the copy
+            return self.load()
+        # Read the version before loading, so a concurrent change is picked
+        # up by the next request rather than hidden under the newer version
+        version = get_version(TAG_VERSION_KEY)
+        cached_version, data = self._entry
+        hit = data is not None and cached_version == version
+        cache_requests.inc(cache='tag-catalogue', result='hit' if hit else 'miss')
+        if not hit:
+            data = self.load()
+            self._entry = (version, data)
+        return data
+
+    def load(self):
+        from .serializers import TagSerializer
+        return list(TagSerializer(Tag.objects.all(), many=True).data)
+
+    def invalidate(self):
+        bump_version_on_commit(TAG_VERSION_KEY)
+
+
+tag_catalogue = TagCatalogue()
+
+
+class ResponseCache:
+    """Shared cache of anonymous API responses, with per-process hit/miss counters"""
+    key_prefix = 'forum:response'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'FORUM_RESPONSE_CACHE_TIMEOUT', 60)
+
+    def shared(self, request):
+        """Whether the response to ``request`` can be shared"""
+        return (
+            request.method == 'GET' and not request.user.is_authenticated
+            and bool(self.timeout) and shared_cache()
+        )
+
+    def key_for(self, request, versions):
+        digest = hashlib.sha256(f'{versions}:{request.build_absolute_uri()}'.encode()).hexdigest()
+        return f'{self.key_prefix}:{digest}'
+
+    def cache_key(self, request, version_keys):
+        """Cache key of ``request``, or None when its response must not be shared"""
+        if not self.shared(request):
+            return None
+        return self.key_for(request, get_versions(version_keys))
+
+    async def acache_key(self, request, version_keys):
+        if not self.shared(request):
+            return None
+        return self.key_for(request, await aget_versions(version_keys))
+
+    def get(self, key, name):
+        """Cached response data, counting a hit or miss under ``name``"""
+        data = cache.get(key)
+        self.count(name, data is not None)
+        return data
+
+    async def aget(self, key, name):
+        data = await cache.aget(key)
+        self.count(name, data is not None)
+        return data
+
+    def count(self, name, hit):
+        with self._lock:
+            (self.hits if hit else self.misses)[name] += 1
+        cache_requests.inc(cache=name, result='hit' if hit else 'miss')
+
+    def set(self, key, data):
+        cache.set(key, data, self.timeout)
+
+    async def aset(self, key, data):
+        await cache.aset(key, data, self.timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {'hits': self.hits[name], 'misses': self.misses[name]}
+                for name in sorted(set(self.hits) | set(self.misses))
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,165 @@
+"""
+Conditional GET for the forum's polling endpoints.
+
+Each endpoint computes a validator from a single aggregate query, without
+loading or serializing the rows it covers: the newest ``updated_at`` and row
+counts pick up edits, additions and deletions (retagging a question moves
+its ``updated_at``), and the stored vote scores pick up votes. The viewer's
+own votes, shown as ``is_upvoted``/``is_downvoted``, are covered by their
+count and newest ``updated_at``. A question page that is rendered anyway computes the same
+validator from the rows it loaded, so the query only runs for conditional
+requests. The validator becomes a weak ``ETag``, and requests carrying a
+matching ``If-None-Match`` get an empty 304. No ``Last-Modified`` is sent:
+votes, deletions and reads change these responses without moving any
+timestamp, so ``If-Modified-Since`` alone always gets the full response.
+
+``Cache-Control`` makes shared caches revalidate every time (anonymous
+responses are ``public``, signed-in ones ``private``) and ``Vary`` keeps
+representations for different users and formats apart.
+"""
+import hashlib
+from collections import namedtuple
+
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+
+from .models import Answer, Comment, Notification, NotificationState, Question, Vote
+
+Validator = namedtuple('Validator', ['etag'])
+
+
+def make_validator(request, state):
+    """Validator for ``state`` as seen by the current user at the current URL"""
+    user_id = request.user.pk if request.user.is_authenticated else None
+    digest = hashlib.sha1(repr((state, user_id, request.get_full_path())).encode()).hexdigest()
+    return Validator(etag=f'W/"{digest}"')
+
+
+def newest(*timestamps):
+    timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+    return max(timestamps) if timestamps else None
+
+
+def aggregate_of(queryset, outer_field, expression):
+    """Subquery computing ``expression`` over the rows of ``queryset`` that belong to the outer row"""
+    return Subquery(
+        queryset.filter(**{outer_field: OuterRef('pk')}).order_by()
+        .values(outer_field).annotate(value=expression).values('value')[:1]
+    )
+
+
+def question_state(updated_at, score, answers_updated, answer_count, answer_score, comments_updated, comment_count,
+                   question_vote_updated=None, answer_votes_updated=None, answer_vote_count=None):
+    return (
+        updated_at, score,
+        answers_updated, answer_count or 0, answer_score or 0,
+        comments_updated, comment_count or 0,
+        question_vote_updated, answer_votes_updated, answer_vote_count or 0,
+    )
+
+
+def question_state_query(question_id, viewer=None):
+    answers = Answer.objects.all()
+    comments = Comment.objects.all()
+    queryset = Question.objects.filter(pk=question_id).order_by().values('updated_at', 'score').annotate(
+        answers_updated=aggregate_of(answers, 'question', Max('updated_at')),
+        answer_count=aggregate_of(answers, 'question', Count('pk')),
+        answer_score=aggregate_of(answers, 'question', Sum('score')),
+        comments_updated=aggregate_of(comments, 'answer__question', Max('updated_at')),
+        comment_count=aggregate_of(comments, 'answer__question', Count('pk')),
+    )
+    if viewer is not None:
+        # Switching a vote moves its updated_at, adding or removing one the count
+        votes = Vote.objects.filter(user=viewer)
+        queryset = queryset.annotate(
+            question_vote_updated=aggregate_of(votes, 'question', Max('updated_at')),
+            answer_votes_updated=aggregate_of(votes, 'answer__question', Max('updated_at')),
+            answer_vote_count=aggregate_of(votes, 'answer__question', Count('pk')),
+        )
+    return queryset
+
+
+def state_viewer(request, personalize):
+    """The user whose votes are part of the response, None for anonymous or ``personalize=false`` ones"""
+    return request.user if personalize and request.user.is_authenticated else None
+
+
+def question_validator(request, question_id, personalize=True):
+    """Validator of a question with its answers and comments, None when it doesn't exist"""
+    row = question_state_query(question_id, state_viewer(request, personalize)).first()
+    if row is None:
+        return None
+    return make_validator(request, question_state(**row))
+
+
+async def aquestion_validator(request, question_id, personalize=True):
+    row = await question_state_query(question_id, state_viewer(request, personalize)).afirst()
+    if row is None:
+        return None
+    return make_validator(request, question_state(**row))
+
+
+def loaded_question_validator(request, question):
+    """question_validator computed from a question loaded by load_question_detail, without a query"""
+    answers = question.answers.all()
+    comments = [comment for answer in answers for comment in answer.comments.all()]
+    # Set by the loader only when it looked up the viewer's votes
+    voted_answers = [answer for answer in answers if getattr(answer, 'viewer_vote_updated', None)]
+    return make_validator(request, question_state(
+        question.updated_at, question.score,
+        newest(*(answer.updated_at for answer in answers)), len(answers), sum(answer.score for answer in answers),
+        newest(*(comment.updated_at for comment in comments)), len(comments),
+        getattr(question, 'viewer_vote_updated', None),
+        newest(*(answer.viewer_vote_updated for answer in voted_answers)), len(voted_answers),
+    ))
+
+
+def comments_validator(request, question_id, answer_id):
+    state = Comment.objects.filter(answer_id=answer_id, answer__question_id=question_id).aggregate(
+        updated=Max('updated_at'), count=Count('pk'),
+    )
+    return make_validator(request, (state['updated'], state['count']))
+
+
+def notifications_state_query(user):
+    # The unread counter and watermark move whenever a notification is read
+    notifications = Notification.objects.all()
+    return NotificationState.objects.filter(user=user).values('unread_count', 'read_before').annotate(
+        last_activity=aggregate_of(notifications, 'recipient', Max('last_activity_at')),
+        count=aggregate_of(notifications, 'recipient', Count('pk')),
+    )
+
+
+def notifications_state_validator(request, state):
+    if state is None:
+        # No notification was ever created for the user
+        return make_validator(request, None)
+    return make_validator(request, sorted(state.items()))
+
+
+def notifications_validator(request):
+    return notifications_state_validator(request, notifications_state_query(request.user).first())
+
+
+async def anotifications_validator(request):
+    return notifications_state_validator(request, await notifications_state_query(request.user).afirst())
+
+
+def is_conditional(request):
+    return 'HTTP_IF_NONE_MATCH' in request.META
+
+
+def not_modified(request, validator):
+    """A 304 response when the client's copy matches ``validator``, otherwise None"""
+    return get_conditional_response(request, etag=validator.etag)
+
+
+def add_validator_headers(request, response, validator):
+    response.validator = validator
+    response['ETag'] = validator.etag
+    if request.user.is_authenticated:
+        patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+    else:
+        patch_cache_control(response, public=True, max_age=0, must_revalidate=True)
+    patch_vary_headers(response, ('Accept', 'Authorization'))
+    return response
@@ -0,0 +1,171 @@
+"""
+Pub/sub for pushing notification events to connected clients.
+
+Publishers are plain sync code (the outbox worker, the notification views)
+and call ``publish`` with a JSON-serializable message for a user's channel.
+Subscribers are the async server-sent events streams: each holds an
+asyncio queue that the backend fills, so an idle connection costs a queue
+and a suspended coroutine, not a thread.
+
+The backend is picked with ``FORUM_EVENT_BACKEND``:
+
+- ``LocalEventBackend`` delivers within the process, which is enough for a
+  single worker and for tests.
+- ``RedisEventBackend`` publishes through Redis, and one listener task per
+  worker fans incoming messages out to that worker's local subscribers, so
+  events reach users connected to any worker.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import event_subscribers
+
+logger = logging.getLogger(__name__)
+
+# Messages kept per subscriber; a client that falls this far behind loses the oldest
+SUBSCRIPTION_BUFFER = 100
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+class Subscription:
+    def __init__(self, backend, channel):
+        self.backend = backend
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=SUBSCRIPTION_BUFFER)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def get_nowait(self):
+        """The next message if one is waiting, otherwise None"""
+        try:
+            return self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+    def deliver(self, message):
+        """Queue a message from any thread"""
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    def close(self):
+        self.backend.unsubscribe(self)
+
+
+class LocalEventBackend:
+    """Delivers messages to subscribers in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def publish(self, channel, message):
+        self.deliver(channel, message)
+
+    def deliver(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.deliver(message)
+            except RuntimeError:
+                # The subscriber's event loop is gone
+                subscription.close()
+
+    def subscribe(self, channel):
+        """Subscription to ``channel``, must be called from the subscriber's event loop"""
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        event_subscribers.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None and subscription in subscriptions:
+                subscriptions.discard(subscription)
+                event_subscribers.dec()
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+class RedisEventBackend(LocalEventBackend):
+    """Shares messages between workers through Redis pub/sub"""
+    prefix = 'forum:events:'
+    reconnect_delay = 1
+
+    def __init__(self, url=None):
+        super().__init__()
+        self.url = url or os.getenv('REDIS_URL')
+        self._client = None
+        self._listener = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, json.dumps(message))
+
+    def subscribe(self, channel):
+        subscription = super().subscribe(channel)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+        return subscription
+
+    async def _listen(self):
+        import redis.asyncio
+
+        while self.subscriber_count():
+            try:
+                client = redis.asyncio.Redis.from_url(self.url)
+                async with client.pubsub() as pubsub:
+                    await pubsub.psubscribe(self.prefix + '*')
+                    async for message in pubsub.listen():
+                        if message['type'] != 'pmessage':
+                            continue
+                        channel = message['channel'].decode()[len(self.prefix):]
+                        self.deliver(channel, json.loads(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Event listener lost its Redis connection")
+                await asyncio.sleep(self.reconnect_delay)
+
+
+@functools.lru_cache(maxsize=None)
+def get_event_backend():
+    path = getattr(settings, 'FORUM_EVENT_BACKEND', 'forum.events.LocalEventBackend')
+    return import_string(path)()
+
+
+def publish_to_user(user_id, message):
+    """Publish to a user's streams, failures are logged rather than raised into the caller"""
+    try:
+        get_event_backend().publish(user_channel(user_id), message)
+    except Exception:
+        logger.exception("Could not publish %s event to user %s", message.get('type'), user_id)
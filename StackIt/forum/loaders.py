@@ -0,0 +1,112 @@
+"""
+Batched loaders for the question detail page and answer feeds.
+
+A question page needs the question, its tags, every answer with its
+comments, all of their authors and the viewer's votes. Loading them through
+the serializers' relations costs several queries per answer and comment;
+these loaders fetch the whole tree in a fixed number of queries:
+
+1. the question with its author,
+2. its tags,
+3. its answers with their authors,
+4. the comments of those answers with their authors,
+5. the viewer's votes on the question and all answers (authenticated only).
+"""
+from django.db.models import Prefetch, Q
+
+from .models import Answer, Comment, Question, Vote
+
+ANSWER_ORDERING = ('-is_accepted', '-score', '-created_at')
+
+
+def answer_queryset():
+    """Answers with authors and comments (and their authors) ready to serialize"""
+    return Answer.objects.select_related('author').prefetch_related(
+        Prefetch('comments', queryset=Comment.objects.select_related('author'))
+    )
+
+
+def question_detail_queryset():
+    return Question.objects.select_related('author').prefetch_related(
+        'tags',
+        Prefetch('answers', queryset=answer_queryset().order_by(*ANSWER_ORDERING)),
+    )
+
+
+def viewer_votes_query(user, question_ids, answer_ids):
+    """``(question_id, answer_id, value, updated_at)`` rows of the user's votes, None when there is nothing to look up"""
+    if not user.is_authenticated or not (question_ids or answer_ids):
+        return None
+    return Vote.objects.filter(user=user).filter(
+        Q(question_id__in=list(question_ids)) | Q(answer_id__in=list(answer_ids))
+    ).values_list('question_id', 'answer_id', 'value', 'updated_at')
+
+
+def votes_by_target(rows):
+    """``{('question'|'answer', id): (value, updated_at)}``"""
+    result = {}
+    for question_id, answer_id, value, updated_at in rows:
+        if question_id is not None:
+            result[('question', question_id)] = (value, updated_at)
+        else:
+            result[('answer', answer_id)] = (value, updated_at)
+    return result
+
+
+def viewer_vote_rows(user, question_ids=(), answer_ids=()):
+    rows = viewer_votes_query(user, question_ids, answer_ids)
+    return votes_by_target(rows) if rows is not None else {}
+
+
+async def aviewer_vote_rows(user, question_ids=(), answer_ids=()):
+    rows = viewer_votes_query(user, question_ids, answer_ids)
+    return votes_by_target([row async for row in rows]) if rows is not None else {}
+
+
+def viewer_votes(user, question_ids=(), answer_ids=()):
+    """The user's votes on the given questions and answers as ``{('question'|'answer', id): value}``"""
+    votes = viewer_vote_rows(user, question_ids, answer_ids)
+    return {target: value for target, (value, updated_at) in votes.items()}
+
+
+def set_viewer_votes(votes, questions, answers):
+    # viewer_vote_updated goes into the question page's validator
+    for question in questions:
+        question.viewer_vote, question.viewer_vote_updated = votes.get(('question', question.id), (0, None))
+    for answer in answers:
+        answer.viewer_vote, answer.viewer_vote_updated = votes.get(('answer', answer.id), (0, None))
+
+
+def attach_viewer_votes(user, questions=(), answers=()):
+    """Set ``viewer_vote`` (1, -1 or 0) on each object, read by the serializers"""
+    votes = viewer_vote_rows(
+        user,
+        question_ids=[question.id for question in questions],
+        answer_ids=[answer.id for answer in answers],
+    )
+    set_viewer_votes(votes, questions, answers)
+
+
+async def aattach_viewer_votes(user, questions=(), answers=()):
+    votes = await aviewer_vote_rows(
+        user,
+        question_ids=[question.id for question in questions],
+        answer_ids=[answer.id for answer in answers],
+    )
+    set_viewer_votes(votes, questions, answers)
+
+
+def load_question_detail(question_id, user, personalize=True):
+    """Question page data for ``user``, raises Question.DoesNotExist"""
+    question = question_detail_queryset().get(id=question_id)
+    if personalize:
+        attach_viewer_votes(user, questions=[question], answers=question.answers.all())
+    return question
+
+
+async def aload_question_detail(question_id, user, personalize=True):
+    """load_question_detail with the async ORM"""
+    question = await question_detail_queryset().aget(id=question_id)
+    if personalize:
+        await aattach_viewer_votes(user, questions=[question], answers=question.answers.all())
+    return question
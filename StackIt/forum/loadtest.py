@@ -0,0 +1,403 @@
+"""
+Request replay for load tests.
+
+A request mix is a list of ``ReplayRequest``. It comes either from a
+request log, one request per line, or from ``synthetic_mix``, which draws
+the forum's read traffic from the rows in the database. ``replay`` sends the
+mix from a number of concurrent workers. The workers use Django's test
+client in-process, where the queries of every request are counted, or a
+running server. With ``asgi=True`` they are coroutines on one event loop
+instead, calling the ASGI application (StackIt.asgi) directly, as an ASGI
+server would. It returns a ``Result`` per request, and ``summarize``
+groups those by route template such as ``/api/forum/questions/{id}/``.
+
+``query_delay`` makes every query take longer, standing in for a database
+across a network.
+
+Accepted log lines:
+
+- JSON objects with ``path`` and optionally ``method``, ``body`` and the
+  user as ``user_id`` or ``user`` (email), e.g. the JSON request log
+  written by StackIt.logging_middleware
+- ``METHOD /path`` plain text; other lines are skipped
+"""
+import asyncio
+import collections
+import http.client
+import json
+import math
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+from django.contrib.auth import get_user_model
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from StackIt import logging_middleware
+
+from .models import Answer, Notification, Question, Tag
+
+User = get_user_model()
+
+PERCENTILES = (50, 95, 99)
+PLAIN_LINE = re.compile(r'\b(GET|POST|PUT|PATCH|DELETE|HEAD|OPTIONS)\s+(/\S*)')
+
+
+@dataclass
+class ReplayRequest:
+    method: str
+    path: str
+    body: dict = None
+    user_id: int = None
+
+
+@dataclass
+class Result:
+    route: str
+    status: int
+    seconds: float
+    # None when the target can't tell, e.g. a server in another process
+    queries: int = None
+
+
+@dataclass
+class RouteStats:
+    route: str
+    latencies: list = field(default_factory=list)
+    queries: list = field(default_factory=list)
+    errors: int = 0
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+    def percentile(self, p):
+        return percentile(self.latencies, p)
+
+    def as_dict(self):
+        return {
+            'route': self.route,
+            'count': self.count,
+            'errors': self.errors,
+            **{f'p{p}_ms': round(self.percentile(p) * 1000, 2) for p in PERCENTILES},
+            'queries_mean': round(sum(self.queries) / len(self.queries), 2) if self.queries else None,
+            'queries_max': max(self.queries) if self.queries else None,
+        }
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of ``values``"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def route_template(path):
+    """``/api/forum/questions/{id}/`` for ``/api/forum/questions/12/``, the path itself when nothing matches"""
+    path = urlsplit(path).path
+    try:
+        return logging_middleware.route_template(resolve(path).route)
+    except Resolver404:
+        return path
+
+
+def parse_log(lines):
+    """ReplayRequests of a request log, see the module docstring for the formats"""
+    emails = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if not entry.get('path'):
+                continue
+            user_id = entry.get('user_id')
+            if user_id is None and entry.get('user'):
+                email = entry['user']
+                if email not in emails:
+                    emails[email] = User.objects.filter(email=email).values_list('id', flat=True).first()
+                user_id = emails[email]
+            yield ReplayRequest(entry.get('method', 'GET').upper(), entry['path'], entry.get('body'), user_id)
+            continue
+        match = PLAIN_LINE.search(line)
+        if match:
+            yield ReplayRequest(match.group(1), match.group(2))
+
+
+def synthetic_mix(count, seed=None, users=50):
+    """
+    ``count`` read requests shaped like the forum's traffic: mostly question
+    pages, feeds and answer lists, plus signed-in users polling their
+    notifications. Popular questions get most of the views.
+    """
+    from .management.commands.seed_forum import WORDS, ZipfSampler
+
+    rng = random.Random(seed)
+    question_ids = list(Question.objects.order_by('-id').values_list('id', flat=True)[:10000])
+    if not question_ids:
+        return []
+    # Users with notifications to poll
+    user_ids = list(Notification.objects.order_by().values_list('recipient', flat=True).distinct()[:users])
+    answered = list(Answer.objects.order_by().values_list('question_id', flat=True).distinct()[:2000])
+    tag_ids = list(Tag.objects.order_by('-question_count').values_list('id', flat=True)[:50])
+    questions = ZipfSampler(rng, question_ids, 1.1)
+    feeds = [
+        '/api/forum/questions/', '/api/forum/questions/?ordering=-hot', '/api/forum/questions/?ordering=-vote_count',
+        '/api/forum/questions/?ordering=-answer_count',
+    ]
+
+    def draw():
+        roll = rng.random()
+        if roll < 0.40:
+            return ReplayRequest('GET', f'/api/forum/questions/{questions.sample()[0]}/')
+        if roll < 0.60:
+            return ReplayRequest('GET', rng.choice(feeds))
+        if roll < 0.65:
+            return ReplayRequest('GET', f'/api/forum/questions/?search={rng.choice(WORDS)}')
+        if roll < 0.78:
+            question_id = rng.choice(answered) if answered else questions.sample()[0]
+            return ReplayRequest('GET', f'/api/forum/questions/{question_id}/answers/')
+        if roll < 0.85:
+            if tag_ids and rng.random() < 0.5:
+                return ReplayRequest('GET', f'/api/forum/tags/{rng.choice(tag_ids)}/')
+            return ReplayRequest('GET', '/api/forum/tags/')
+        if not user_ids:
+            return ReplayRequest('GET', '/api/forum/questions/')
+        user_id = rng.choice(user_ids)
+        if roll < 0.93:
+            return ReplayRequest('GET', '/api/forum/notifications/unread_count/', user_id=user_id)
+        return ReplayRequest('GET', '/api/forum/notifications/', user_id=user_id)
+
+    return [draw() for _ in range(count)]
+
+
+class AccessTokens:
+    """JWT access tokens of the replayed users, minted once per user"""
+
+    def __init__(self):
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def header(self, user_id):
+        if user_id is None:
+            return {}
+        with self.lock:
+            if user_id not in self.tokens:
+                user = User.objects.filter(id=user_id).first()
+                self.tokens[user_id] = str(RefreshToken.for_user(user).access_token) if user else None
+            token = self.tokens[user_id]
+        return {'Authorization': f'Bearer {token}'} if token else {}
+
+
+class InProcessTarget:
+    """Sends requests through Django's test client and counts their queries"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.client = Client()
+
+    def send(self, request):
+        body = json.dumps(request.body) if request.body is not None else ''
+        headers = self.tokens.header(request.user_id)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = self.client.generic(
+                request.method, request.path, body, content_type='application/json', headers=headers,
+            )
+            seconds = time.perf_counter() - started
+        return response.status_code, seconds, len(queries)
+
+    def close(self):
+        connection.close()
+
+
+class HTTPTarget:
+    """Sends requests to a running server over one keep-alive connection"""
+
+    def __init__(self, tokens, base_url):
+        self.tokens = tokens
+        url = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(url.netloc, timeout=30)
+        self.prefix = url.path.rstrip('/')
+
+    def send(self, request):
+        body = json.dumps(request.body) if request.body is not None else None
+        headers = {'Content-Type': 'application/json', **self.tokens.header(request.user_id)}
+        started = time.perf_counter()
+        try:
+            self.connection.request(request.method, self.prefix + request.path, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            status = 0
+        return status, time.perf_counter() - started, None
+
+    def close(self):
+        self.connection.close()
+
+
+class ASGITarget:
+    """Sends requests to the ASGI application, the way an ASGI server would"""
+
+    def __init__(self):
+        from StackIt.asgi import application
+
+        self.application = application
+
+    async def send(self, request, headers):
+        url = urlsplit(request.path)
+        body = json.dumps(request.body).encode() if request.body is not None else b''
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': request.method, 'scheme': 'http', 'path': url.path, 'raw_path': url.path.encode(),
+            'query_string': url.query.encode(), 'root_path': '',
+            'headers': [
+                (b'host', b'testserver'), (b'content-type', b'application/json'),
+                *((name.lower().encode(), value.encode()) for name, value in headers.items()),
+            ],
+            'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+        }
+        received = asyncio.Event()
+        status = 0
+
+        async def receive():
+            if not received.is_set():
+                received.set()
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            # The client never disconnects; Django cancels this once it has responded
+            await asyncio.Event().wait()
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        started = time.perf_counter()
+        await self.application(scope, receive, send)
+        return status, time.perf_counter() - started, None
+
+
+@contextmanager
+def query_delay(seconds):
+    """Every query takes ``seconds`` longer, on any connection, while in the block"""
+    if not seconds:
+        yield
+        return
+
+    def delay(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(connection, **kwargs):
+        if delay not in connection.execute_wrappers:
+            connection.execute_wrappers.append(delay)
+
+    connection_created.connect(install, weak=False, dispatch_uid='loadtest_query_delay')
+    for opened in connections.all(initialized_only=True):
+        install(opened)
+    try:
+        yield
+    finally:
+        connection_created.disconnect(dispatch_uid='loadtest_query_delay')
+        for opened in connections.all(initialized_only=True):
+            if delay in opened.execute_wrappers:
+                opened.execute_wrappers.remove(delay)
+
+
+def replay_asgi(requests, concurrency, tokens):
+    """``replay`` through ASGITarget, with ``concurrency`` requests in flight on one event loop"""
+    target = ASGITarget()
+    # Minted up front, the event loop can't use the ORM
+    headers = [tokens.header(request.user_id) for request in requests]
+    pending = collections.deque(zip(requests, headers))
+    results = []
+
+    async def work():
+        while pending:
+            request, request_headers = pending.popleft()
+            status, seconds, queries = await target.send(request, request_headers)
+            results.append(Result(route_template(request.path), status, seconds, queries))
+
+    async def run():
+        await asyncio.gather(*(work() for _ in range(max(concurrency, 1))))
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    return results, time.perf_counter() - started
+
+
+def replay(requests, concurrency=1, base_url=None, asgi=False):
+    """
+    Send ``requests`` from ``concurrency`` workers, to ``base_url``,
+    in-process or, with ``asgi``, to the ASGI application; returns the
+    Results and the wall-clock seconds taken
+    """
+    tokens = AccessTokens()
+    if asgi:
+        return replay_asgi(requests, concurrency, tokens)
+    pending = queue.SimpleQueue()
+    for request in requests:
+        pending.put(request)
+    results = []
+    lock = threading.Lock()
+
+    def work(close):
+        target = HTTPTarget(tokens, base_url) if base_url else InProcessTarget(tokens)
+        done = []
+        try:
+            while True:
+                try:
+                    request = pending.get_nowait()
+                except queue.Empty:
+                    break
+                status, seconds, queries = target.send(request)
+                done.append(Result(route_template(request.path), status, seconds, queries))
+        finally:
+            if close:
+                target.close()
+            with lock:
+                results.extend(done)
+
+    started = time.perf_counter()
+    if concurrency <= 1:
+        # On the calling thread, so the database connection (and any open
+        # transaction) is the caller's
+        work(close=bool(base_url))
+    else:
+        workers = [threading.Thread(target=work, args=(True,)) for _ in range(concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    return results, time.perf_counter() - started
+
+
+def summarize(results):
+    """RouteStats per route template, busiest first"""
+    stats = {}
+    for result in results:
+        route = stats.setdefault(result.route, RouteStats(result.route))
+        route.latencies.append(result.seconds)
+        if result.queries is not None:
+            route.queries.append(result.queries)
+        if not 200 <= result.status < 400:
+            route.errors += 1
+    return sorted(stats.values(), key=lambda route: (-route.count, route.route))
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from forum.models import Question, Answer, Vote
+
+# Through tables of the old upvotes/downvotes ManyToMany fields
+LEGACY_TABLES = [
+    ('forum_question_upvotes', 'question_id', Vote.UPVOTE),
+    ('forum_question_downvotes', 'question_id', Vote.DOWNVOTE),
+    ('forum_answer_upvotes', 'answer_id', Vote.UPVOTE),
+    ('forum_answer_downvotes', 'answer_id', Vote.DOWNVOTE),
+]
+
+class Command(BaseCommand):
+    help = 'Copy votes from the legacy upvotes/downvotes tables into Vote and recompute stored vote counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--recount-only',
+            action='store_true',
+            help='Skip the legacy import and only recompute score counters from Vote rows',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if not options['recount_only']:
+                self.import_legacy_votes()
+            for model, field in ((Question, 'question'), (Answer, 'answer')):
+                self.recount(model, field)
+                self.stdout.write(self.style.SUCCESS(f'Recomputed vote counters for {model.__name__} rows'))
+
+    def import_legacy_votes(self):
+        existing_tables = set(connection.introspection.table_names())
+        if not existing_tables & {table for table, _, _ in LEGACY_TABLES} and not Vote.objects.exists():
+            # Nothing to import from and nothing imported: the legacy tables
+            # were dropped before their votes were copied
+            raise CommandError(
+                'No legacy vote tables and no Vote rows: restore the forum_*_upvotes/downvotes '
+                'tables and run backfill_votes again, or pass --recount-only on a fresh database'
+            )
+        vote_table = Vote._meta.db_table
+        now = timezone.now()
+
+        # Upvotes are imported first, so a user left in both tables by the old
+        # check-then-act race keeps their upvote.
+        for table, target_column, value in LEGACY_TABLES:
+            if table not in existing_tables:
+                self.stdout.write(f'Legacy table {table} not found, skipping')
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {vote_table} (user_id, {target_column}, value, created_at, updated_at) '
+                    f'SELECT legacy.user_id, legacy.{target_column}, %s, %s, %s FROM {table} legacy '
+                    f'WHERE NOT EXISTS (SELECT 1 FROM {vote_table} v '
+                    f'WHERE v.user_id = legacy.user_id AND v.{target_column} = legacy.{target_column})',
+                    [value, now, now],
+                )
+                self.stdout.write(self.style.SUCCESS(f'Imported {cursor.rowcount} votes from {table}'))
+
+    def recount(self, model, field):
+        def count_of(value):
+            votes = (
+                Vote.objects.filter(**{field: OuterRef('pk'), 'value': value})
+                .order_by()
+                .values(field)
+                .annotate(total=Count('id'))
+                .values('total')
+            )
+            return Coalesce(Subquery(votes, output_field=IntegerField()), Value(0))
+
+        model.objects.update(
+            upvote_count=count_of(Vote.UPVOTE),
+            downvote_count=count_of(Vote.DOWNVOTE),
+        )
+        model.objects.update(score=F('upvote_count') - F('downvote_count'))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from forum.outbox import DEFAULT_BATCH_SIZE, drain_outbox
+
+class Command(BaseCommand):
+    help = 'Turn pending outbox events into notifications, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help='Events handled per transaction')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain what is pending and exit instead of polling')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            processed = drain_outbox(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Processed {processed} outbox events'))
+            return
+
+        self.stdout.write(f"Processing outbox events every {options['interval']}s, press Ctrl+C to stop")
+        try:
+            while True:
+                processed = drain_outbox(options['batch_size'])
+                if processed:
+                    self.stdout.write(f'Processed {processed} outbox events')
+                close_old_connections()
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS('Stopped'))
@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from forum.models import Notification, NotificationState
+
+class Command(BaseCommand):
+    help = 'Delete read notifications older than the retention period, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'FORUM_NOTIFICATION_RETENTION_DAYS', 90),
+                            help='Keep read notifications newer than this many days')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Notifications deleted per transaction')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches, the rest is left for the next run')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        # Read means flagged, or covered by the recipient's mark-all-read watermark
+        watermarked = NotificationState.objects.filter(user=OuterRef('recipient'), read_before__gte=OuterRef('created_at'))
+        expired = (
+            # Grouped activity keeps a notification around
+            Notification.objects.filter(last_activity_at__lt=cutoff)
+            .filter(Q(is_read=True) | Exists(watermarked))
+            .order_by('id')
+            .values_list('id', flat=True)
+        )
+
+        deleted = 0
+        batches = 0
+        while options['max_batches'] is None or batches < options['max_batches']:
+            with transaction.atomic():
+                ids = list(expired[:options['batch_size']])
+                if not ids:
+                    break
+                # Flag watermarked rows first, so the delete receiver knows they
+                # don't count towards the unread counter
+                Notification.objects.filter(id__in=ids, is_read=False).update(is_read=True)
+                Notification.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+            batches += 1
+            if len(ids) < options['batch_size']:
+                break
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} read notifications older than {options["days"]} days'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from forum.models import Question
+from forum.search import get_search_backend
+
+class Command(BaseCommand):
+    help = 'Create the full-text search structures and re-index every question'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.setup()
+        count = 0
+        for question in Question.objects.prefetch_related('tags').iterator(chunk_size=500):
+            backend.index(question)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} questions with {type(backend).__name__}'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from forum.models import Answer, Question
+from forum.ranking import sweep_hot_scores
+
+class Command(BaseCommand):
+    help = 'Recompute the stored answer_count of every question, then its hot score'
+
+    def handle(self, *args, **options):
+        answers = (
+            Answer.objects.filter(question=OuterRef('pk'))
+            .order_by()
+            .values('question')
+            .annotate(total=Count('id'))
+            .values('total')
+        )
+        updated = Question.objects.update(
+            answer_count=Coalesce(Subquery(answers, output_field=IntegerField()), Value(0))
+        )
+        sweep_hot_scores()
+        self.stdout.write(self.style.SUCCESS(f'Recomputed answer counts for {updated} questions'))
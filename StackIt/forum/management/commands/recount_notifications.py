@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from forum.models import Notification, NotificationState
+
+class Command(BaseCommand):
+    help = 'Recompute every user\'s stored unread notification count'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backfill-activity',
+            action='store_true',
+            help='Also set last_activity_at to created_at on every notification; run once, right after '
+                 'the migration adding last_activity_at, since it undoes later grouped activity',
+        )
+
+    def handle(self, *args, **options):
+        if options['backfill_activity']:
+            # The migration stamps existing rows with its own time, which would
+            # reorder every feed and hold old notifications back from purging
+            backfilled = Notification.objects.update(last_activity_at=F('created_at'))
+            self.stdout.write(self.style.SUCCESS(f'Set last_activity_at on {backfilled} notifications'))
+        recipients = Notification.objects.values('recipient').distinct()
+        NotificationState.objects.bulk_create(
+            [NotificationState(user_id=row['recipient']) for row in recipients.iterator()],
+            ignore_conflicts=True,
+            batch_size=1000,
+        )
+        # Unread notifications newer than the user's read watermark
+        unread = (
+            Notification.objects.filter(recipient=OuterRef('user'), is_read=False)
+            .filter(Q(created_at__gt=OuterRef('read_before')) | Q(recipient__notification_state__read_before__isnull=True))
+            .order_by()
+            .values('recipient')
+            .annotate(total=Count('pk'))
+            .values('total')
+        )
+        updated = NotificationState.objects.update(
+            unread_count=Coalesce(Subquery(unread, output_field=IntegerField()), Value(0))
+        )
+        self.stdout.write(self.style.SUCCESS(f'Recomputed unread counts for {updated} users'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from forum.cache import tag_catalogue
+from forum.models import Tag
+
+class Command(BaseCommand):
+    help = 'Recompute the stored question_count of every tag'
+
+    def handle(self, *args, **options):
+        updated = Tag.objects.recount_questions()
+        tag_catalogue.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Recomputed question counts for {updated} tags'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from forum.ranking import DEFAULT_BATCH_SIZE, sweep_hot_scores
+
+class Command(BaseCommand):
+    help = 'Recompute the hot score of recent questions so it decays with age; run it every few minutes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help='Questions rescored per UPDATE')
+
+    def handle(self, *args, **options):
+        updated = sweep_hot_scores(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Refreshed hot scores of {updated} questions'))
@@ -0,0 +1,126 @@
+import json
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from forum.loadtest import PERCENTILES, parse_log, percentile, query_delay, replay, summarize, synthetic_mix
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay a request log or a synthetic request mix, in-process or against a running server, '
+        'and report latency percentiles, throughput and query counts per route'
+    )
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--log', help='Request log to replay, one request per line ("-" for stdin)')
+        source.add_argument('--synthetic', type=int, metavar='N',
+                            help='Replay N requests drawn from the data in the database')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed of the synthetic mix')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Requests in flight at once')
+        parser.add_argument('--repeat', type=int, default=1,
+                            help='Replay the mix this many times')
+        parser.add_argument('--warmup', type=int, default=0,
+                            help='Send the first N requests before measuring')
+        parser.add_argument('--url', default=None,
+                            help='Base URL of a running server, e.g. http://localhost:8000; in-process by default')
+        parser.add_argument('--asgi', action='store_true',
+                            help='Send the requests to the ASGI application in-process, all on one event loop')
+        parser.add_argument('--query-delay', type=float, default=0, metavar='MS',
+                            help='Add MS milliseconds to every query, like a database across a network')
+        parser.add_argument('--save', metavar='PATH',
+                            help='Write the report as JSON, to --compare a later run against')
+        parser.add_argument('--compare', metavar='PATH',
+                            help='Report saved by an earlier run (e.g. on another branch) to compare with')
+
+    def handle(self, *args, **options):
+        requests = self.load_requests(options)
+        if not requests:
+            raise CommandError('No requests to replay')
+        if options['asgi'] and options['url']:
+            raise CommandError('--asgi replays in-process, it can\'t be combined with --url')
+        warmup, requests = requests[:options['warmup']], requests[options['warmup']:] * options['repeat']
+        target = options['concurrency'], options['url'], options['asgi']
+
+        # The test client talks to "testserver"
+        hosts = [*settings.ALLOWED_HOSTS, 'testserver']
+        with override_settings(ALLOWED_HOSTS=hosts), query_delay(options['query_delay'] / 1000):
+            if warmup:
+                replay(warmup, *target)
+            results, seconds = replay(requests, *target)
+
+        report = self.report(results, seconds, options)
+        self.print_report(report)
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.print_comparison(json.load(f), report)
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Saved the report to {options["save"]}')
+
+    def load_requests(self, options):
+        if options['synthetic'] is not None:
+            return synthetic_mix(options['synthetic'], seed=options['seed'])
+        if options['log'] == '-':
+            return list(parse_log(sys.stdin))
+        try:
+            with open(options['log']) as f:
+                return list(parse_log(f))
+        except OSError as exc:
+            raise CommandError(f'Cannot read {options["log"]}: {exc}')
+
+    def report(self, results, seconds, options):
+        latencies = [result.seconds for result in results]
+        return {
+            'target': options['url'] or ('asgi' if options['asgi'] else 'in-process'),
+            'concurrency': options['concurrency'],
+            'query_delay_ms': options['query_delay'],
+            'requests': len(results),
+            'errors': sum(1 for result in results if not 200 <= result.status < 400),
+            'seconds': round(seconds, 3),
+            'throughput': round(len(results) / seconds, 2) if seconds else 0.0,
+            **{f'p{p}_ms': round(percentile(latencies, p) * 1000, 2) for p in PERCENTILES},
+            'routes': [route.as_dict() for route in summarize(results)],
+        }
+
+    def print_report(self, report):
+        columns = ''.join(f'{f"p{p} ms":>9}' for p in PERCENTILES)
+        self.stdout.write(f'{"route":<52}{"count":>7}{"errors":>7}{columns}{"queries":>9}{"max":>5}')
+        for route in report['routes']:
+            latencies = ''.join(f'{route[f"p{p}_ms"]:>9.1f}' for p in PERCENTILES)
+            queries = '-' if route['queries_mean'] is None else f'{route["queries_mean"]:.1f}'
+            queries_max = '-' if route['queries_max'] is None else route['queries_max']
+            self.stdout.write(
+                f'{route["route"][:51]:<52}{route["count"]:>7}{route["errors"]:>7}{latencies}{queries:>9}{queries_max:>5}'
+            )
+        latencies = ', '.join(f'p{p} {report[f"p{p}_ms"]:.1f} ms' for p in PERCENTILES)
+        self.stdout.write(self.style.SUCCESS(
+            f'{report["requests"]} requests ({report["errors"]} errors) in {report["seconds"]:.2f}s '
+            f'at concurrency {report["concurrency"]}: {report["throughput"]:.1f} req/s, {latencies}'
+        ))
+
+    def print_comparison(self, baseline, report):
+        def change(before, after):
+            return f'{(after - before) / before * 100:+.1f}%' if before else '-'
+
+        self.stdout.write(f'\nCompared with {baseline.get("target")} at concurrency {baseline.get("concurrency")}:')
+        self.stdout.write(f'{"route":<52}{"p50":>9}{"p95":>9}{"p99":>9}{"queries":>9}')
+        before = {route['route']: route for route in baseline['routes']}
+        for route in report['routes']:
+            old = before.get(route['route'])
+            if old is None:
+                continue
+            queries = '-'
+            if route['queries_mean'] is not None and old['queries_mean'] is not None:
+                queries = f'{route["queries_mean"] - old["queries_mean"]:+.1f}'
+            self.stdout.write(
+                f'{route["route"][:51]:<52}'
+                + ''.join(f'{change(old[f"p{p}_ms"], route[f"p{p}_ms"]):>9}' for p in PERCENTILES)
+                + f'{queries:>9}'
+            )
+        self.stdout.write(f'Throughput {change(baseline["throughput"], report["throughput"])}')
@@ -0,0 +1,270 @@
+import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import accumulate, islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.text import slugify
+from account.models import UserProfile
+from forum.models import Answer, Comment, Notification, Question, Tag, Vote
+from forum.outbox import MESSAGES
+
+User = get_user_model()
+
+WORDS = (
+    'python django react query index cache async thread queue deploy docker build test error '
+    'request response model view form field migration database postgres sqlite redis celery '
+    'token auth session cookie header json api rest graphql schema type class function method '
+    'loop list dict string number date time timezone memory leak slow fast memory profile '
+    'signal middleware template static media upload file path import module package version'
+).split()
+
+
+def zipf_cum_weights(n, exponent):
+    """Cumulative weights of ranks 1..n, the rank k item being picked in proportion to 1/k**exponent"""
+    return list(accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+
+class ZipfSampler:
+    """Draws items with Zipfian popularity; which item gets which rank is random"""
+
+    def __init__(self, rng, items, exponent):
+        self.rng = rng
+        self.items = list(items)
+        rng.shuffle(self.items)
+        self.cum_weights = zipf_cum_weights(len(self.items), exponent)
+
+    def sample(self, k=1):
+        return self.rng.choices(self.items, cum_weights=self.cum_weights, k=k)
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Let bulk_create keep the given created_at/updated_at instead of stamping them with now"""
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate synthetic users, questions, answers, comments, votes, tags and notifications '
+        'with Zipfian popularity, for benchmarks'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--questions', type=int, default=5000)
+        parser.add_argument('--tags', type=int, default=200)
+        parser.add_argument('--answers-per-question', type=float, default=2.5,
+                            help='Mean answers per question')
+        parser.add_argument('--comments-per-answer', type=float, default=1.0,
+                            help='Mean comments per answer')
+        parser.add_argument('--votes-per-post', type=float, default=3.0,
+                            help='Mean votes per question and per answer')
+        parser.add_argument('--max-tags-per-question', type=int, default=5)
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent of user activity and post popularity')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Spread question creation times over this many days')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows per bulk insert and transaction')
+        parser.add_argument('--password', default='password',
+                            help='Password of every seeded user')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed, the same seed generates the same rows')
+        parser.add_argument('--skip-search-index', action='store_true',
+                            help='Leave the full-text search index for rebuild_search_index')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.now = timezone.now()
+        self.rows = 0
+        started = time.monotonic()
+
+        # Seeded rows skip the signal receivers; the counters are recomputed at the end
+        with explicit_timestamps(User, Tag, Question, Answer, Comment, Vote, Notification):
+            self.seed_users()
+            self.seed_tags()
+            self.seed_questions()
+            self.seed_answers()
+            self.seed_comments()
+            self.seed_votes()
+            self.seed_notifications()
+
+        call_command('backfill_votes', recount_only=True, stdout=self.stdout)
+        call_command('recount_answers', stdout=self.stdout)
+        call_command('recount_tags', stdout=self.stdout)
+        call_command('recount_notifications', stdout=self.stdout)
+        if not options['skip_search_index']:
+            call_command('rebuild_search_index', stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {self.rows} rows in {time.monotonic() - started:.1f}s'
+        ))
+
+    def insert(self, model, objects, ignore_conflicts=False):
+        """bulk_create ``objects`` in batches of --batch-size, one transaction each; returns the pks"""
+        batch_size = self.options['batch_size']
+        objects = iter(objects)
+        pks = []
+        while batch := list(islice(objects, batch_size)):
+            with transaction.atomic():
+                model.objects.bulk_create(batch, batch_size=batch_size, ignore_conflicts=ignore_conflicts)
+            pks.extend(obj.pk for obj in batch)
+            self.rows += len(batch)
+        self.stdout.write(f'Inserted {len(pks)} {model._meta.verbose_name_plural}')
+        return pks
+
+    def words(self, low, high):
+        return ' '.join(self.rng.choices(WORDS, k=self.rng.randint(low, high)))
+
+    def timestamp_after(self, start, mean_hours):
+        """Random time after ``start``, exponentially distributed, never in the future"""
+        return min(start + timedelta(hours=self.rng.expovariate(1 / mean_hours)), self.now)
+
+    def seed_users(self):
+        # One hash for every user: hashing each password would dominate the run
+        password = make_password(self.options['password'])
+        first = (User.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+        joined = self.now - timedelta(days=self.options['days'])
+        self.emails = [f'seed{first + i}@example.com' for i in range(self.options['users'])]
+        self.user_ids = self.insert(User, (
+            User(email=email, password=password, verified=True, created_at=joined, updated_at=joined)
+            for email in self.emails
+        ))
+        self.insert(UserProfile, (
+            UserProfile(user_id=user_id, name=f'Seed user {user_id}') for user_id in self.user_ids
+        ))
+        # The few most active users write most of the posts and cast most of the votes
+        self.active_users = ZipfSampler(self.rng, range(len(self.user_ids)), self.options['skew'])
+
+    def seed_tags(self):
+        names = [f'{self.rng.choice(WORDS)}-{i}' for i in range(self.options['tags'])]
+        self.insert(Tag, (
+            Tag(name=name, slug=slugify(name), created_at=self.now, description=f'Questions about {name}')
+            for name in names
+        ), ignore_conflicts=True)
+        ids = dict(Tag.objects.filter(name__in=names).values_list('name', 'id'))
+        self.popular_tags = ZipfSampler(self.rng, [ids[name] for name in names], self.options['skew'])
+
+    def seed_questions(self):
+        count = self.options['questions']
+        start = self.now - timedelta(days=self.options['days'])
+        span = (self.now - start).total_seconds()
+        # Ascending creation times, so ids follow age as they would in production
+        self.question_times = sorted(start + timedelta(seconds=self.rng.random() * span) for _ in range(count))
+        self.question_authors = [self.active_users.sample()[0] for _ in range(count)]
+        self.question_titles = [self.words(4, 10).capitalize() + '?' for _ in range(count)]
+        self.question_ids = self.insert(Question, (
+            Question(
+                title=title, description=f'<p>{self.words(20, 80)}</p>',
+                author_id=self.user_ids[author], created_at=created, updated_at=created,
+            )
+            for title, author, created in zip(self.question_titles, self.question_authors, self.question_times)
+        ))
+
+        links = set()
+        for question_id in self.question_ids:
+            for tag_id in self.popular_tags.sample(self.rng.randint(1, self.options['max_tags_per_question'])):
+                links.add((question_id, tag_id))
+        Link = Question.tags.through
+        self.insert(Link, (Link(question_id=question_id, tag_id=tag_id) for question_id, tag_id in sorted(links)))
+
+    def seed_answers(self):
+        count = round(len(self.question_ids) * self.options['answers_per_question'])
+        questions = ZipfSampler(self.rng, range(len(self.question_ids)), self.options['skew'])
+        answered = sorted(
+            (self.timestamp_after(self.question_times[question], mean_hours=12), question)
+            for question in (questions.sample(count) if count else [])
+        )
+        self.answer_times = [created for created, _ in answered]
+        self.answer_questions = [question for _, question in answered]
+        self.answer_authors = [self.active_users.sample()[0] for _ in answered]
+        accepted = set()
+
+        def answers():
+            for question, author, created in zip(self.answer_questions, self.answer_authors, self.answer_times):
+                # A third of the answered questions accept their first answer
+                is_accepted = question not in accepted and self.rng.random() < 1 / 3
+                accepted.add(question)
+                yield Answer(
+                    question_id=self.question_ids[question], author_id=self.user_ids[author],
+                    content=f'<p>{self.words(15, 120)}</p>', is_accepted=is_accepted,
+                    created_at=created, updated_at=created,
+                )
+
+        self.answer_ids = self.insert(Answer, answers())
+
+    def seed_comments(self):
+        count = round(len(self.answer_ids) * self.options['comments_per_answer'])
+        answers = ZipfSampler(self.rng, range(len(self.answer_ids)), self.options['skew'])
+        commented = sorted(
+            (self.timestamp_after(self.answer_times[answer], mean_hours=6), answer)
+            for answer in (answers.sample(count) if count else [])
+        )
+        self.comment_times = [created for created, _ in commented]
+        self.comment_answers = [answer for _, answer in commented]
+        self.comment_authors = [self.active_users.sample()[0] for _ in commented]
+        self.insert(Comment, (
+            Comment(
+                answer_id=self.answer_ids[answer], author_id=self.user_ids[author],
+                content=self.words(5, 30), created_at=created, updated_at=created,
+            )
+            for answer, author, created in zip(self.comment_answers, self.comment_authors, self.comment_times)
+        ))
+
+    def seed_votes(self):
+        for field, ids in (('question', self.question_ids), ('answer', self.answer_ids)):
+            targets = ZipfSampler(self.rng, ids, self.options['skew'])
+            votes = set()
+            for target in targets.sample(round(len(ids) * self.options['votes_per_post'])) if ids else []:
+                votes.add((self.user_ids[self.active_users.sample()[0]], target))
+            self.insert(Vote, (
+                Vote(
+                    user_id=user_id, value=Vote.UPVOTE if self.rng.random() < 0.85 else Vote.DOWNVOTE,
+                    created_at=self.now, updated_at=self.now, **{f'{field}_id': target},
+                )
+                for user_id, target in sorted(votes)
+            ))
+
+    def seed_notifications(self):
+        """An answer notification per answer and a comment notification per comment, most of them read"""
+        def notification(notification_type, recipient, sender, question, created):
+            return Notification(
+                recipient_id=self.user_ids[recipient], sender_id=self.user_ids[sender],
+                notification_type=notification_type, question_id=self.question_ids[question],
+                message=MESSAGES[notification_type][0].format(
+                    sender=self.emails[sender], title=self.question_titles[question],
+                ),
+                actor_ids=[self.user_ids[sender]], is_read=self.rng.random() < 0.7,
+                created_at=created, last_activity_at=created,
+            )
+
+        def notifications():
+            for answer, (question, author) in enumerate(zip(self.answer_questions, self.answer_authors)):
+                recipient = self.question_authors[question]
+                if recipient != author:
+                    yield notification('answer', recipient, author, question, self.answer_times[answer])
+            for answer, author, created in zip(self.comment_answers, self.comment_authors, self.comment_times):
+                recipient = self.answer_authors[answer]
+                if recipient != author:
+                    yield notification('comment', recipient, author, self.answer_questions[answer], created)
+
+        self.insert(Notification, notifications())
@@ -0,0 +1,40 @@
+"""
+@mentions in comments.
+
+Users are mentioned by email address, e.g. ``@jane@example.com``. Handles
+are de-duplicated and capped at ``FORUM_MAX_MENTIONS_PER_COMMENT`` per
+comment, then resolved for a whole batch of comments with one query.
+Emails are stored lowercased, so lowercasing the handles makes that an
+``IN`` lookup on the unique email index.
+"""
+import re
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+MENTION_PATTERN = re.compile(r'(?<![\w.+-])@([\w.%+-]+@[\w-]+(?:\.[\w-]+)*\.[A-Za-z]{2,})')
+
+
+def max_mentions():
+    return getattr(settings, 'FORUM_MAX_MENTIONS_PER_COMMENT', 10)
+
+
+def parse_mentions(text, limit=None):
+    """Distinct lowercased handles in order of first appearance, at most ``limit``"""
+    limit = max_mentions() if limit is None else limit
+    handles = []
+    for match in MENTION_PATTERN.finditer(text):
+        handle = match.group(1).lower()
+        if handle not in handles:
+            handles.append(handle)
+            if len(handles) >= limit:
+                break
+    return handles
+
+
+def resolve_mentions(handles):
+    """``{handle: user}`` for the handles that belong to a user, in one query"""
+    handles = set(handles)
+    if not handles:
+        return {}
+    return {user.email: user for user in get_user_model().objects.filter(email__in=handles)}
@@ -0,0 +1,20 @@
+"""The forum's metrics, rendered with the request metrics by StackIt.metrics"""
+from StackIt.metrics import Counter, Gauge
+
+posts_written = Counter(
+    'forum_posts_written_total', 'Questions, answers and comments created, updated or deleted',
+    ['type', 'action'],
+)
+votes_cast = Counter(
+    'forum_votes_total', 'Votes cast, changed or withdrawn on questions and answers', ['target', 'value'],
+)
+notifications_written = Counter(
+    'forum_notifications_total', 'Notifications created, or grouped into an unread notification',
+    ['type', 'result'],
+)
+cache_requests = Counter(
+    'forum_cache_requests_total', 'Response cache and tag catalogue lookups, by hit or miss', ['cache', 'result'],
+)
+event_subscribers = Gauge(
+    'forum_event_subscribers', 'Open notification streams',
+)
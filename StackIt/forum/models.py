@@ -1,16 +1,40 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchVectorField
+from django.dispatch import Signal
+from django.utils import timezone
 from django.utils.text import slugify
+from collections import defaultdict, namedtuple
 import uuid
 
+from .hyperloglog import HyperLogLog, DEFAULT_PRECISION
+
 User = get_user_model()
 
+class TagQuerySet(models.QuerySet):
+    def recount_questions(self):
+        """Set question_count of the selected tags from their links, returns the number of tags"""
+        links = (
+            Question.tags.through.objects.filter(tag_id=OuterRef('pk'))
+            .order_by()
+            .values('tag_id')
+            .annotate(total=Count('id'))
+            .values('total')
+        )
+        return self.update(question_count=Coalesce(Subquery(links, output_field=models.IntegerField()), Value(0)))
+
 class Tag(models.Model):
     """Model for question tags"""
     name = models.CharField(max_length=30, unique=True)
     slug = models.SlugField(max_length=40, unique=True, blank=True)
     description = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Maintained by the Question.tags m2m_changed and Question pre_delete receivers
+    question_count = models.PositiveIntegerField(default=0)
+    
+    objects = TagQuerySet.as_manager()
     
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -32,20 +56,46 @@ class Question(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     views_count = models.PositiveIntegerField(default=0)
-    upvotes = models.ManyToManyField(User, related_name='upvoted_questions', blank=True)
-    downvotes = models.ManyToManyField(User, related_name='downvoted_questions', blank=True)
+    # HyperLogLog estimate of distinct viewers, refreshed when view counts are flushed
+    unique_viewers = models.PositiveIntegerField(default=0, db_index=True)
+    # Vote counters maintained by Vote.objects.set_vote
+    score = models.IntegerField(default=0, db_index=True)
+    upvote_count = models.PositiveIntegerField(default=0)
+    downvote_count = models.PositiveIntegerField(default=0)
+    # Legacy vote links, no longer written: kept until every database has run
+    # backfill_votes, so no migration drops them before they are copied to Vote
+    upvotes = models.ManyToManyField(User, related_name='upvoted_questions', blank=True, editable=False)
+    downvotes = models.ManyToManyField(User, related_name='downvoted_questions', blank=True, editable=False)
+    # Maintained by the Answer signals, so feeds can sort on it without aggregating
+    answer_count = models.PositiveIntegerField(default=0, db_index=True)
+    # Time-decayed activity score behind ordering=-hot (see forum.ranking)
+    hot_score = models.FloatField(default=0, editable=False)
+    # Weighted full-text document, only populated on PostgreSQL (see forum.search)
+    search_vector = SearchVectorField(null=True, editable=False)
     
     @property
     def vote_count(self):
-        """Calculate the net vote count"""
-        return self.upvotes.count() - self.downvotes.count()
+        """Net vote count"""
+        return self.score
     
     @property
-    def answer_count(self):
-        """Get the count of answers for this question"""
-        return self.answers.count()
+    def hot(self):
+        """hot_score under its name in the API's ``ordering``"""
+        return self.hot_score
+    
+    # Read by Vote.objects.set_vote along with the locked row, see vote_updates
+    VOTE_ROW_FIELDS = ('answer_count', 'views_count', 'created_at')
+    
+    @staticmethod
+    def vote_updates(row, score):
+        """Fields set in the same UPDATE as the vote counters, the hot score follows the new ``score``"""
+        from .ranking import hot_score
+        return {'hot_score': hot_score(score, row['answer_count'], row['views_count'], row['created_at'])}
     
     def save(self, *args, **kwargs):
+        if self._state.adding:
+            from .ranking import hot_score
+            self.hot_score = hot_score(self.score, self.answer_count, self.views_count, timezone.now())
         super().save(*args, **kwargs)
     
     def __str__(self):
@@ -53,6 +103,11 @@ class Question(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # The default and hot feeds, in keyset pagination order
+            models.Index(fields=['-created_at', '-id'], name='forum_question_created_idx'),
+            models.Index(fields=['-hot_score', '-id'], name='forum_question_hot_idx'),
+        ]
 
 class Answer(models.Model):
     """Model for answers to questions"""
@@ -62,13 +117,18 @@ class Answer(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_accepted = models.BooleanField(default=False)
-    upvotes = models.ManyToManyField(User, related_name='upvoted_answers', blank=True)
-    downvotes = models.ManyToManyField(User, related_name='downvoted_answers', blank=True)
+    # Vote counters maintained by Vote.objects.set_vote
+    score = models.IntegerField(default=0, db_index=True)
+    upvote_count = models.PositiveIntegerField(default=0)
+    downvote_count = models.PositiveIntegerField(default=0)
+    # Legacy vote links, see Question.upvotes
+    upvotes = models.ManyToManyField(User, related_name='upvoted_answers', blank=True, editable=False)
+    downvotes = models.ManyToManyField(User, related_name='downvoted_answers', blank=True, editable=False)
     
     @property
     def vote_count(self):
-        """Calculate the net vote count"""
-        return self.upvotes.count() - self.downvotes.count()
+        """Net vote count"""
+        return self.score
     
     def __str__(self):
         return f"Answer to: {self.question.title[:50]}"
@@ -81,6 +141,171 @@ class Answer(models.Model):
     
     class Meta:
         ordering = ['-is_accepted', '-created_at']
+        indexes = [
+            # A question's answers in display order (forum.loaders.ANSWER_ORDERING)
+            models.Index(fields=['question', '-is_accepted', '-score', '-created_at', '-id'], name='forum_answer_question_idx'),
+        ]
+
+# Sent by VoteManager.set_vote when a vote changed, with the target model as
+# sender and ``target_id``; votes are written with queryset updates, so
+# post_save doesn't cover them
+vote_changed = Signal()
+
+VoteResult = namedtuple('VoteResult', ['vote', 'score', 'upvote_count', 'downvote_count'])
+
+class VoteManager(models.Manager):
+    def set_vote(self, user, target, value, toggle=False):
+        """
+        Set the user's vote on a question or answer to +1, -1 or 0 (no vote).
+
+        ``target`` is a Question/Answer instance or a queryset narrowed to a
+        single one. The target row is locked and read together with the
+        user's current vote, then the vote row is inserted, updated or
+        deleted and the stored counters adjusted, all in one transaction.
+        With ``toggle=True`` casting the same value twice removes the vote.
+        Returns a VoteResult with the new vote and counters.
+        """
+        if value not in (Vote.UPVOTE, Vote.DOWNVOTE, 0):
+            raise ValueError('Vote value must be 1, -1 or 0')
+        if isinstance(target, models.Model):
+            target = type(target)._default_manager.filter(pk=target.pk)
+        model = target.model
+        target_field = Vote.target_field(model)
+        current_vote = self.filter(user=user, **{target_field: OuterRef('pk')}).values('value')[:1]
+        
+        with transaction.atomic():
+            row = (
+                target.select_for_update()
+                .annotate(current_vote=Subquery(current_vote))
+                .values('pk', 'score', 'upvote_count', 'downvote_count', 'current_vote',
+                        *getattr(model, 'VOTE_ROW_FIELDS', ()))
+                .first()
+            )
+            if row is None:
+                raise model.DoesNotExist(f"{model.__name__} matching query does not exist.")
+            
+            previous = row['current_vote'] or 0
+            if toggle and previous == value:
+                value = 0
+            upvote_delta = int(value == Vote.UPVOTE) - int(previous == Vote.UPVOTE)
+            downvote_delta = int(value == Vote.DOWNVOTE) - int(previous == Vote.DOWNVOTE)
+            
+            if previous != value:
+                lookup = {'user': user, f'{target_field}_id': row['pk']}
+                if value == 0:
+                    self.filter(**lookup).delete()
+                elif previous:
+                    self.filter(**lookup).update(value=value, updated_at=timezone.now())
+                else:
+                    self.create(value=value, **lookup)
+                
+                # The row is locked, so its score can't have moved since it was read
+                vote_updates = getattr(model, 'vote_updates', None)
+                model._default_manager.filter(pk=row['pk']).update(
+                    score=F('score') + (value - previous),
+                    upvote_count=F('upvote_count') + upvote_delta,
+                    downvote_count=F('downvote_count') + downvote_delta,
+                    **(vote_updates(row, row['score'] + value - previous) if vote_updates else {}),
+                )
+                vote_changed.send(sender=model, target_id=row['pk'], user=user, value=value)
+        
+        return VoteResult(
+            vote=value,
+            score=row['score'] + value - previous,
+            upvote_count=row['upvote_count'] + upvote_delta,
+            downvote_count=row['downvote_count'] + downvote_delta,
+        )
+
+class Vote(models.Model):
+    """A user's vote on exactly one question or answer"""
+    UPVOTE = 1
+    DOWNVOTE = -1
+    VALUE_CHOICES = (
+        (UPVOTE, 'Upvote'),
+        (DOWNVOTE, 'Downvote'),
+    )
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='votes')
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, null=True, blank=True, related_name='votes')
+    answer = models.ForeignKey(Answer, on_delete=models.CASCADE, null=True, blank=True, related_name='votes')
+    value = models.SmallIntegerField(choices=VALUE_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = VoteManager()
+    
+    @staticmethod
+    def target_field(model):
+        """Name of the foreign key pointing at the voted model"""
+        if issubclass(model, Question):
+            return 'question'
+        if issubclass(model, Answer):
+            return 'answer'
+        raise TypeError(f"Cannot vote on {model.__name__}")
+    
+    def __str__(self):
+        return f"{self.user} voted {self.value:+d} on {self.question or self.answer}"
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'question'],
+                condition=Q(question__isnull=False),
+                name='unique_question_vote',
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'answer'],
+                condition=Q(answer__isnull=False),
+                name='unique_answer_vote',
+            ),
+            models.CheckConstraint(
+                condition=Q(question__isnull=False, answer__isnull=True) | Q(question__isnull=True, answer__isnull=False),
+                name='vote_single_target',
+            ),
+            models.CheckConstraint(
+                condition=Q(value__in=[1, -1]),
+                name='vote_value_valid',
+            ),
+        ]
+
+class ViewerSketchQuerySet(models.QuerySet):
+    def merged(self, precision=DEFAULT_PRECISION):
+        """
+        Union of the selected sketches, e.g. the unique reach of a tag in a week:
+        ``QuestionViewerSketch.objects.filter(question__tags=tag, day__gte=start).merged().count()``
+        """
+        sketch = HyperLogLog(precision)
+        for registers in self.values_list('registers', flat=True).iterator():
+            sketch.merge(HyperLogLog.from_bytes(registers))
+        return sketch
+
+class QuestionViewerSketch(models.Model):
+    """HyperLogLog sketch of a question's distinct viewers for one day, or all time when day is null"""
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, related_name='viewer_sketches')
+    day = models.DateField(null=True, blank=True)
+    registers = models.BinaryField()
+    
+    objects = ViewerSketchQuerySet.as_manager()
+    
+    @property
+    def sketch(self):
+        return HyperLogLog.from_bytes(self.registers)
+    
+    def __str__(self):
+        return f"Viewers of {self.question_id} on {self.day or 'all days'}"
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['question', 'day'],
+                name='unique_question_day_sketch',
+            ),
+            models.UniqueConstraint(
+                fields=['question'],
+                condition=Q(day__isnull=True),
+                name='unique_question_total_sketch',
+            ),
+        ]
 
 class Comment(models.Model):
     """Model for comments on answers"""
@@ -95,6 +320,9 @@ class Comment(models.Model):
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['answer', 'created_at', 'id'], name='forum_comment_answer_idx'),
+        ]
 
 class Notification(models.Model):
     """Model for user notifications"""
@@ -112,11 +340,152 @@ class Notification(models.Model):
     answer = models.ForeignKey(Answer, on_delete=models.CASCADE, null=True, blank=True)
     comment = models.ForeignKey(Comment, on_delete=models.CASCADE, null=True, blank=True)
     message = models.TextField()
+    # Activity of the same type on the same question is grouped into one unread
+    # notification, which points at the latest sender, answer and comment
+    actor_ids = models.JSONField(default=list, blank=True)
+    actor_count = models.PositiveIntegerField(default=1)
     is_read = models.BooleanField(default=False)
+    # Compared with the read watermark, so it never moves
     created_at = models.DateTimeField(auto_now_add=True)
+    # Time of the latest grouped activity, which orders the feed
+    last_activity_at = models.DateTimeField(default=timezone.now)
     
     def __str__(self):
         return f"Notification to {self.recipient.email}: {self.message[:50]}"
     
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-last_activity_at']
+        indexes = [
+            # A recipient's feed in keyset pagination order
+            models.Index(fields=['recipient', '-last_activity_at', '-id'], name='forum_notif_recipient_idx'),
+            # Read/unread lookups and counts per recipient
+            models.Index(fields=['recipient', 'is_read', '-last_activity_at'], name='forum_notif_recipient_read_idx'),
+            # Only the unread rows, which grouping and recounts look at; skipped
+            # on databases without partial indexes
+            models.Index(
+                fields=['recipient', '-created_at'],
+                condition=Q(is_read=False),
+                name='forum_notif_unread_idx',
+            ),
+        ]
+
+class NotificationStateManager(models.Manager):
+    def unread_count(self, user):
+        return self.filter(user=user).values_list('unread_count', flat=True).first() or 0
+    
+    async def aunread_count(self, user):
+        return await self.filter(user=user).values_list('unread_count', flat=True).afirst() or 0
+    
+    def read_before(self, user):
+        return self.filter(user=user).values_list('read_before', flat=True).first()
+    
+    async def aread_before(self, user):
+        return await self.filter(user=user).values_list('read_before', flat=True).afirst()
+    
+    def lock(self, user_ids):
+        """
+        Lock the users' rows, creating missing ones, until the transaction ends.
+        Outbox workers hold them while grouping, so two workers can't both
+        start the same group and the watermark can't move under a merge.
+        """
+        user_ids = sorted(user_ids)
+        self.bulk_create([NotificationState(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+        # Always in id order, so workers with overlapping recipients don't deadlock
+        list(self.select_for_update().filter(user_id__in=user_ids).order_by('user_id').values_list('user_id', flat=True))
+    
+    def add_unread(self, counts):
+        """Count newly created notifications, ``counts`` maps recipient ids to how many, whose rows lock() created"""
+        if not counts:
+            return
+        # Recipients with the same increment share one UPDATE
+        by_increment = defaultdict(list)
+        for user_id, count in counts.items():
+            by_increment[count].append(user_id)
+        for count, user_ids in by_increment.items():
+            self.filter(user_id__in=user_ids).update(unread_count=F('unread_count') + count)
+    
+    def discount(self, notification):
+        """Take an unread notification that was read or deleted off its recipient's counter"""
+        self.filter(user_id=notification.recipient_id, unread_count__gt=0).filter(
+            Q(read_before__isnull=True) | Q(read_before__lt=notification.created_at)
+        ).update(unread_count=F('unread_count') - 1)
+    
+    def discount_deleted(self, notifications):
+        """
+        discount() for every unread notification in the queryset, about to be
+        deleted together, with one UPDATE per distinct count
+        """
+        read = self.filter(user=OuterRef('recipient'), read_before__gte=OuterRef('created_at'))
+        unread = (
+            notifications.filter(is_read=False).exclude(Exists(read))
+            .order_by().values('recipient').annotate(total=Count('pk'))
+        )
+        by_total = defaultdict(list)
+        for row in unread:
+            by_total[row['total']].append(row['recipient'])
+        for total, user_ids in by_total.items():
+            self.filter(user_id__in=user_ids).update(unread_count=Greatest(F('unread_count') - total, 0))
+    
+    def mark_read(self, notification):
+        with transaction.atomic():
+            # The counter row before the notification, in the outbox workers' order
+            list(self.select_for_update().filter(user_id=notification.recipient_id).values_list('user_id', flat=True))
+            if Notification.objects.filter(pk=notification.pk, is_read=False).update(is_read=True):
+                self.discount(notification)
+        notification.is_read = True
+    
+    def mark_all_read(self, user):
+        """
+        Move the user's read watermark to now with a single-row UPDATE, however
+        many notifications they have. Only notifications stamped after the
+        watermark (created concurrently) stay unread.
+        """
+        now = timezone.now()
+        remaining = (
+            Notification.objects.filter(recipient=user, is_read=False, created_at__gt=now)
+            .order_by().values('recipient').annotate(total=Count('pk')).values('total')
+        )
+        updated = self.filter(user=user).update(
+            read_before=now, unread_count=Coalesce(Subquery(remaining), Value(0)),
+        )
+        if not updated:
+            self.get_or_create(user=user, defaults={'read_before': now})
+
+class NotificationState(models.Model):
+    """Per-user unread notification counter and read watermark"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='notification_state')
+    # Kept in step by NotificationStateManager, recount_notifications rebuilds it
+    unread_count = models.PositiveIntegerField(default=0)
+    # Notifications created at or before this count as read, whatever their is_read says
+    read_before = models.DateTimeField(null=True, blank=True)
+    
+    objects = NotificationStateManager()
+    
+    def __str__(self):
+        return f"{self.user.email}: {self.unread_count} unread"
+
+class OutboxEvent(models.Model):
+    """
+    Pending notification work, written in the same transaction as the change
+    that caused it and processed by ``forum.outbox.drain_outbox``
+    """
+    ANSWER_POSTED = 'answer_posted'
+    COMMENT_POSTED = 'comment_posted'
+    ANSWER_ACCEPTED = 'answer_accepted'
+    EVENT_TYPES = (
+        (ANSWER_POSTED, 'Answer posted'),
+        (COMMENT_POSTED, 'Comment posted'),
+        (ANSWER_ACCEPTED, 'Answer accepted'),
+    )
+    
+    event_type = models.CharField(max_length=30, choices=EVENT_TYPES)
+    # Ids of the rows the event is about, e.g. {"answer": 1}
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.event_type} {self.payload}"
+    
+    class Meta:
+        ordering = ['id']
+
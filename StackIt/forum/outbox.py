@@ -0,0 +1,277 @@
+"""
+Transactional outbox for notification fan-out.
+
+The post_save receivers only record an OutboxEvent with the ids involved,
+inside the transaction that saved the answer or comment, so the write path
+does no notification work. ``drain_outbox`` turns pending events into
+notifications in batches: the rows each batch needs are loaded with a few
+``IN`` queries, the notifications written with one ``bulk_create``, the
+recipients' unread counters bumped and the events deleted in the same
+transaction, so an event is handled once or, if the batch fails, left for
+the next attempt.
+
+Notifications of the same type on the same question are grouped: while the
+recipient hasn't read one, later activity updates it in place (latest
+sender, distinct actor count, "3 people answered your question") and moves
+its ``last_activity_at`` to the top of the feed instead of adding a row, so
+the unread counter only grows when a new row is written. ``created_at``
+stays put, since the read watermark is compared with it. Once a batch
+commits, its notifications are pushed to the recipients' event streams.
+Workers lock the events they take with ``SKIP LOCKED``, so several can drain
+side by side, and lock the recipients' NotificationState rows while
+grouping, so they take turns per recipient.
+
+Run ``python manage.py process_outbox`` as a worker. With
+``FORUM_OUTBOX_EAGER`` enabled, events are drained in-process after the
+transaction commits instead, which needs no worker (development, tests).
+"""
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .events import publish_to_user
+from .metrics import notifications_written
+from .mentions import parse_mentions, resolve_mentions
+from .models import Answer, Comment, Notification, NotificationState, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+
+# Message for one actor, and for a group of distinct actors
+MESSAGES = {
+    'answer': ("{sender} answered your question: '{title}'", "{count} people answered your question: '{title}'"),
+    'comment': ("{sender} commented on your answer to '{title}'", "{count} people commented on your answers to '{title}'"),
+    'mention': ("{sender} mentioned you in a comment on '{title}'", "{count} people mentioned you in comments on '{title}'"),
+    'accept': ("{sender} accepted your answer to '{title}'", "{count} people accepted your answers to '{title}'"),
+}
+
+
+def enqueue(event_type, **payload):
+    """Record an event in the current transaction"""
+    event = OutboxEvent.objects.create(event_type=event_type, payload=payload)
+    if getattr(settings, 'FORUM_OUTBOX_EAGER', False):
+        transaction.on_commit(drain_outbox)
+    return event
+
+
+def drain_outbox(batch_size=DEFAULT_BATCH_SIZE, max_batches=None):
+    """Process pending events batch by batch, returns the number processed"""
+    processed = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        count = process_batch(batch_size)
+        processed += count
+        batches += 1
+        # A short batch means the outbox was empty at that point
+        if count < batch_size:
+            break
+    return processed
+
+
+def process_batch(batch_size=DEFAULT_BATCH_SIZE):
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size]
+        )
+        if not events:
+            return 0
+        created, grouped = group_notifications(build_notifications(events))
+        created = Notification.objects.bulk_create(created, batch_size=batch_size)
+        Notification.objects.bulk_update(grouped, GROUPED_FIELDS, batch_size=batch_size)
+        NotificationState.objects.add_unread(Counter(notification.recipient_id for notification in created))
+        notifications = created + grouped
+        transaction.on_commit(lambda: publish_notifications(notifications))
+        OutboxEvent.objects.filter(id__in=[event.id for event in events]).delete()
+    for result, written in (('created', created), ('grouped', grouped)):
+        for notification_type, count in Counter(notification.notification_type for notification in written).items():
+            notifications_written.inc(count, type=notification_type, result=result)
+    return len(events)
+
+
+GROUPED_FIELDS = ['sender', 'answer', 'comment', 'message', 'actor_ids', 'actor_count', 'last_activity_at']
+
+
+def group_key(notification):
+    return notification.recipient_id, notification.notification_type, notification.question_id
+
+
+def group_notifications(notifications):
+    """
+    Collapse ``notifications`` by recipient, type and question, and merge them
+    into the matching unread notifications. Returns the unsaved notifications
+    and the updated existing ones.
+    """
+    groups = {}
+    for notification in notifications:
+        key = group_key(notification)
+        if key in groups:
+            merge_notification(groups[key], notification)
+        else:
+            notification.actor_ids = [notification.sender_id]
+            notification.message = notification_message(notification)
+            groups[key] = notification
+    if not groups:
+        return [], []
+
+    # Another worker grouping for the same recipients waits here, then sees what it wrote
+    NotificationState.objects.lock({key[0] for key in groups})
+    # Unread means not flagged and newer than the recipient's read watermark
+    read = NotificationState.objects.filter(user=OuterRef('recipient'), read_before__gte=OuterRef('created_at'))
+    # Only the notification rows: the joined question and user rows are what votes
+    # and view counts update, so they stay unlocked and unloaded
+    candidates = (
+        Notification.objects.select_for_update(of=('self',))
+        .filter(
+            recipient_id__in={key[0] for key in groups},
+            notification_type__in={key[1] for key in groups},
+            question_id__in={key[2] for key in groups},
+            is_read=False,
+        )
+        .exclude(Exists(read))
+        .order_by('last_activity_at')
+    )
+    # The newest one wins when older data has several for a key
+    unread = {group_key(notification): notification for notification in candidates}
+
+    created, grouped = [], []
+    now = timezone.now()
+    for key, notification in groups.items():
+        existing = unread.get(key)
+        if existing is None:
+            created.append(notification)
+        else:
+            # Same question, already loaded with the new notification
+            existing.question = notification.question
+            merge_notification(existing, notification)
+            existing.last_activity_at = now
+            grouped.append(existing)
+    return created, grouped
+
+
+def merge_notification(group, notification):
+    """Fold a newer ``notification`` into ``group``"""
+    group.sender = notification.sender
+    group.answer = notification.answer
+    group.comment = notification.comment
+    if notification.sender_id not in group.actor_ids:
+        group.actor_ids.append(notification.sender_id)
+    group.actor_count = len(group.actor_ids)
+    group.message = notification_message(group)
+
+
+def notification_message(notification):
+    single, grouped = MESSAGES[notification.notification_type]
+    template = grouped if notification.actor_count > 1 else single
+    return template.format(
+        sender=notification.sender.email, count=notification.actor_count, title=notification.question.title,
+    )
+
+
+def publish_notifications(notifications):
+    """Push new notifications to their recipients' open streams"""
+    from .serializers import NotificationSerializer
+
+    for notification in notifications:
+        publish_to_user(notification.recipient_id, {
+            'type': 'notification',
+            'notification': NotificationSerializer(notification).data,
+        })
+
+
+def build_notifications(events):
+    """Unsaved, ungrouped notifications for ``events``; rows deleted since the event was recorded are skipped"""
+    answer_ids = {
+        event.payload['answer'] for event in events
+        if event.event_type in (OutboxEvent.ANSWER_POSTED, OutboxEvent.ANSWER_ACCEPTED)
+    }
+    comment_ids = {
+        event.payload['comment'] for event in events if event.event_type == OutboxEvent.COMMENT_POSTED
+    }
+    answers = Answer.objects.select_related('author', 'question__author').in_bulk(answer_ids)
+    comments = Comment.objects.select_related('author', 'answer__author', 'answer__question').in_bulk(comment_ids)
+    # Mentions of every comment in the batch are resolved together
+    mentions = {comment.id: parse_mentions(comment.content) for comment in comments.values()}
+    users = resolve_mentions(handle for handles in mentions.values() for handle in handles)
+
+    notifications = []
+    for event in events:
+        if event.event_type == OutboxEvent.ANSWER_POSTED:
+            answer = answers.get(event.payload['answer'])
+            if answer is not None:
+                notifications.extend(answer_notifications(answer))
+        elif event.event_type == OutboxEvent.ANSWER_ACCEPTED:
+            answer = answers.get(event.payload['answer'])
+            if answer is not None:
+                notifications.extend(accept_notifications(answer))
+        elif event.event_type == OutboxEvent.COMMENT_POSTED:
+            comment = comments.get(event.payload['comment'])
+            if comment is not None:
+                notifications.extend(comment_notifications(comment))
+                mentioned = [users[handle] for handle in mentions[comment.id] if handle in users]
+                notifications.extend(mention_notifications(comment, mentioned))
+        else:
+            logger.warning("Dropping outbox event %s of unknown type %r", event.id, event.event_type)
+    return notifications
+
+
+def answer_notifications(answer):
+    """The question author hears about new answers, unless they wrote it"""
+    question = answer.question
+    if question.author_id == answer.author_id:
+        return []
+    return [Notification(
+        recipient=question.author,
+        sender=answer.author,
+        notification_type='answer',
+        question=question,
+        answer=answer,
+    )]
+
+
+def accept_notifications(answer):
+    """The answer author hears about their answer being accepted by someone else"""
+    question = answer.question
+    if question.author_id == answer.author_id:
+        return []
+    return [Notification(
+        recipient=answer.author,
+        sender=question.author,
+        notification_type='accept',
+        question=question,
+        answer=answer,
+    )]
+
+
+def comment_notifications(comment):
+    answer = comment.answer
+    if answer.author_id == comment.author_id:
+        return []
+    return [Notification(
+        recipient=answer.author,
+        sender=comment.author,
+        notification_type='comment',
+        question=answer.question,
+        answer=answer,
+        comment=comment,
+    )]
+
+
+def mention_notifications(comment, mentioned_users):
+    notifications = []
+    for mentioned_user in mentioned_users:
+        # Don't notify if the user is mentioning themselves
+        if mentioned_user.id != comment.author_id:
+            notifications.append(Notification(
+                recipient=mentioned_user,
+                sender=comment.author,
+                notification_type='mention',
+                question=comment.answer.question,
+                answer=comment.answer,
+                comment=comment,
+            ))
+    return notifications
@@ -0,0 +1,83 @@
+"""
+"Hot" ranking of the question feed.
+
+    hot = (1 + votes + 2 * answers + log10(1 + views)) / (age in hours + 2) ** gravity
+
+The score is stored in ``Question.hot_score`` behind a descending index, so
+``ordering=-hot`` reads the front page off the index instead of scoring every
+question per request. Votes rescore the question in the same UPDATE as
+its vote counters (Question.vote_updates); answers and flushed view counts
+refresh the questions involved right away. Decay is applied by running
+``python manage.py refresh_hot_scores`` periodically, which rescores the
+questions younger than ``FORUM_HOT_WINDOW_DAYS`` and zeroes older ones.
+Between sweeps scores are slightly stale, which only matters relative to
+questions that were rescored more recently.
+"""
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Question
+
+GRAVITY = 1.8
+ANSWER_WEIGHT = 2
+DEFAULT_BATCH_SIZE = 500
+
+
+def hot_window():
+    return timedelta(days=getattr(settings, 'FORUM_HOT_WINDOW_DAYS', 7))
+
+
+def hot_score(score, answer_count, views_count, created_at, now=None):
+    now = now or timezone.now()
+    age = now - created_at
+    if age > hot_window():
+        return 0.0
+    points = 1 + score + ANSWER_WEIGHT * answer_count + math.log10(1 + views_count)
+    hours = max(age.total_seconds(), 0) / 3600
+    return points / (hours + 2) ** GRAVITY
+
+
+def refresh_hot_scores(question_ids, now=None):
+    """Rescore the given questions with one read and batched writes, returns how many were updated"""
+    now = now or timezone.now()
+    rows = Question.objects.filter(id__in=question_ids).order_by().values_list(
+        'id', 'score', 'answer_count', 'views_count', 'created_at',
+    )
+    questions = [
+        Question(id=question_id, hot_score=hot_score(score, answers, views, created_at, now))
+        for question_id, score, answers, views, created_at in rows
+    ]
+    return Question.objects.bulk_update(questions, ['hot_score'], batch_size=DEFAULT_BATCH_SIZE)
+
+
+def count_answers(question_id, delta):
+    """Move a question's answer count by ``delta`` and rescore it in the same UPDATE, returns whether it exists"""
+    row = Question.objects.filter(pk=question_id).values('score', 'answer_count', 'views_count', 'created_at').first()
+    if row is None:
+        return False
+    # The count itself is relative, so concurrent answers can't lose one
+    return bool(Question.objects.filter(pk=question_id).update(
+        answer_count=F('answer_count') + delta,
+        hot_score=hot_score(row['score'], row['answer_count'] + delta, row['views_count'], row['created_at']),
+    ))
+
+
+def sweep_hot_scores(batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """Apply decay to every question in the window and zero the ones that left it"""
+    now = now or timezone.now()
+    cutoff = now - hot_window()
+    recent = Question.objects.filter(created_at__gte=cutoff).order_by('id').values_list('id', flat=True)
+    refreshed = 0
+    last_id = 0
+    while True:
+        ids = list(recent.filter(id__gt=last_id)[:batch_size])
+        if not ids:
+            break
+        refreshed += refresh_hot_scores(ids, now)
+        last_id = ids[-1]
+    expired = Question.objects.filter(created_at__lt=cutoff).exclude(hot_score=0).update(hot_score=0)
+    return refreshed + expired
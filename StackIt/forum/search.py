@@ -0,0 +1,184 @@
+"""
+Full-text search for questions.
+
+The backend is picked from the database vendor:
+
+- PostgreSQL: a weighted ``tsvector`` column (title A, tags B, description C)
+  with a GIN index, ranked with ``ts_rank`` and highlighted with ``ts_headline``.
+- SQLite: an FTS5 table keyed by question id, ranked with ``bm25``, for local
+  and test runs.
+- Anything else: the previous ``icontains`` matching, without ranking.
+
+Search data is refreshed from the Question post_save/post_delete and tag
+m2m_changed receivers. ``python manage.py rebuild_search_index`` rebuilds it
+for existing rows.
+"""
+import functools
+import re
+
+from django.db import connection
+from django.db.models import F, FloatField, Func, Q, TextField, Value
+from django.db.models.expressions import RawSQL
+from django.utils.html import strip_tags
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
+
+from .models import Question
+
+SEARCH_PARAM = 'search'
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_STOP = '</mark>'
+
+
+def question_document(question):
+    """Plain-text title, description and tag names of a question"""
+    tags = ' '.join(tag.name for tag in question.tags.all())
+    return question.title, strip_tags(question.description), tags
+
+
+class BaseSearchBackend:
+    def setup(self):
+        """Create the tables or indexes the backend needs"""
+
+    def index(self, question):
+        """Refresh the search data of one question"""
+
+    def remove(self, question_id):
+        """Drop the search data of a deleted question"""
+
+    def search(self, queryset, query):
+        """Filter to matches and annotate ``search_rank`` (higher is better) and ``search_snippet``"""
+        raise NotImplementedError
+
+
+class BasicSearchBackend(BaseSearchBackend):
+    def search(self, queryset, query):
+        condition = Q()
+        for term in query.split():
+            condition &= Q(title__icontains=term) | Q(description__icontains=term) | Q(tags__name__icontains=term)
+        matches = Question.objects.filter(condition).values('pk')
+        return queryset.filter(pk__in=matches).annotate(
+            search_rank=Value(0.0, output_field=FloatField()),
+            search_snippet=Value(None, output_field=TextField()),
+        )
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    config = 'english'
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS forum_question_search_vector_gin '
+                'ON forum_question USING gin (search_vector)'
+            )
+
+    def index(self, question):
+        from django.contrib.postgres.search import SearchVector
+
+        title, description, tags = question_document(question)
+        Question.objects.filter(pk=question.pk).update(
+            search_vector=(
+                SearchVector(Value(title), weight='A', config=self.config)
+                + SearchVector(Value(tags), weight='B', config=self.config)
+                + SearchVector(Value(description), weight='C', config=self.config)
+            )
+        )
+
+    def search(self, queryset, query):
+        from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+
+        search_query = SearchQuery(query, search_type='websearch', config=self.config)
+        plain_description = Func(
+            F('description'), Value('<[^>]*>'), Value(' '), Value('g'),
+            function='regexp_replace', output_field=TextField(),
+        )
+        return queryset.filter(search_vector=search_query).annotate(
+            search_rank=SearchRank(F('search_vector'), search_query),
+            search_snippet=SearchHeadline(
+                plain_description, search_query, config=self.config,
+                start_sel=HIGHLIGHT_START, stop_sel=HIGHLIGHT_STOP, max_words=35, min_words=15,
+            ),
+        )
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    table = 'forum_question_fts'
+    # bm25 weights for the title, description and tags columns
+    weights = '10.0, 2.0, 5.0'
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5(title, description, tags)'
+            )
+
+    def index(self, question):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [question.pk])
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, title, description, tags) VALUES (%s, %s, %s, %s)',
+                [question.pk, *question_document(question)],
+            )
+
+    def remove(self, question_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [question_id])
+
+    @staticmethod
+    def match_expression(query):
+        # Quote every word so user input can't use FTS5 query syntax
+        return ' '.join(f'"{term}"' for term in re.findall(r'\w+', query))
+
+    def search(self, queryset, query):
+        match = self.match_expression(query)
+        if not match:
+            return queryset.none()
+        question_id = f'{Question._meta.db_table}.{Question._meta.pk.column}'
+        matched = f'FROM {self.table} WHERE {self.table} MATCH %s AND rowid = {question_id}'
+        return queryset.filter(
+            pk__in=RawSQL(f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s', [match])
+        ).annotate(
+            # bm25 is lower for better matches
+            search_rank=RawSQL(f'SELECT -bm25({self.table}, {self.weights}) {matched}', [match]),
+            search_snippet=RawSQL(
+                f"SELECT snippet({self.table}, -1, %s, %s, '…', 24) {matched}",
+                [HIGHLIGHT_START, HIGHLIGHT_STOP, match],
+            ),
+        )
+
+
+def sqlite_has_fts5():
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+@functools.lru_cache(maxsize=None)
+def get_search_backend():
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    if connection.vendor == 'sqlite' and sqlite_has_fts5():
+        return SqliteSearchBackend()
+    return BasicSearchBackend()
+
+
+class QuestionSearchFilter(BaseFilterBackend):
+    """Full-text ``?search=`` filter backed by the database's search engine"""
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(SEARCH_PARAM, '').strip()
+        if not query:
+            return queryset
+        return get_search_backend().search(queryset, query)
+
+
+class RelevanceOrderingFilter(OrderingFilter):
+    """OrderingFilter that also accepts ``ordering=relevance`` (best match first) while searching"""
+
+    def get_ordering(self, request, queryset, view):
+        searching = 'search_rank' in queryset.query.annotations
+        params = request.query_params.get(self.ordering_param, '')
+        fields = [param.strip() for param in params.split(',') if param.strip()]
+        if searching and (not fields or fields[0] in ('relevance', '-relevance')):
+            return ['-search_rank', *view.ordering]
+        return super().get_ordering(request, queryset, view)
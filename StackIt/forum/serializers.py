@@ -1,19 +1,16 @@
 from rest_framework import serializers
-from .models import Question, Answer, Comment, Tag, Notification
+from .models import Question, Answer, Comment, Tag, Notification, Vote
+from .loaders import ANSWER_ORDERING
 from django.contrib.auth import get_user_model
 from django.db.models import Count
 
 User = get_user_model()
 
 class TagSerializer(serializers.ModelSerializer):
-    question_count = serializers.SerializerMethodField()
-
     class Meta:
         model = Tag
         fields = ['id', 'name', 'slug', 'description', 'question_count']
-
-    def get_question_count(self, obj):
-        return obj.questions.count()
+        read_only_fields = ['question_count']
 
 class UserMinimalSerializer(serializers.ModelSerializer):
     """Minimal user serializer for listing authors"""
@@ -21,6 +18,41 @@ class UserMinimalSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'email']
 
+class ViewerVoteMixin:
+    """
+    is_upvoted/is_downvoted from ``viewer_vote`` when a loader attached it.
+    
+    With ``personalize=False`` in the context both fields are left out, so the
+    response is the same for every user and can be shared from a cache; the
+    caller's votes then come from ``GET /api/forum/votes/mine/``.
+    """
+    personal_fields = ('is_upvoted', 'is_downvoted')
+    
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if not self.context.get('personalize', True):
+            for field in self.personal_fields:
+                data.pop(field, None)
+        return data
+    
+    def get_viewer_vote(self, obj):
+        if not self.context.get('personalize', True):
+            # Left out of the response anyway
+            return 0
+        if not hasattr(obj, 'viewer_vote'):
+            request = self.context.get('request')
+            vote = None
+            if request and request.user.is_authenticated:
+                vote = obj.votes.filter(user=request.user).values_list('value', flat=True).first()
+            obj.viewer_vote = vote or 0
+        return obj.viewer_vote
+    
+    def get_is_upvoted(self, obj):
+        return self.get_viewer_vote(obj) == Vote.UPVOTE
+        
+    def get_is_downvoted(self, obj):
+        return self.get_viewer_vote(obj) == Vote.DOWNVOTE
+
 class CommentSerializer(serializers.ModelSerializer):
     author = UserMinimalSerializer(read_only=True)
     # Remove author_id from required fields, we'll set it automatically from request
@@ -36,7 +68,7 @@ class CommentSerializer(serializers.ModelSerializer):
             validated_data['author'] = request.user
         return Comment.objects.create(**validated_data)
 
-class AnswerSerializer(serializers.ModelSerializer):
+class AnswerSerializer(ViewerVoteMixin, serializers.ModelSerializer):
     author = UserMinimalSerializer(read_only=True)
     # Remove author_id from required fields, we'll set it automatically from request
     question_id = serializers.PrimaryKeyRelatedField(
@@ -55,17 +87,6 @@ class AnswerSerializer(serializers.ModelSerializer):
         fields = ['id', 'content', 'author', 'question_id', 'vote_count', 'created_at', 
                   'updated_at', 'is_accepted', 'comments', 'is_upvoted', 'is_downvoted']
                   
-    def get_is_upvoted(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return obj.upvotes.filter(id=request.user.id).exists()
-        return False
-        
-    def get_is_downvoted(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return obj.downvotes.filter(id=request.user.id).exists()
-        return False
         
     def create(self, validated_data):
         # Set author from the request context
@@ -81,17 +102,24 @@ class QuestionListSerializer(serializers.ModelSerializer):
     answer_count = serializers.IntegerField(read_only=True)
     vote_count = serializers.IntegerField(read_only=True)
     is_answered = serializers.SerializerMethodField()
+    snippet = serializers.SerializerMethodField()
     
     class Meta:
         model = Question
         fields = ['id', 'title', 'author', 'tags', 'created_at', 
-                  'updated_at', 'vote_count', 'answer_count', 'is_answered']
+                  'updated_at', 'vote_count', 'answer_count', 'is_answered', 'snippet']
                   
     def get_is_answered(self, obj):
         """Check if the question has an accepted answer"""
+        if hasattr(obj, 'is_answered'):
+            return obj.is_answered
         return obj.answers.filter(is_accepted=True).exists()
+        
+    def get_snippet(self, obj):
+        """Highlighted match from the description, only set when searching"""
+        return getattr(obj, 'search_snippet', None)
 
-class QuestionDetailSerializer(serializers.ModelSerializer):
+class QuestionDetailSerializer(ViewerVoteMixin, serializers.ModelSerializer):
     """Serializer for detailed question view"""
     author = UserMinimalSerializer(read_only=True)
     # Remove author_id from required fields, we'll set it automatically from request
@@ -111,25 +139,18 @@ class QuestionDetailSerializer(serializers.ModelSerializer):
         model = Question
         fields = ['id', 'title', 'description', 'author', 'tags', 'tag_ids',
                   'created_at', 'updated_at', 'vote_count', 'answers', 
-                  'views_count', 'is_upvoted', 'is_downvoted']
+                  'views_count', 'unique_viewers', 'is_upvoted', 'is_downvoted']
+        read_only_fields = ['unique_viewers']
         
     def get_answers(self, obj):
         """Get answers sorted by accepted status and votes"""
-        answers = obj.answers.all().order_by('-is_accepted', '-created_at')
-        request = self.context.get('request')
-        return AnswerSerializer(answers, many=True, context={'request': request}).data
+        if 'answers' in getattr(obj, '_prefetched_objects_cache', {}):
+            # Already loaded and ordered by forum.loaders
+            answers = obj.answers.all()
+        else:
+            answers = obj.answers.all().order_by(*ANSWER_ORDERING)
+        return AnswerSerializer(answers, many=True, context=self.context).data
         
-    def get_is_upvoted(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return obj.upvotes.filter(id=request.user.id).exists()
-        return False
-        
-    def get_is_downvoted(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return obj.downvotes.filter(id=request.user.id).exists()
-        return False
         
     def create(self, validated_data):
         tags = validated_data.pop('tags', [])
@@ -153,11 +174,44 @@ class QuestionDetailSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
+class VoteSerializer(serializers.Serializer):
+    """Input for setting the current user's vote"""
+    value = serializers.ChoiceField(choices=[Vote.UPVOTE, 0, Vote.DOWNVOTE])
+
+class IdListField(serializers.CharField):
+    """Comma-separated ids, e.g. ``?questions=1,2,3``"""
+    
+    def to_internal_value(self, data):
+        data = super().to_internal_value(data)
+        try:
+            return sorted({int(part) for part in data.split(',') if part.strip()})
+        except ValueError:
+            raise serializers.ValidationError('Expected a comma-separated list of ids.')
+
+class VoteStateQuerySerializer(serializers.Serializer):
+    """Query parameters of the bulk vote state endpoint"""
+    MAX_IDS = 500
+    
+    questions = IdListField(required=False, allow_blank=True)
+    answers = IdListField(required=False, allow_blank=True)
+    
+    def validate(self, attrs):
+        if len(attrs.get('questions', [])) + len(attrs.get('answers', [])) > self.MAX_IDS:
+            raise serializers.ValidationError(f'At most {self.MAX_IDS} ids can be requested at once.')
+        return attrs
+
 class NotificationSerializer(serializers.ModelSerializer):
     sender = UserMinimalSerializer(read_only=True)
+    is_read = serializers.SerializerMethodField()
     
     class Meta:
         model = Notification
-        fields = ['id', 'notification_type', 'sender', 'message', 
-                  'is_read', 'created_at', 'question', 'answer']
-        read_only_fields = ['notification_type', 'sender', 'message', 'created_at', 'question', 'answer']
+        fields = ['id', 'notification_type', 'sender', 'message', 'actor_count',
+                  'is_read', 'created_at', 'last_activity_at', 'question', 'answer']
+        read_only_fields = ['notification_type', 'sender', 'message', 'actor_count', 'created_at', 'last_activity_at',
+                            'question', 'answer']
+    
+    def get_is_read(self, obj):
+        # Everything up to the read watermark counts as read
+        read_before = self.context.get('read_before')
+        return obj.is_read or (read_before is not None and obj.created_at <= read_before)
@@ -1,88 +1,195 @@
-from django.db.models.signals import post_save, m2m_changed
+from django.db.models import F, QuerySet
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
-from .models import Answer, Comment, Question, Notification
-import re
+from django.utils import timezone
+from .models import Answer, Comment, Notification, NotificationState, OutboxEvent, Question, Tag, Vote, vote_changed
+from .cache import QUESTION_LIST_VERSION_KEY, bump_version_on_commit, invalidate_question, tag_catalogue
+from .metrics import posts_written, votes_cast
+from .outbox import enqueue
+from .ranking import count_answers
+from .search import get_search_backend
+
+def deleted_with(origin, *models):
+    """Whether a delete started from ``models`` rows, e.g. answers going with their question"""
+    if isinstance(origin, QuerySet):
+        return issubclass(origin.model, models)
+    return isinstance(origin, models)
 
 @receiver(post_save, sender=Answer)
 def create_answer_notification(sender, instance, created, **kwargs):
-    """Create notification when a new answer is posted"""
+    """Queue the notification for a new answer"""
     if created:
-        # Notify question author
-        question = instance.question
-        author = question.author
-        
-        # Don't notify if the question author is the one answering
-        if author != instance.author:
-            Notification.objects.create(
-                recipient=author,
-                sender=instance.author,
-                notification_type='answer',
-                question=question,
-                answer=instance,
-                message=f"{instance.author.email} answered your question: '{question.title}'"
-            )
+        enqueue(OutboxEvent.ANSWER_POSTED, answer=instance.id)
 
 @receiver(post_save, sender=Comment)
 def create_comment_notification(sender, instance, created, **kwargs):
-    """Create notification when a new comment is posted"""
-    if created:
-        answer = instance.answer
-        answer_author = answer.author
-        
-        # Don't notify if the answer author is the one commenting
-        if answer_author != instance.author:
-            Notification.objects.create(
-                recipient=answer_author,
-                sender=instance.author,
-                notification_type='comment',
-                question=answer.question,
-                answer=answer,
-                comment=instance,
-                message=f"{instance.author.email} commented on your answer to '{answer.question.title}'"
-            )
-
-@receiver(post_save, sender=Comment)
-def create_mention_notification(sender, instance, created, **kwargs):
-    """Create notification when a user is mentioned in a comment"""
+    """Queue the comment and mention notifications for a new comment"""
     if created:
-        # Find mentions using regex (@username)
-        mentions = re.findall(r'@(\w+)', instance.content)
-        from django.contrib.auth import get_user_model
-        User = get_user_model()
-        
-        for mention in mentions:
-            # Try to find mentioned user by username/email
-            try:
-                mentioned_user = User.objects.get(email__iexact=mention)
-                # Don't notify if the user is mentioning themselves
-                if mentioned_user != instance.author:
-                    Notification.objects.create(
-                        recipient=mentioned_user,
-                        sender=instance.author,
-                        notification_type='mention',
-                        question=instance.answer.question,
-                        answer=instance.answer,
-                        comment=instance,
-                        message=f"{instance.author.email} mentioned you in a comment on '{instance.answer.question.title}'"
-                    )
-            except User.DoesNotExist:
-                pass
+        enqueue(OutboxEvent.COMMENT_POSTED, comment=instance.id)
 
 @receiver(post_save, sender=Answer)
 def create_accept_notification(sender, instance, **kwargs):
-    """Create notification when an answer is accepted"""
+    """Queue the notification for an accepted answer"""
     if instance.is_accepted:
-        # Notify answer author
-        answer_author = instance.author
-        question_author = instance.question.author
-        
-        # Don't notify if the question author is also the answer author
-        if answer_author != question_author:
-            Notification.objects.create(
-                recipient=answer_author,
-                sender=question_author,
-                notification_type='accept',
-                question=instance.question,
-                answer=instance,
-                message=f"{question_author.email} accepted your answer to '{instance.question.title}'"
-            )
+        enqueue(OutboxEvent.ANSWER_ACCEPTED, answer=instance.id)
+
+@receiver(post_save, sender=Answer)
+def count_new_answer(sender, instance, created, **kwargs):
+    """Keep Question.answer_count and the question's hot score up to date"""
+    if created:
+        count_answers(instance.question_id, 1)
+
+@receiver(post_delete, sender=Answer)
+def count_deleted_answer(sender, instance, origin=None, **kwargs):
+    # Nothing is left to update when the answer goes with its question
+    if deleted_with(origin, Question):
+        return
+    count_answers(instance.question_id, -1)
+
+@receiver(post_delete, sender=Notification)
+def discount_deleted_notification(sender, instance, origin=None, **kwargs):
+    """Deleting an unread notification, e.g. with its answer, takes it off the unread counter"""
+    if not instance.is_read and not deleted_with(origin, Question):
+        NotificationState.objects.discount(instance)
+
+@receiver(pre_delete, sender=Question)
+def discount_question_notifications(sender, instance, **kwargs):
+    """A deleted question's notifications come off the counters together rather than one by one"""
+    NotificationState.objects.discount_deleted(Notification.objects.filter(question=instance))
+
+@receiver(m2m_changed, sender=Question.tags.through)
+def update_tag_question_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep Tag.question_count in step with the question/tag links"""
+    if action == 'post_add' and pk_set:
+        # pk_set only holds the links that were actually added
+        delta = len(pk_set) if reverse else 1
+        tags = Tag.objects.filter(pk=instance.pk) if reverse else Tag.objects.filter(pk__in=pk_set)
+        tags.update(question_count=F('question_count') + delta)
+    elif action == 'post_remove' and pk_set:
+        # pk_set holds whatever was asked for, linked or not, so count what is left
+        tags = Tag.objects.filter(pk=instance.pk) if reverse else Tag.objects.filter(pk__in=pk_set)
+        tags.recount_questions()
+    elif action == 'pre_clear':
+        if reverse:
+            Tag.objects.filter(pk=instance.pk).update(question_count=0)
+        else:
+            Tag.objects.filter(questions=instance).update(question_count=F('question_count') - 1)
+    else:
+        return
+    tag_catalogue.invalidate()
+
+@receiver(m2m_changed, sender=Question.tags.through)
+def touch_retagged_questions(sender, instance, action, reverse, pk_set, **kwargs):
+    """Retagging is an edit: it moves updated_at, and with it the question page's ETag"""
+    if action in ('post_add', 'post_remove') and pk_set:
+        question_ids = pk_set if reverse else [instance.pk]
+        questions = Question.objects.filter(pk__in=question_ids)
+    elif action == 'post_clear' and not reverse:
+        questions = Question.objects.filter(pk=instance.pk)
+    elif action == 'pre_clear' and reverse:
+        # Afterwards there is no telling which questions had the tag
+        questions = Question.objects.filter(tags=instance)
+    else:
+        return
+    now = timezone.now()
+    questions.update(updated_at=now)
+    if not reverse:
+        instance.updated_at = now
+
+@receiver(pre_delete, sender=Tag)
+def touch_untagged_questions(sender, instance, **kwargs):
+    """Deleting a tag drops its links without m2m_changed"""
+    Question.objects.filter(tags=instance).update(updated_at=timezone.now())
+
+@receiver(pre_delete, sender=Question)
+def release_question_tags(sender, instance, **kwargs):
+    """Deleting a question drops its tag links without m2m_changed"""
+    if Tag.objects.filter(questions=instance).update(question_count=F('question_count') - 1):
+        tag_catalogue.invalidate()
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_tag_catalogue(sender, **kwargs):
+    tag_catalogue.invalidate()
+    # Question lists show tag names
+    bump_version_on_commit(QUESTION_LIST_VERSION_KEY)
+
+@receiver(post_save, sender=Question)
+def index_question(sender, instance, **kwargs):
+    """Refresh the question's full-text search data"""
+    get_search_backend().index(instance)
+
+@receiver(m2m_changed, sender=Question.tags.through)
+def index_question_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    """Tag names are part of the search document"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # Tag-side changes; pk_set holds question ids (None after a clear)
+        for question in Question.objects.filter(pk__in=pk_set or []):
+            get_search_backend().index(question)
+    else:
+        get_search_backend().index(instance)
+
+@receiver(post_delete, sender=Question)
+def remove_question_from_index(sender, instance, **kwargs):
+    get_search_backend().remove(instance.pk)
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def invalidate_question_responses(sender, instance, **kwargs):
+    invalidate_question(instance.pk)
+
+@receiver(m2m_changed, sender=Question.tags.through)
+def invalidate_question_tag_responses(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_question(instance.pk)
+    else:
+        for question_id in pk_set or []:
+            invalidate_question(question_id)
+        # A tag-side clear doesn't say which questions lost the tag
+        bump_version_on_commit(QUESTION_LIST_VERSION_KEY)
+
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+def invalidate_answer_responses(sender, instance, origin=None, **kwargs):
+    # Answer counts and accepted state show up in the lists as well
+    if not deleted_with(origin, Question):
+        invalidate_question(instance.question_id)
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_responses(sender, instance, origin=None, **kwargs):
+    # The receivers of a deleted answer or question cover their comments
+    if deleted_with(origin, Question, Answer):
+        return
+    question_id = Answer.objects.filter(pk=instance.answer_id).values_list('question_id', flat=True).first()
+    if question_id is not None:
+        invalidate_question(question_id)
+
+@receiver(vote_changed)
+def invalidate_vote_responses(sender, target_id, **kwargs):
+    if sender is Question:
+        invalidate_question(target_id)
+        return
+    question_id = Answer.objects.filter(pk=target_id).values_list('question_id', flat=True).first()
+    if question_id is not None:
+        invalidate_question(question_id)
+
+@receiver(post_save, sender=Question)
+@receiver(post_save, sender=Answer)
+@receiver(post_save, sender=Comment)
+def count_post_write(sender, instance, created, **kwargs):
+    posts_written.inc(type=sender._meta.model_name, action='created' if created else 'updated')
+
+@receiver(post_delete, sender=Question)
+@receiver(post_delete, sender=Answer)
+@receiver(post_delete, sender=Comment)
+def count_post_delete(sender, instance, **kwargs):
+    posts_written.inc(type=sender._meta.model_name, action='deleted')
+
+@receiver(vote_changed)
+def count_vote(sender, value, **kwargs):
+    votes_cast.inc(target=sender._meta.model_name, value={Vote.UPVOTE: 'up', Vote.DOWNVOTE: 'down'}.get(value, 'withdrawn'))
@@ -0,0 +1,277 @@
+"""
+Query budgets for every API route.
+
+``BUDGETS`` holds the most queries each route may run, for an anonymous
+and a signed-in client (JWT, so the user lookup is counted). Requests run
+against a question with realistic fan-out: many tags, answers, comments
+and votes, so a serializer that starts querying per row blows its budget.
+A failing budget lists the query templates that ran more than once, which
+is where an N+1 shows up.
+
+Adding a route to forum/urls.py or account/urls.py without a budget fails
+``test_every_route_has_a_budget``.
+"""
+import re
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, get_resolver, reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from account.models import UserType
+
+from .cache import tag_catalogue
+from .models import Answer, Comment, Notification, Question, Tag, Vote
+from .view_counter import view_counter
+
+User = get_user_model()
+
+# (route name, method): (anonymous, authenticated) query budget
+BUDGETS = {
+    ('api-root', 'GET'): (0, 1),
+    ('question-list', 'GET'): (3, 4),
+    ('question-list', 'POST'): (0, 17),
+    ('question-detail', 'GET'): (4, 6),
+    ('question-detail', 'PUT'): (0, 20),
+    ('question-detail', 'PATCH'): (0, 20),
+    # Deletes also clear the legacy upvotes/downvotes links until those fields go
+    ('question-detail', 'DELETE'): (0, 24),
+    ('question-vote', 'PUT'): (0, 6),
+    ('question-upvote', 'POST'): (0, 6),
+    ('question-downvote', 'POST'): (0, 6),
+    ('answer-list', 'GET'): (4, 6),
+    ('answer-list', 'POST'): (0, 11),
+    ('answer-detail', 'GET'): (2, 4),
+    ('answer-detail', 'PUT'): (0, 7),
+    ('answer-detail', 'PATCH'): (0, 7),
+    ('answer-detail', 'DELETE'): (0, 13),
+    ('answer-accept', 'POST'): (0, 10),
+    ('answer-vote', 'PUT'): (0, 7),
+    ('answer-upvote', 'POST'): (0, 7),
+    ('answer-downvote', 'POST'): (0, 7),
+    ('direct-answer-list', 'GET'): (3, 5),
+    ('direct-answer-list', 'POST'): (0, 11),
+    ('direct-answer-detail', 'GET'): (2, 4),
+    ('direct-answer-detail', 'PUT'): (0, 7),
+    ('direct-answer-detail', 'PATCH'): (0, 7),
+    ('direct-answer-detail', 'DELETE'): (0, 13),
+    ('direct-answer-accept', 'POST'): (0, 10),
+    ('direct-answer-vote', 'PUT'): (0, 7),
+    ('direct-answer-upvote', 'POST'): (0, 7),
+    ('direct-answer-downvote', 'POST'): (0, 7),
+    ('comment-list', 'GET'): (3, 4),
+    ('comment-list', 'POST'): (0, 7),
+    ('comment-detail', 'GET'): (1, 2),
+    ('comment-detail', 'PUT'): (0, 4),
+    ('comment-detail', 'PATCH'): (0, 4),
+    ('comment-detail', 'DELETE'): (0, 5),
+    ('tag-list', 'GET'): (1, 2),
+    ('tag-list', 'POST'): (0, 1),
+    ('tag-detail', 'GET'): (1, 2),
+    ('tag-detail', 'PUT'): (0, 1),
+    ('tag-detail', 'PATCH'): (0, 1),
+    ('tag-detail', 'DELETE'): (0, 1),
+    ('vote-mine', 'GET'): (0, 1),
+    ('notification-list', 'GET'): (0, 5),
+    ('notification-detail', 'GET'): (0, 3),
+    ('notification-mark-as-read', 'POST'): (0, 7),
+    ('notification-mark-all-as-read', 'POST'): (0, 6),
+    ('notification-unread-count', 'GET'): (0, 2),
+    ('account-register', 'POST'): (8, 9),
+    ('account-login', 'POST'): (3, 4),
+    ('account-logout', 'POST'): (0, 1),
+    ('account-forgot-password', 'POST'): (0, 1),
+    ('account-profile', 'GET'): (0, 3),
+    ('account-profile', 'PUT'): (0, 4),
+    ('metrics', 'GET'): (0, 1),
+}
+
+# Routes measured elsewhere
+UNBUDGETED = {
+    # Long-lived server-sent events stream, see NotificationStreamTests
+    'notification-stream',
+}
+
+ANSWERS = 15
+COMMENTS_PER_ANSWER = 4
+TAGS = 8
+
+
+def query_template(sql):
+    """``sql`` with its literals replaced, so repeated queries group together"""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return re.sub(r'\((?:\?, )+\?\)', '(...)', sql)
+
+
+def duplicated_templates(queries):
+    counts = Counter(query_template(query['sql']) for query in queries)
+    return [(count, template) for template, count in counts.most_common() if count > 1]
+
+
+def routes(patterns=None, prefix=''):
+    """Names of the API routes with the HTTP methods each accepts"""
+    if patterns is None:
+        patterns = get_resolver().url_patterns
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            if str(pattern.pattern).startswith('api/'):
+                yield from routes(pattern.url_patterns, prefix + str(pattern.pattern))
+            continue
+        view = pattern.callback
+        actions = getattr(view, 'actions', None)
+        if actions is not None:
+            methods = {method.upper() for method in actions}
+        elif hasattr(view, 'view_class'):
+            methods = {
+                method.upper() for method in view.view_class.http_method_names
+                if method not in ('options', 'head') and hasattr(view.view_class, method)
+            }
+        else:
+            methods = {'GET'}
+        yield pattern.name, methods
+
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        UserType.objects.create(name='User')
+        cls.owner = User.objects.create_user(email='owner@example.com', password='password123')
+        others = User.objects.bulk_create([User(email=f'member{i}@example.com') for i in range(ANSWERS)])
+        tags = Tag.objects.bulk_create([Tag(name=f'topic-{i}', slug=f'topic-{i}') for i in range(TAGS)])
+        cls.tag = tags[0]
+        questions = [
+            Question.objects.create(title=f'Budget {i}', description='Description', author=cls.owner)
+            for i in range(3)
+        ]
+        cls.question = questions[0]
+        for question in questions:
+            question.tags.set(tags)
+        answers = [
+            Answer.objects.create(question=question, author=author, content='Answer')
+            for question in questions for author in others
+        ]
+        cls.answer = Answer.objects.create(question=cls.question, author=cls.owner, content='Own answer')
+        Comment.objects.bulk_create([
+            Comment(answer=answer, author=others[i], content='Comment')
+            for answer in answers + [cls.answer] for i in range(COMMENTS_PER_ANSWER)
+        ])
+        cls.comment = Comment.objects.create(answer=cls.answer, author=cls.owner, content='Own comment')
+        for voter in others:
+            Vote.objects.set_vote(voter, cls.question, Vote.UPVOTE)
+            Vote.objects.set_vote(voter, cls.answer, Vote.UPVOTE)
+        for answer in answers[:ANSWERS]:
+            Vote.objects.set_vote(cls.owner, answer, Vote.DOWNVOTE)
+        cls.notification = Notification.objects.bulk_create([
+            Notification(recipient=cls.owner, sender=author, notification_type='answer',
+                         question=cls.question, message='Answered')
+            for author in others
+        ])[0]
+        cls.token = str(RefreshToken.for_user(cls.owner).access_token)
+
+    def setUp(self):
+        view_counter.flush()
+        cache.clear()
+        tag_catalogue.invalidate()
+
+    def request_for(self, name, method):
+        """URL and body of a representative ``method`` request to route ``name``"""
+        question, answer = self.question.id, self.answer.id
+        kwargs = {
+            'question-detail': {'id': question},
+            'question-vote': {'id': question},
+            'question-upvote': {'id': question},
+            'question-downvote': {'id': question},
+            'answer-list': {'question_id': question},
+            'comment-list': {'question_id': question, 'answer_pk': answer},
+            'comment-detail': {'question_id': question, 'answer_pk': answer, 'pk': self.comment.id},
+            'tag-detail': {'pk': self.tag.id},
+            'notification-detail': {'pk': self.notification.id},
+            'notification-mark-as-read': {'pk': self.notification.id},
+        }.get(name)
+        if kwargs is None and name.startswith('answer-'):
+            kwargs = {'question_id': question, 'pk': answer}
+        elif kwargs is None and name.startswith('direct-answer-') and name != 'direct-answer-list':
+            kwargs = {'pk': answer}
+        url = reverse(name, kwargs=kwargs)
+        if name.endswith('-list') and method == 'GET':
+            url += '?page_size=10'
+
+        body = {
+            'question-list': {'title': 'New question', 'description': 'Description', 'tag_ids': [self.tag.id]},
+            'question-detail': {'title': 'Edited', 'description': 'Edited', 'tag_ids': [self.tag.id]},
+            'question-vote': {'value': -1},
+            'answer-list': {'content': 'New answer'},
+            'answer-detail': {'content': 'Edited answer'},
+            'answer-vote': {'value': -1},
+            'direct-answer-list': {'content': 'New answer', 'question_id': question},
+            'direct-answer-detail': {'content': 'Edited answer'},
+            'direct-answer-vote': {'value': -1},
+            'comment-list': {'content': 'New comment'},
+            'comment-detail': {'content': 'Edited comment'},
+            'tag-list': {'name': 'brand-new'},
+            'tag-detail': {'name': 'renamed'},
+            'account-register': {'email': 'fresh@example.com', 'password': 'password123', 'user_type': 'User'},
+            'account-login': {'email': 'owner@example.com', 'password': 'password123'},
+            'account-forgot-password': {'email': 'owner@example.com'},
+            'account-profile': {'bio': 'Hello'},
+        }.get(name, {})
+        return url, body
+
+    def measure(self, name, method, authenticated):
+        client = APIClient()
+        if authenticated:
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        url, body = self.request_for(name, method)
+        # Every request sees the same data
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(client, method.lower())(url, body, format='json')
+            transaction.set_rollback(True)
+        return response, list(queries)
+
+    def assertWithinBudgets(self, authenticated):
+        for (name, method), budgets in BUDGETS.items():
+            budget = budgets[1 if authenticated else 0]
+            with self.subTest(route=name, method=method):
+                response, queries = self.measure(name, method, authenticated)
+                self.assertLess(response.status_code, 500, f'{method} {name} failed')
+                if len(queries) <= budget:
+                    continue
+                duplicated = '\n'.join(f'  {count}x {template}' for count, template in duplicated_templates(queries))
+                self.fail(
+                    f'{method} {name} ran {len(queries)} queries, budget {budget}\n'
+                    f'Repeated query templates:\n{duplicated or "  (none)"}\n'
+                    'All queries:\n' + '\n'.join(f'  {query["sql"]}' for query in queries)
+                )
+
+    def test_anonymous_budgets(self):
+        self.assertWithinBudgets(authenticated=False)
+
+    def test_authenticated_budgets(self):
+        self.assertWithinBudgets(authenticated=True)
+
+    def test_every_route_has_a_budget(self):
+        missing = [
+            f'{method} {name}'
+            for name, methods in routes() if name not in UNBUDGETED
+            for method in sorted(methods) if (name, method) not in BUDGETS
+        ]
+        self.assertFalse(missing, 'Routes without a query budget')
+
+    def test_failures_name_repeated_queries(self):
+        queries = [
+            {'sql': 'SELECT "forum_tag"."name" FROM "forum_tag" WHERE "forum_tag"."id" = 1'},
+            {'sql': 'SELECT "forum_tag"."name" FROM "forum_tag" WHERE "forum_tag"."id" = 2'},
+            {'sql': "SELECT 1 FROM \"account_user\" WHERE \"email\" = 'a@example.com'"},
+        ]
+        self.assertEqual(
+            duplicated_templates(queries),
+            [(2, 'SELECT "forum_tag"."name" FROM "forum_tag" WHERE "forum_tag"."id" = ?')],
+        )
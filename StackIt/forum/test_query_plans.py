@@ -0,0 +1,155 @@
+"""
+Query plan checks for the forum's hot read paths.
+
+Each test loads a realistic amount of data, runs ANALYZE, then EXPLAINs the
+main query of an endpoint (captured from a real request) or of a lookup the
+background jobs depend on, and fails when the plan reads a whole table or
+sorts rows instead of walking an index. SQLite and PostgreSQL plans are
+both understood, so the checks hold on the test database and in CI against
+Postgres.
+"""
+import re
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from .models import Answer, Comment, Notification, Question, Tag
+from .view_counter import view_counter
+
+User = get_user_model()
+
+# Table scans and sorts, per vendor
+BAD_PLAN_PATTERNS = {
+    'sqlite': re.compile(r'^SCAN (?!.*\bUSING\b)|USE TEMP B-TREE'),
+    'postgresql': re.compile(r'\bSeq Scan\b|\bSort\b'),
+}
+
+
+def outer_table(sql):
+    """Table in the outermost FROM clause of ``sql``"""
+    depth = 0
+    for index, char in enumerate(sql):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and sql.startswith(' FROM ', index):
+            match = re.match(r' FROM "?(\w+)"?', sql[index:])
+            return match.group(1) if match else None
+    return None
+
+
+def explain(sql, params=()):
+    """Plan lines of ``sql``"""
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [str(row[-1]) for row in cursor.fetchall()]
+
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class QueryPlanTests(TestCase):
+    USERS = 30
+    QUESTIONS = 3000
+    ANSWERS = 3000
+    COMMENTS = 2000
+    NOTIFICATIONS = 4000
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create([User(email=f'planner{i}@example.com') for i in range(cls.USERS)])
+        cls.user = users[0]
+        questions = Question.objects.bulk_create([
+            Question(title=f'Question {i}', description='Description', author=users[i % cls.USERS], hot_score=i % 97)
+            for i in range(cls.QUESTIONS)
+        ])
+        cls.question = questions[0]
+        # A tenth of the answers are on the question the tests read
+        answers = Answer.objects.bulk_create([
+            Answer(question=questions[0 if i % 10 == 0 else i % cls.QUESTIONS], author=users[i % cls.USERS],
+                   content='Answer', is_accepted=i == 0, score=i % 7)
+            for i in range(cls.ANSWERS)
+        ])
+        cls.answer = answers[0]
+        Comment.objects.bulk_create([
+            Comment(answer=answers[0 if i % 10 == 0 else i % cls.ANSWERS], author=users[i % cls.USERS], content='Comment')
+            for i in range(cls.COMMENTS)
+        ])
+        # A quarter of the notifications go to the user the tests read as
+        Notification.objects.bulk_create([
+            Notification(recipient=users[0 if i % 4 == 0 else i % cls.USERS], sender=users[1],
+                         notification_type='answer', question=questions[i % cls.QUESTIONS],
+                         message='Message', is_read=i % 3 == 0)
+            for i in range(cls.NOTIFICATIONS)
+        ])
+        tags = Tag.objects.bulk_create([Tag(name=f'tag-{i}', slug=f'tag-{i}') for i in range(20)])
+        cls.tag = tags[0]
+        Question.tags.through.objects.bulk_create([
+            Question.tags.through(question=question, tag=tags[i % len(tags)]) for i, question in enumerate(questions)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        view_counter.flush()
+        cache.clear()
+        self.client = APIClient()
+
+    def assertIndexedPlan(self, sql, params=()):
+        plan = explain(sql, params)
+        pattern = BAD_PLAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            self.skipTest(f'No plan checks for {connection.vendor}')
+        bad = [line for line in plan if pattern.search(line.strip())]
+        self.assertFalse(bad, 'Scan or sort in the plan of:\n{}\n\n{}'.format(sql, '\n'.join(plan)))
+
+    def assertEndpointUsesIndexes(self, url, table, user=None):
+        """Every query ``url`` runs against ``table`` walks an index"""
+        if user is not None:
+            self.client.force_authenticate(user=user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        checked = [query['sql'] for query in queries if outer_table(query['sql']) == table]
+        self.assertTrue(checked, f'{url} ran no query against {table}')
+        for sql in checked:
+            self.assertIndexedPlan(sql)
+
+    def assertQuerysetUsesIndexes(self, queryset):
+        self.assertIndexedPlan(*queryset.query.sql_with_params())
+
+    def test_question_feed(self):
+        self.assertEndpointUsesIndexes('/api/forum/questions/?count=false', 'forum_question')
+
+    def test_hot_question_feed(self):
+        self.assertEndpointUsesIndexes('/api/forum/questions/?ordering=-hot&count=false', 'forum_question')
+
+    def test_answers_of_a_question(self):
+        self.assertEndpointUsesIndexes(
+            f'/api/forum/questions/{self.question.id}/answers/?count=false', 'forum_answer',
+        )
+
+    def test_comments_of_an_answer(self):
+        self.assertEndpointUsesIndexes(
+            f'/api/forum/questions/{self.question.id}/answers/{self.answer.id}/comments/', 'forum_comment',
+        )
+
+    def test_notification_feed(self):
+        self.assertEndpointUsesIndexes('/api/forum/notifications/?count=false', 'forum_notification', user=self.user)
+
+    def test_unread_notifications(self):
+        self.assertQuerysetUsesIndexes(
+            Notification.objects.filter(recipient=self.user, is_read=False).order_by('-last_activity_at')[:20]
+        )
+        self.assertQuerysetUsesIndexes(
+            Notification.objects.filter(recipient=self.user, is_read=True).order_by('-last_activity_at')[:20]
+        )
+
+    def test_questions_of_a_tag(self):
+        self.assertQuerysetUsesIndexes(
+            Question.tags.through.objects.filter(tag=self.tag).values_list('question_id', flat=True)
+        )
@@ -1,9 +1,43 @@
-from django.test import TestCase
-from django.urls import reverse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import DatabaseError, close_old_connections, connection
+from django.db.models import Count, F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from django.utils.http import http_date
 from rest_framework import status
 from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import get_user_model
-from .models import Question, Answer, Comment, Tag, Notification
+from .models import (
+    Question, Answer, Comment, Tag, Notification, NotificationState, OutboxEvent, Vote, QuestionViewerSketch
+)
+from .view_counter import flush_after_response, view_counter
+from .cache import response_cache
+from .events import get_event_backend, user_channel
+from .outbox import drain_outbox
+from .loadtest import ReplayRequest, parse_log, percentile, query_delay, replay, route_template, synthetic_mix
+from .ranking import hot_score, sweep_hot_scores
+from StackIt.metrics import (
+    Counter as MetricCounter, FileStore, Gauge, Histogram, MemoryStore, Registry, request_duration, requests_total
+)
+from . import metrics
 
 User = get_user_model()
 
@@ -34,3 +68,1324 @@ class QuestionModelTests(TestCase):
         
     def test_question_str(self):
         self.assertEqual(str(self.question), 'Test Question')
+
+class VoteTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='voter@example.com', password='password123')
+        self.author = User.objects.create_user(email='author@example.com', password='password123')
+        self.question = Question.objects.create(
+            title='Test Question',
+            description='This is a test question',
+            author=self.author
+        )
+        self.answer = Answer.objects.create(question=self.question, author=self.author, content='An answer')
+        
+    def test_set_vote_updates_counters(self):
+        Vote.objects.set_vote(self.user, self.question, Vote.UPVOTE)
+        self.question.refresh_from_db()
+        self.assertEqual((self.question.score, self.question.upvote_count, self.question.downvote_count), (1, 1, 0))
+        
+        Vote.objects.set_vote(self.user, self.question, Vote.DOWNVOTE)
+        self.question.refresh_from_db()
+        self.assertEqual((self.question.score, self.question.upvote_count, self.question.downvote_count), (-1, 0, 1))
+        
+        Vote.objects.set_vote(self.user, self.question, 0)
+        self.question.refresh_from_db()
+        self.assertEqual((self.question.score, self.question.upvote_count, self.question.downvote_count), (0, 0, 0))
+        self.assertFalse(Vote.objects.exists())
+        
+    def test_toggle_removes_repeated_vote(self):
+        self.assertEqual(Vote.objects.set_vote(self.user, self.answer, Vote.UPVOTE, toggle=True).vote, Vote.UPVOTE)
+        self.assertEqual(Vote.objects.set_vote(self.user, self.answer, Vote.UPVOTE, toggle=True).vote, 0)
+        self.answer.refresh_from_db()
+        self.assertEqual(self.answer.score, 0)
+        
+    def test_upvote_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(f'/api/forum/questions/{self.question.id}/upvote/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'upvoted')
+        
+        response = client.get('/api/forum/questions/', {'ordering': '-vote_count'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['vote_count'], 1)
+        
+    def test_put_vote_is_idempotent(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = f'/api/forum/questions/{self.question.id}/answers/{self.answer.id}/vote/'
+        for _ in range(2):
+            response = client.put(url, {'value': -1}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data, {'vote': -1, 'score': -1, 'upvote_count': 0, 'downvote_count': 1})
+        
+        response = client.put(url, {'value': 0}, format='json')
+        self.assertEqual(response.data['score'], 0)
+        self.assertFalse(Vote.objects.exists())
+        
+        response = client.put(url, {'value': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        
+        response = client.put(f'/api/forum/questions/{self.question.id + 1}/answers/{self.answer.id}/vote/', {'value': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        
+        # Ids that aren't numbers are missing objects too
+        for method, url in (
+            ('put', '/api/forum/questions/abc/vote/'),
+            ('put', f'/api/forum/questions/abc/answers/{self.answer.id}/vote/'),
+            ('post', f'/api/forum/questions/{self.question.id}/answers/abc/upvote/'),
+            ('post', '/api/forum/direct-answers/abc/downvote/'),
+        ):
+            with self.subTest(url=url):
+                response = getattr(client, method)(url, {'value': 1}, format='json')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        
+    def test_set_vote_query_count(self):
+        # Locked read of target and current vote, vote write, counter and hot score update
+        with self.assertNumQueries(3 + 2):  # plus SAVEPOINT/RELEASE in the test transaction
+            Vote.objects.set_vote(self.user, self.question, Vote.UPVOTE)
+        with self.assertNumQueries(1 + 2):
+            Vote.objects.set_vote(self.user, self.question, Vote.UPVOTE)
+        self.question.refresh_from_db()
+        self.assertAlmostEqual(self.question.hot_score, hot_score(1, self.question.answer_count, 0, self.question.created_at), places=3)
+        
+    def test_backfill_copies_legacy_votes(self):
+        self.question.upvotes.add(self.user)
+        self.answer.downvotes.add(self.user)
+        Vote.objects.set_vote(self.author, self.answer, Vote.UPVOTE)
+        call_command('backfill_votes', stdout=StringIO())
+        self.assertEqual(set(Vote.objects.values_list('user', 'question', 'answer', 'value')), {
+            (self.user.id, self.question.id, None, 1), (self.user.id, None, self.answer.id, -1),
+            (self.author.id, None, self.answer.id, 1),
+        })
+        self.answer.refresh_from_db()
+        self.assertEqual((self.answer.score, self.answer.upvote_count, self.answer.downvote_count), (0, 1, 1))
+        # Running it again imports nothing twice
+        call_command('backfill_votes', stdout=StringIO())
+        self.assertEqual(Vote.objects.count(), 3)
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class HotRankingTests(TestCase):
+    def setUp(self):
+        view_counter.flush()
+        self.author = User.objects.create_user(email='author@example.com', password='password123')
+        self.voters = User.objects.bulk_create([User(email=f'voter{i}@example.com') for i in range(3)])
+        self.old, self.quiet, self.busy = [
+            Question.objects.create(title=title, description='Description', author=self.author)
+            for title in ('Old', 'Quiet', 'Busy')
+        ]
+        Question.objects.filter(pk=self.old.pk).update(created_at=timezone.now() - timedelta(days=30))
+        
+    def hot_titles(self):
+        response = self.client.get('/api/forum/questions/?ordering=-hot&count=false')
+        return [question['title'] for question in response.data['results']]
+        
+    def test_activity_moves_questions_up(self):
+        # Fresh questions start with a score, so new ones show up on the front page
+        self.assertGreater(self.busy.hot_score, 0)
+        sweep_hot_scores()
+        self.assertEqual(self.hot_titles(), ['Busy', 'Quiet', 'Old'])
+        Answer.objects.create(question=self.quiet, author=self.voters[0], content='Answer')
+        for voter in self.voters:
+            Vote.objects.set_vote(voter, self.quiet, Vote.UPVOTE)
+        self.assertEqual(self.hot_titles(), ['Quiet', 'Busy', 'Old'])
+        self.quiet.refresh_from_db()
+        self.assertEqual(self.quiet.answer_count, 1)
+        
+        # Like every other ordering, without the minus it's ascending
+        response = self.client.get('/api/forum/questions/?ordering=hot&count=false')
+        self.assertEqual([question['title'] for question in response.data['results']], ['Old', 'Busy', 'Quiet'])
+        titles, url = [], '/api/forum/questions/?ordering=-hot&page_size=1'
+        while url:
+            response = self.client.get(url)
+            titles += [question['title'] for question in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(titles, ['Quiet', 'Busy', 'Old'])
+        
+        Answer.objects.filter(question=self.quiet).delete()
+        self.quiet.refresh_from_db()
+        self.assertEqual(self.quiet.answer_count, 0)
+        
+        response = self.client.get('/api/forum/questions/?ordering=answer_count')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+    def test_sweep_applies_decay(self):
+        Question.objects.update(hot_score=1)
+        call_command('refresh_hot_scores', stdout=StringIO())
+        scores = dict(Question.objects.values_list('title', 'hot_score'))
+        self.assertEqual(scores['Old'], 0)
+        self.assertTrue(0 < scores['Quiet'] < 1)
+        
+        # An hour later the same question has cooled down
+        later = timezone.now() + timedelta(hours=1)
+        self.assertLess(hot_score(0, 0, 0, self.quiet.created_at, later), scores['Quiet'])
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class ViewCountTests(TestCase):
+    def setUp(self):
+        # Drop views buffered by other tests before their rows are reused
+        view_counter.flush()
+        self.user = User.objects.create_user(email='test@example.com', password='password123')
+        self.question = Question.objects.create(
+            title='Test Question',
+            description='This is a test question',
+            author=self.user
+        )
+        
+    def tearDown(self):
+        view_counter.flush()
+        
+    @override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=3600)
+    def test_views_are_buffered_and_flushed_in_batches(self):
+        updated_at = self.question.updated_at
+        client = APIClient()
+        for expected in (1, 2):
+            response = client.get(f'/api/forum/questions/{self.question.id}/')
+            self.assertEqual(response.data['views_count'], expected)
+        
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.views_count, 0)
+        
+        # views UPDATE, hot score read and write, then the viewer sketch merge
+        # (existence check, row insert, locking read, sketch and estimate
+        # updates), inside SAVEPOINT/RELEASE
+        with self.assertNumQueries(10):
+            self.assertEqual(view_counter.flush(), 2)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.views_count, 2)
+        self.assertEqual(self.question.unique_viewers, 1)
+        self.assertEqual(self.question.updated_at, updated_at)
+        
+    @override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=0)
+    def test_zero_interval_writes_through(self):
+        view_counter.add(self.question.id)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.views_count, 1)
+        
+    @override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=1)
+    def test_due_flush_runs_after_the_response(self):
+        view_counter._last_flush -= 2
+        view_counter.add(self.question.id)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.views_count, 0)
+        request_finished.send(sender=None)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.views_count, 1)
+        
+    def test_due_flush_runs_before_connections_are_closed(self):
+        receivers = request_finished._live_receivers(None)[0]
+        self.assertLess(receivers.index(flush_after_response), receivers.index(close_old_connections))
+        
+    @override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=1)
+    def test_failed_flush_keeps_counts_without_failing_the_request(self):
+        def fail_view_updates(execute, sql, params, many, context):
+            if sql.startswith('UPDATE "forum_question" SET "views_count"'):
+                raise DatabaseError('database is down')
+            return execute(sql, params, many, context)
+        
+        client = APIClient()
+        # Sets up the middleware, whose query timer would land on top of the wrapper below
+        client.get('/api/forum/tags/')
+        view_counter._last_flush -= 2
+        with connection.execute_wrapper(fail_view_updates), self.assertLogs('forum.view_counter', 'ERROR'):
+            response = client.get(f'/api/forum/questions/{self.question.id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(view_counter.pending(self.question.id), 1)
+        self.assertEqual(view_counter.flush(), 1)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.views_count, 1)
+        
+    @override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=3600)
+    def test_unique_viewers_sketches(self):
+        other = Question.objects.create(title='Other', description='Another question', author=self.user)
+        tag = Tag.objects.create(name='Python')
+        self.question.tags.add(tag)
+        other.tags.add(tag)
+        for i in range(50):
+            view_counter.add(self.question.id, viewer=f'user:{i}')
+            view_counter.add(self.question.id, viewer=f'user:{i}')
+        for i in range(25, 100):
+            view_counter.add(other.id, viewer=f'user:{i}')
+        view_counter.flush()
+        
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.views_count, 100)
+        self.assertAlmostEqual(self.question.unique_viewers, 50, delta=2)
+        
+        reach = QuestionViewerSketch.objects.filter(question__tags=tag, day__isnull=True).merged().count()
+        self.assertAlmostEqual(reach, 100, delta=3)
+        self.assertEqual(QuestionViewerSketch.objects.filter(day__isnull=False).count(), 2)
+        
+        response = APIClient().get('/api/forum/questions/', {'ordering': '-unique_viewers'})
+        self.assertEqual(response.data['results'][0]['id'], other.id)
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class QuestionListQueryTests(TestCase):
+    def create_questions(self, count):
+        for i in range(count):
+            author = self.authors[self.created % 2]
+            question = Question.objects.create(title=f'Question {self.created}', description='Description', author=author)
+            question.tags.add(*self.tags)
+            answer = Answer.objects.create(question=question, author=author, content='Answer')
+            if i % 2:
+                answer.is_accepted = True
+                answer.save()
+            self.created += 1
+            
+    def setUp(self):
+        self.created = 0
+        self.authors = [
+            User.objects.create_user(email=f'user{i}@example.com', password='password123') for i in range(2)
+        ]
+        self.tags = [Tag.objects.create(name=name) for name in ('Python', 'Django', 'SQL')]
+        
+    def test_list_query_count_is_fixed(self):
+        client = APIClient()
+        self.create_questions(2)
+        # pagination COUNT, page of questions, prefetched tags with counts
+        with self.assertNumQueries(3):
+            response = client.get('/api/forum/questions/')
+        self.create_questions(8)
+        with self.assertNumQueries(3):
+            response = client.get('/api/forum/questions/')
+        
+        first = response.data['results'][0]
+        self.assertEqual(first['title'], 'Question 9')
+        self.assertTrue(first['is_answered'])
+        self.assertEqual(first['answer_count'], 1)
+        self.assertEqual({tag['question_count'] for tag in first['tags']}, {10})
+
+class TagCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='test@example.com', password='password123')
+        self.python = Tag.objects.create(name='Python')
+        self.django = Tag.objects.create(name='Django')
+        
+    def counts(self):
+        return dict(Tag.objects.values_list('name', 'question_count'))
+        
+    def test_question_count_follows_tag_changes(self):
+        question = Question.objects.create(title='Q', description='D', author=self.user)
+        question.tags.set([self.python, self.django])
+        self.assertEqual(self.counts(), {'Python': 1, 'Django': 1})
+        
+        question.tags.set([self.django])
+        self.assertEqual(self.counts(), {'Python': 0, 'Django': 1})
+        
+        # Removing links that don't exist changes nothing
+        question.tags.remove(self.python)
+        self.python.questions.remove(question)
+        self.assertEqual(self.counts(), {'Python': 0, 'Django': 1})
+        
+        self.python.questions.add(question)
+        self.assertEqual(self.counts(), {'Python': 1, 'Django': 1})
+        
+        question.tags.clear()
+        self.assertEqual(self.counts(), {'Python': 0, 'Django': 0})
+        
+        question.tags.add(self.python)
+        question.delete()
+        self.assertEqual(self.counts(), {'Python': 0, 'Django': 0})
+        
+    @override_settings(FORUM_SHARED_CACHE=True)
+    def test_tag_list_is_served_from_catalogue(self):
+        client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            question = Question.objects.create(title='Q', description='D', author=self.user)
+            question.tags.add(self.python)
+        
+        response = client.get('/api/forum/tags/')
+        self.assertEqual(response.data['count'], 2)
+        with self.assertNumQueries(0):
+            response = client.get('/api/forum/tags/')
+        self.assertEqual([tag['question_count'] for tag in response.data['results']], [0, 1])
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='SQL')
+        response = client.get('/api/forum/tags/')
+        self.assertEqual(response.data['count'], 3)
+        
+    @override_settings(FORUM_SHARED_CACHE=False)
+    def test_tag_list_is_not_cached_without_shared_cache(self):
+        client = APIClient()
+        client.get('/api/forum/tags/')
+        # As if another worker renamed the tag: its version bump would stay in that process
+        Tag.objects.filter(pk=self.python.pk).update(name='Python 3')
+        with self.assertNumQueries(1):
+            response = client.get('/api/forum/tags/')
+        self.assertIn('Python 3', [tag['name'] for tag in response.data['results']])
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='password123')
+        self.tag = Tag.objects.create(name='Postgres')
+        self.in_title = Question.objects.create(
+            title='Indexing strategies', description='<p>How should I pick columns?</p>', author=self.user
+        )
+        self.in_body = Question.objects.create(
+            title='Slow page', description='<p>My query does a full scan, is indexing the fix?</p>', author=self.user
+        )
+        self.unrelated = Question.objects.create(title='CSS grid', description='Centering a div', author=self.user)
+        self.unrelated.tags.add(self.tag)
+        
+    def search(self, **params):
+        return APIClient().get('/api/forum/questions/', params).data['results']
+        
+    def test_ranked_search_with_snippets(self):
+        results = self.search(search='indexing', ordering='relevance')
+        self.assertEqual([q['id'] for q in results], [self.in_title.id, self.in_body.id])
+        self.assertIn('<mark>indexing</mark>', results[1]['snippet'])
+        self.assertNotIn('<p>', results[1]['snippet'])
+        
+    def test_search_follows_edits_and_tags(self):
+        self.assertEqual([q['id'] for q in self.search(search='postgres')], [self.unrelated.id])
+        self.unrelated.tags.clear()
+        self.assertEqual(self.search(search='postgres'), [])
+        
+        self.unrelated.title = 'Indexing CSS'
+        self.unrelated.save()
+        self.assertEqual(len(self.search(search='indexing')), 3)
+        
+        self.in_title.delete()
+        self.assertEqual(len(self.search(search='indexing "strategies')), 0)
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='test@example.com', password='password123')
+        self.questions = [
+            Question.objects.create(title=f'Question {i}', description='Description', author=self.user)
+            for i in range(25)
+        ]
+        # Ties on the ordering column are broken by id
+        Question.objects.filter(id__in=[q.id for q in self.questions[:12]]).update(score=3)
+        
+    def walk(self, client, url, params):
+        ids = []
+        response = client.get(url, params)
+        while True:
+            ids += [item['id'] for item in response.data['results']]
+            if not response.data['next']:
+                return ids, response
+            response = client.get(response.data['next'])
+        
+    def test_pages_follow_ordering_without_duplicates(self):
+        client = APIClient()
+        ids, _ = self.walk(client, '/api/forum/questions/', {'ordering': '-vote_count'})
+        expected = list(Question.objects.order_by('-score', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        
+    def test_new_rows_do_not_shift_pages(self):
+        client = APIClient()
+        first = client.get('/api/forum/questions/')
+        Question.objects.create(title='Newest', description='Description', author=self.user)
+        second = client.get(first.data['next'])
+        self.assertEqual(second.data['results'][0]['id'], first.data['results'][-1]['id'] - 1)
+        
+        previous = client.get(second.data['previous'])
+        self.assertEqual(
+            [item['id'] for item in previous.data['results']],
+            [item['id'] for item in first.data['results']],
+        )
+        
+    def test_count_opt_out_and_invalid_cursor(self):
+        client = APIClient()
+        response = client.get('/api/forum/questions/', {'count': 'false'})
+        self.assertNotIn('count', response.data)
+        response = client.get('/api/forum/questions/')
+        self.assertEqual(response.data['count'], 25)
+        response = client.get('/api/forum/questions/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+@override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=3600, FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class QuestionDetailQueryTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(email=f'user{i}@example.com', password='password123') for i in range(3)
+        ]
+        self.viewer = self.users[0]
+        self.question = Question.objects.create(title='Question', description='Description', author=self.users[1])
+        self.question.tags.add(Tag.objects.create(name='Python'), Tag.objects.create(name='Django'))
+        Vote.objects.set_vote(self.viewer, self.question, Vote.UPVOTE)
+        
+    def tearDown(self):
+        view_counter.flush()
+        
+    def add_answers(self, count, comments_per_answer):
+        for i in range(count):
+            answer = Answer.objects.create(question=self.question, author=self.users[i % 3], content=f'Answer {i}')
+            Comment.objects.bulk_create([
+                Comment(answer=answer, author=self.users[(i + j) % 3], content=f'Comment {j}')
+                for j in range(comments_per_answer)
+            ])
+            if i % 2:
+                Vote.objects.set_vote(self.viewer, answer, Vote.DOWNVOTE)
+                
+    def test_detail_query_count_is_fixed(self):
+        url = f'/api/forum/questions/{self.question.id}/'
+        client = APIClient()
+        client.force_authenticate(self.viewer)
+        
+        self.add_answers(2, 1)
+        # question+author, tags, answers+authors, comments+authors, viewer votes
+        with self.assertNumQueries(5):
+            client.get(url)
+        
+        self.add_answers(30, 7)
+        with self.assertNumQueries(5):
+            response = client.get(url)
+        with self.assertNumQueries(4):
+            APIClient().get(url)
+        
+        self.assertTrue(response.data['is_upvoted'])
+        answers = response.data['answers']
+        self.assertEqual(len(answers), 32)
+        self.assertEqual(sum(answer['is_downvoted'] for answer in answers), 16)
+        self.assertEqual(answers[0]['vote_count'], 0)
+        self.assertEqual(answers[-1]['vote_count'], -1)
+        self.assertEqual(len(answers[0]['comments']), 7)
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class VoteStateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='voter@example.com', password='password123')
+        self.questions = [
+            Question.objects.create(title=f'Question {i}', description='Description', author=self.user)
+            for i in range(3)
+        ]
+        self.answer = Answer.objects.create(question=self.questions[0], author=self.user, content='Answer')
+        Vote.objects.set_vote(self.user, self.questions[0], Vote.UPVOTE)
+        Vote.objects.set_vote(self.user, self.questions[2], Vote.DOWNVOTE)
+        Vote.objects.set_vote(self.user, self.answer, Vote.UPVOTE)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        
+    def tearDown(self):
+        view_counter.flush()
+        
+    def test_votes_mine_in_one_query(self):
+        ids = ','.join(str(q.id) for q in self.questions)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/forum/votes/mine/', {'questions': ids, 'answers': str(self.answer.id)})
+        self.assertEqual(response.data, {
+            'questions': {str(self.questions[0].id): 1, str(self.questions[2].id): -1},
+            'answers': {str(self.answer.id): 1},
+        })
+        
+        response = self.client.get('/api/forum/votes/mine/', {'questions': 'a,b'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/api/forum/votes/mine/', {'questions': ','.join(map(str, range(501)))})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        
+    @override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=3600)
+    def test_detail_without_personalization(self):
+        url = f'/api/forum/questions/{self.questions[0].id}/'
+        personal = self.client.get(url).data
+        self.assertTrue(personal['is_upvoted'])
+        self.assertTrue(personal['answers'][0]['is_upvoted'])
+        
+        shared = self.client.get(url, {'personalize': 'false'}).data
+        anonymous = APIClient().get(url, {'personalize': 'false'}).data
+        self.assertNotIn('is_upvoted', shared)
+        self.assertNotIn('is_upvoted', shared['answers'][0])
+        shared.pop('views_count')
+        anonymous.pop('views_count')
+        self.assertEqual(shared, anonymous)
+
+@override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=3600, FORUM_RESPONSE_CACHE_TIMEOUT=60, FORUM_SHARED_CACHE=True)
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        response_cache.reset_stats()
+        view_counter.flush()
+        self.user = User.objects.create_user(email='test@example.com', password='password123')
+        self.question = Question.objects.create(title='Cached', description='Description', author=self.user)
+        self.answer = Answer.objects.create(question=self.question, author=self.user, content='Answer')
+        self.detail_url = f'/api/forum/questions/{self.question.id}/'
+        self.anonymous = APIClient()
+        
+    def test_anonymous_reads_are_cached(self):
+        self.anonymous.get('/api/forum/questions/')
+        with self.assertNumQueries(0):
+            response = self.anonymous.get('/api/forum/questions/')
+        self.assertEqual(response.data['results'][0]['title'], 'Cached')
+        first = self.anonymous.get(self.detail_url)
+        self.assertIn('public', first['Cache-Control'])
+        with self.assertNumQueries(0):
+            self.anonymous.get(self.detail_url)
+        with self.assertNumQueries(0):
+            response = self.anonymous.get(self.detail_url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.anonymous.get('/api/forum/tags/')
+        self.anonymous.get('/api/forum/tags/')
+        self.assertEqual(response_cache.stats(), {
+            'question-list': {'hits': 1, 'misses': 1},
+            'question-retrieve': {'hits': 2, 'misses': 1},
+            'tag-list': {'hits': 1, 'misses': 1},
+        })
+        # Cached pages still count views
+        self.assertEqual(view_counter.pending(self.question.id), 3)
+        view_counter.flush()
+        
+        client = APIClient()
+        client.force_authenticate(self.user)
+        # Signed-in readers always get a fresh, personalized page
+        with self.assertNumQueries(5):
+            client.get(self.detail_url)
+        view_counter.flush()
+        
+    def test_writes_invalidate_cached_responses(self):
+        self.anonymous.get(self.detail_url)
+        self.anonymous.get('/api/forum/questions/')
+        client = APIClient()
+        client.force_authenticate(self.user)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(f'{self.detail_url}upvote/')
+        self.assertEqual(self.anonymous.get(self.detail_url).data['vote_count'], 1)
+        self.assertEqual(self.anonymous.get('/api/forum/questions/').data['results'][0]['vote_count'], 1)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(f'{self.detail_url}answers/{self.answer.id}/comments/', {'content': 'A comment'})
+        self.assertEqual(len(self.anonymous.get(self.detail_url).data['answers'][0]['comments']), 1)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            client.patch(self.detail_url, {'title': 'Edited'})
+        self.assertEqual(self.anonymous.get('/api/forum/questions/').data['results'][0]['title'], 'Edited')
+        view_counter.flush()
+
+@override_settings(FORUM_VIEW_COUNT_FLUSH_INTERVAL=3600, FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        view_counter.flush()
+        self.user = User.objects.create_user(email='test@example.com', password='password123')
+        self.other = User.objects.create_user(email='other@example.com', password='password123')
+        self.question = Question.objects.create(title='Polling', description='Description', author=self.user)
+        self.answer = Answer.objects.create(question=self.question, author=self.other, content='Answer')
+        drain_outbox()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        
+    def tearDown(self):
+        view_counter.flush()
+        
+    def assertRevalidates(self, url):
+        """Returns the first response; the repeat must be a 304 costing a single query"""
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Authorization', response['Vary'])
+        with self.assertNumQueries(1):
+            repeat = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(repeat.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(repeat['ETag'], response['ETag'])
+        return response
+        
+    def test_question_detail(self):
+        url = f'/api/forum/questions/{self.question.id}/'
+        first = self.assertRevalidates(url)
+        # Votes and deletions move no timestamp, so dates never revalidate
+        self.assertNotIn('Last-Modified', first)
+        repeat = self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(repeat.status_code, status.HTTP_200_OK)
+        # 304s still count as views
+        self.assertEqual(view_counter.pending(self.question.id), 3)
+        
+        Vote.objects.set_vote(self.other, self.answer, Vote.UPVOTE)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        
+        # Another user's copy has different vote state
+        other = APIClient()
+        other.force_authenticate(self.other)
+        self.assertEqual(other.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, status.HTTP_200_OK)
+        
+    def test_question_tags_and_own_votes(self):
+        url = f'/api/forum/questions/{self.question.id}/'
+        first = self.assertRevalidates(url)
+        self.question.tags.add(Tag.objects.create(name='Python'))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([tag['name'] for tag in response.data['tags']], ['Python'])
+        
+        Vote.objects.set_vote(self.user, self.question, Vote.UPVOTE)
+        Vote.objects.set_vote(self.other, self.question, Vote.DOWNVOTE)
+        Vote.objects.set_vote(self.user, self.answer, Vote.UPVOTE)
+        first = self.assertRevalidates(url)
+        # Both switch sides: every score stays the same, only the viewer's own vote shows the change
+        Vote.objects.set_vote(self.user, self.question, Vote.DOWNVOTE)
+        Vote.objects.set_vote(self.other, self.question, Vote.UPVOTE)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['is_downvoted'])
+        
+        answers_url = f'{url}answers/'
+        first = self.assertRevalidates(answers_url)
+        Vote.objects.set_vote(self.user, self.answer, 0)
+        Vote.objects.set_vote(self.other, self.answer, Vote.UPVOTE)
+        response = self.client.get(answers_url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['results'][0]['is_upvoted'])
+        
+        # Deleting a tag sends no m2m_changed
+        first = self.assertRevalidates(url)
+        Tag.objects.all().delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, status.HTTP_200_OK)
+        
+    def test_nested_lists_and_notifications(self):
+        answers_url = f'/api/forum/questions/{self.question.id}/answers/'
+        first = self.assertRevalidates(answers_url)
+        Comment.objects.create(answer=self.answer, author=self.user, content='Comment')
+        self.assertEqual(self.client.get(answers_url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, status.HTTP_200_OK)
+        
+        comments_url = f'{answers_url}{self.answer.id}/comments/'
+        first = self.assertRevalidates(comments_url)
+        Comment.objects.filter(answer=self.answer).delete()
+        self.assertEqual(self.client.get(comments_url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, status.HTTP_200_OK)
+        
+        first = self.assertRevalidates('/api/forum/notifications/')
+        self.client.post('/api/forum/notifications/mark_all_as_read/')
+        response = self.client.get('/api/forum/notifications/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(email=f'user{i}@example.com', password='password123') for i in range(3)
+        ]
+        self.question = Question.objects.create(title='Outbox', description='Description', author=self.users[0])
+        
+    def test_events_become_notifications_in_batches(self):
+        answers = [
+            Answer.objects.create(question=self.question, author=self.users[1 + i % 2], content=f'Answer {i}')
+            for i in range(10)
+        ]
+        # Nothing is created on the write path
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(OutboxEvent.objects.count(), 10)
+        
+        # Locking read, answers, recipients' counter upsert and lock, unread notifications
+        # to group into, notification insert, counter update, event delete, however many events
+        with self.assertNumQueries(8 + 2):
+            self.assertEqual(drain_outbox(batch_size=50), 10)
+        notification = Notification.objects.get(recipient=self.users[0], notification_type='answer')
+        self.assertEqual(notification.actor_count, 2)
+        self.assertEqual(notification.answer, answers[-1])
+        self.assertEqual(notification.message, "2 people answered your question: 'Outbox'")
+        self.assertFalse(OutboxEvent.objects.exists())
+        
+        Comment.objects.create(answer=answers[0], author=self.users[2], content='Thanks')
+        Comment.objects.create(answer=answers[1], author=answers[1].author, content='My own answer')
+        answers[2].is_accepted = True
+        answers[2].save()
+        answers[3].delete()
+        self.assertEqual(drain_outbox(batch_size=2), 3)
+        self.assertEqual(
+            sorted(Notification.objects.exclude(notification_type='answer').values_list('notification_type', 'recipient')),
+            [('accept', self.users[1].id), ('comment', self.users[1].id)],
+        )
+        
+    def test_eager_mode_drains_after_commit(self):
+        with self.settings(FORUM_OUTBOX_EAGER=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                Answer.objects.create(question=self.question, author=self.users[1], content='Answer')
+                self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertFalse(OutboxEvent.objects.exists())
+        
+    @override_settings(FORUM_MAX_MENTIONS_PER_COMMENT=15)
+    def test_mentions_are_resolved_in_one_query(self):
+        mentioned = User.objects.bulk_create([User(email=f'reader{i}@example.com') for i in range(20)])
+        answer = Answer.objects.create(question=self.question, author=self.users[0], content='Answer')
+        drain_outbox()
+        content = ' '.join(f'@Reader{i}@Example.com' for i in range(20))
+        Comment.objects.create(answer=answer, author=self.users[1], content=f'{content} @reader0@example.com @nobody@example.com')
+        Comment.objects.create(answer=answer, author=self.users[2], content='cc @user2@example.com, @reader19@example.com.')
+        
+        # Locking read, comments, mentioned users, recipients' counter upsert and lock,
+        # unread notifications to group into, notification insert, counter update, event delete
+        with self.assertNumQueries(9 + 2):
+            drain_outbox()
+        self.assertEqual(
+            set(Notification.objects.filter(notification_type='mention').values_list('recipient', flat=True)),
+            {user.id for user in mentioned[:15]} | {mentioned[19].id},
+        )
+        # Both comments are on the owner's answer
+        self.assertEqual(Notification.objects.get(notification_type='comment').actor_count, 2)
+    
+    def test_unread_notifications_are_updated_in_place(self):
+        owner = self.users[0]
+        Answer.objects.create(question=self.question, author=self.users[1], content='First')
+        drain_outbox()
+        first = Notification.objects.get()
+        self.assertEqual(first.message, f"{self.users[1].email} answered your question: 'Outbox'")
+        
+        other = Question.objects.create(title='Other', description='Description', author=owner)
+        Answer.objects.create(question=other, author=self.users[1], content='Elsewhere')
+        drain_outbox()
+        
+        Answer.objects.create(question=self.question, author=self.users[2], content='Second')
+        Answer.objects.create(question=self.question, author=self.users[1], content='Third')
+        drain_outbox(batch_size=1)
+        grouped = Notification.objects.get(question=self.question)
+        self.assertEqual(grouped.id, first.id)
+        self.assertEqual((grouped.actor_count, grouped.sender), (2, self.users[1]))
+        # The watermark compares created_at, so only last_activity_at moves
+        self.assertEqual(grouped.created_at, first.created_at)
+        self.assertGreater(grouped.last_activity_at, first.last_activity_at)
+        self.assertEqual(NotificationState.objects.unread_count(owner), 2)
+        
+        client = APIClient()
+        client.force_authenticate(user=owner)
+        feed = client.get('/api/forum/notifications/').data['results']
+        self.assertEqual([notification['id'] for notification in feed][0], first.id)
+        
+        # Once read, new activity starts a new notification
+        client.post('/api/forum/notifications/mark_all_as_read/')
+        Answer.objects.create(question=self.question, author=self.users[2], content='Fourth')
+        drain_outbox()
+        self.assertEqual(Notification.objects.filter(question=self.question).count(), 2)
+        self.assertEqual(NotificationState.objects.unread_count(owner), 1)
+        self.assertEqual(client.get('/api/forum/notifications/unread_count/').data['count'], 1)
+        
+    def test_read_notifications_are_purged_in_batches(self):
+        owner = self.users[0]
+        other = Question.objects.create(title='Other', description='Description', author=owner)
+        for question in (self.question, other):
+            Answer.objects.create(question=question, author=self.users[1], content='Answer')
+            Answer.objects.create(question=question, author=self.users[1], content='Another answer')
+        drain_outbox()
+        old, recent = Notification.objects.order_by('id')
+        long_ago = timezone.now() - timedelta(days=100)
+        Notification.objects.update(created_at=long_ago, last_activity_at=long_ago)
+        Notification.objects.filter(id=recent.id).update(last_activity_at=timezone.now())
+        
+        # Unread notifications are kept however old they are
+        call_command('purge_notifications', stdout=StringIO())
+        self.assertEqual(Notification.objects.count(), 2)
+        
+        client = APIClient()
+        client.force_authenticate(user=owner)
+        client.post('/api/forum/notifications/mark_all_as_read/')
+        out = StringIO()
+        call_command('purge_notifications', days=30, batch_size=1, stdout=out)
+        self.assertIn('Deleted 1', out.getvalue())
+        self.assertEqual(list(Notification.objects.values_list('id', flat=True)), [recent.id])
+        self.assertEqual(NotificationState.objects.unread_count(owner), 0)
+
+class UnreadCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='reader@example.com', password='password123')
+        self.other = User.objects.create_user(email='writer@example.com', password='password123')
+        # Separate questions, so the notifications aren't grouped
+        self.questions = [
+            Question.objects.create(title=f'Unread {i}', description='Description', author=self.user) for i in range(5)
+        ]
+        for i, question in enumerate(self.questions):
+            Answer.objects.create(question=question, author=self.other, content=f'Answer {i}')
+        drain_outbox()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        
+    def unread_count(self):
+        with self.assertNumQueries(1):
+            return self.client.get('/api/forum/notifications/unread_count/').data['count']
+        
+    def test_counter_follows_reads_and_deletes(self):
+        self.assertEqual(self.unread_count(), 5)
+        first = Notification.objects.filter(recipient=self.user).earliest('created_at')
+        self.client.post(f'/api/forum/notifications/{first.id}/mark_as_read/')
+        self.client.post(f'/api/forum/notifications/{first.id}/mark_as_read/')
+        self.assertEqual(self.unread_count(), 4)
+        
+        Answer.objects.filter(content='Answer 4').delete()
+        self.assertEqual(self.unread_count(), 3)
+        
+    def test_mark_all_read_is_a_single_update(self):
+        with self.assertNumQueries(1):
+            self.client.post('/api/forum/notifications/mark_all_as_read/')
+        self.assertEqual(self.unread_count(), 0)
+        results = self.client.get('/api/forum/notifications/').data['results']
+        self.assertTrue(all(notification['is_read'] for notification in results))
+        # Rows themselves are untouched, and reading one doesn't count twice
+        notification = Notification.objects.filter(recipient=self.user).first()
+        self.assertFalse(notification.is_read)
+        self.client.post(f'/api/forum/notifications/{notification.id}/mark_as_read/')
+        
+        Answer.objects.create(question=self.questions[0], author=self.other, content='Later')
+        drain_outbox()
+        self.assertEqual(self.unread_count(), 1)
+        results = self.client.get('/api/forum/notifications/').data['results']
+        self.assertEqual([notification['is_read'] for notification in results], [False] + [True] * 5)
+        
+        NotificationState.objects.update(unread_count=42)
+        call_command('recount_notifications', stdout=StringIO())
+        self.assertEqual(self.unread_count(), 1)
+        
+        # As left by the migration adding the column
+        Notification.objects.update(last_activity_at=timezone.now() + timedelta(days=1))
+        call_command('recount_notifications', backfill_activity=True, stdout=StringIO())
+        self.assertFalse(Notification.objects.exclude(last_activity_at=F('created_at')).exists())
+        self.assertEqual(self.unread_count(), 1)
+
+class NotificationStreamTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='reader@example.com', password='password123')
+        self.other = User.objects.create_user(email='writer@example.com', password='password123')
+        self.question = Question.objects.create(title='Streaming', description='Description', author=self.user)
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        
+    def answer_and_drain(self):
+        Answer.objects.create(question=self.question, author=self.other, content='Answer')
+        # Publishing happens once the outbox batch commits
+        with self.captureOnCommitCallbacks(execute=True):
+            drain_outbox()
+        
+    async def next_event(self, stream):
+        return (await anext(stream)).decode()
+        
+    async def test_stream_pushes_notifications_and_counts(self):
+        response = await self.async_client.get(
+            '/api/forum/notifications/stream/', headers={'Authorization': f'Bearer {self.token}'}
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertTrue((await self.next_event(stream)).startswith('retry:'))
+        self.assertIn('"count": 0', await self.next_event(stream))
+        
+        await sync_to_async(self.answer_and_drain)()
+        event = await self.next_event(stream)
+        self.assertTrue(event.startswith('event: notification'))
+        self.assertIn('answered your question', event)
+        self.assertIn('"count": 1', await self.next_event(stream))
+        
+        get_event_backend().publish(user_channel(self.user.id), {'type': 'read'})
+        self.assertIn('event: unread_count', await self.next_event(stream))
+        # A client disconnect cancels the waiting stream, which unsubscribes
+        waiting = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(get_event_backend().subscriber_count(), 0)
+        
+    async def test_stream_requires_authentication(self):
+        response = await self.async_client.get('/api/forum/notifications/stream/', {'token': 'invalid'})
+        self.assertEqual(response.status_code, 401)
+
+class SeedForumTests(TestCase):
+    def seed(self, **options):
+        call_command('seed_forum', users=30, questions=60, tags=10, seed=7, batch_size=50, stdout=StringIO(), **options)
+        return list(Question.objects.order_by('id').values_list('title', 'answer_count', 'score'))
+    
+    def test_counters_match_the_seeded_rows(self):
+        self.seed()
+        self.assertEqual(User.objects.count(), 30)
+        self.assertEqual(Question.objects.count(), 60)
+        self.assertEqual(Answer.objects.count(), 150)
+        for question in Question.objects.annotate(answers_total=Count('answers')):
+            self.assertEqual(question.answer_count, question.answers_total)
+        for tag in Tag.objects.annotate(total=Count('questions')):
+            self.assertEqual(tag.question_count, tag.total)
+        for state in NotificationState.objects.all():
+            self.assertEqual(
+                state.unread_count, Notification.objects.filter(recipient=state.user, is_read=False).count()
+            )
+        user = User.objects.order_by('?').first()
+        self.assertTrue(user.check_password('password'))
+        # Answers and comments come after what they reply to
+        self.assertFalse(Answer.objects.filter(created_at__lt=F('question__created_at')).exists())
+        self.assertFalse(Comment.objects.filter(created_at__lt=F('answer__created_at')).exists())
+        self.assertFalse(Notification.objects.exclude(last_activity_at=F('created_at')).exists())
+    
+    def test_same_seed_same_rows(self):
+        first = self.seed(skip_search_index=True)
+        User.objects.all().delete()
+        Tag.objects.all().delete()
+        self.assertEqual(self.seed(skip_search_index=True), first)
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class ReplayRequestsTests(TestCase):
+    def setUp(self):
+        view_counter.flush()
+        cache.clear()
+        self.user = User.objects.create_user(email='replayer@example.com', password='password123')
+        self.question = Question.objects.create(title='Replayed', description='Description', author=self.user)
+        self.answer = Answer.objects.create(question=self.question, author=self.user, content='Answer')
+        
+    def tearDown(self):
+        view_counter.flush()
+        
+    def test_route_templates(self):
+        self.assertEqual(route_template(f'/api/forum/questions/{self.question.id}/?personalize=false'),
+                         '/api/forum/questions/{id}/')
+        self.assertEqual(
+            route_template(f'/api/forum/questions/{self.question.id}/answers/{self.answer.id}/comments/'),
+            '/api/forum/questions/{question_id}/answers/{answer_pk}/comments/',
+        )
+        self.assertEqual(route_template('/api/auth/login/'), '/api/auth/login/')
+        self.assertEqual(route_template('/nowhere/'), '/nowhere/')
+        
+    def test_parse_log(self):
+        lines = [
+            '{"method": "post", "path": "/api/forum/tags/", "body": {"name": "x"}, "user": "replayer@example.com"}',
+            'INFO [2026-01-01 00:00:00] abc anonymous - GET /api/forum/questions/?ordering=hot',
+            '{"message": "no path"}',
+            'not a request',
+        ]
+        self.assertEqual(list(parse_log(lines)), [
+            ReplayRequest('POST', '/api/forum/tags/', {'name': 'x'}, self.user.id),
+            ReplayRequest('GET', '/api/forum/questions/?ordering=hot'),
+        ])
+        
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, p) for p in (50, 95, 99)], [50, 95, 99])
+        self.assertEqual(percentile([], 50), 0.0)
+        
+    def test_report_per_route(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = os.path.join(directory, 'requests.log')
+            with open(log, 'w') as f:
+                f.write(f'GET /api/forum/questions/{self.question.id}/\n' * 3)
+                f.write('GET /api/forum/questions/\n')
+                f.write(json.dumps({'path': '/api/forum/notifications/unread_count/', 'user_id': self.user.id}) + '\n')
+            out = StringIO()
+            call_command('replay_requests', log=log, concurrency=1, save=os.path.join(directory, 'report.json'),
+                         stdout=out)
+            with open(os.path.join(directory, 'report.json')) as f:
+                report = json.load(f)
+        self.assertIn('5 requests (0 errors)', out.getvalue())
+        routes = {route['route']: route for route in report['routes']}
+        self.assertEqual(routes['/api/forum/questions/{id}/']['count'], 3)
+        self.assertEqual(routes['/api/forum/notifications/unread_count/']['queries_max'], 2)
+        self.assertEqual(report['routes'][0]['route'], '/api/forum/questions/{id}/')
+        
+    def test_synthetic_mix_is_reproducible(self):
+        Notification.objects.create(recipient=self.user, sender=self.user, notification_type='answer',
+                                    question=self.question, message='Answered')
+        first = synthetic_mix(200, seed=3)
+        self.assertEqual(first, synthetic_mix(200, seed=3))
+        results, _ = replay(first[:40])
+        self.assertTrue(all(result.status == 200 for result in results))
+        
+    def test_query_delay(self):
+        with query_delay(0.05):
+            with CaptureQueriesContext(connection) as queries:
+                Question.objects.count()
+        self.assertGreaterEqual(float(queries[0]['time']), 0.05)
+        with CaptureQueriesContext(connection) as queries:
+            Question.objects.count()
+        self.assertLess(float(queries[0]['time']), 0.05)
+        
+    def test_replay_through_asgi(self):
+        # The ASGI handler's request threads have their own connections, outside
+        # the test transaction, so these are answered without the database
+        requests = [
+            ReplayRequest('GET', '/api/forum/notifications/unread_count/'),
+            ReplayRequest('GET', '/api/forum/notifications/?page_size=5'),
+        ]
+        results, _ = replay(requests, concurrency=2, asgi=True)
+        self.assertEqual([result.status for result in results], [401, 401])
+        self.assertEqual(
+            sorted(result.route for result in results),
+            ['/api/forum/notifications/', '/api/forum/notifications/unread_count/'],
+        )
+        self.assertEqual({result.queries for result in results}, {None})
+
+@override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class RequestTimingTests(TestCase):
+    def setUp(self):
+        view_counter.flush()
+        cache.clear()
+        self.user = User.objects.create_user(email='timed@example.com', password='password123')
+        self.question = Question.objects.create(title='Timed', description='Description', author=self.user)
+        
+    @override_settings(REQUEST_TIMING_HEADER=True)
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().get('/api/forum/questions/', HTTP_X_REQUEST_ID='trace-0123456789')
+        self.assertEqual(response['X-Request-ID'], 'trace-0123456789')
+        timings = {part.split(';')[0]: part for part in response['Server-Timing'].split(', ')}
+        self.assertEqual(set(timings), {'app', 'db', 'serializer'})
+        self.assertIn(f'desc="{len(queries)} queries"', timings['db'])
+        
+    @override_settings(REQUEST_TIMING_HEADER=False)
+    def test_request_log_record(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.assertLogs('stackit.requests', 'INFO') as logs:
+            response = client.get(f'/api/forum/questions/{self.question.id}/', HTTP_X_REQUEST_ID='bad id')
+        record = logs.records[-1]
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(record.request_id, response['X-Request-ID'])
+        self.assertNotEqual(record.request_id, 'bad id')
+        self.assertEqual(record.route, '/api/forum/questions/{id}/')
+        self.assertEqual(record.user_id, self.user.id)
+        self.assertEqual(record.status_code, 200)
+        self.assertEqual(record.response_bytes, len(response.content))
+        self.assertGreater(record.queries, 0)
+        self.assertGreater(record.serializer_ms, 0)
+        self.assertLessEqual(record.db_ms, record.duration_ms)
+        # Log lines can be replayed
+        self.assertEqual(list(parse_log([record.getMessage()])),
+                         [ReplayRequest('GET', f'/api/forum/questions/{self.question.id}/')])
+        
+    def test_credentials_stay_out_of_the_log(self):
+        with self.assertLogs('stackit.requests', 'INFO') as logs:
+            APIClient().get('/api/forum/notifications/', {'token': 'secret-jwt', 'page_size': 5})
+        record = logs.records[-1]
+        self.assertEqual(record.path, '/api/forum/notifications/?page_size=5')
+        self.assertNotIn('secret-jwt', record.getMessage())
+        
+    @override_settings(REQUEST_TIMING=False)
+    def test_switched_off(self):
+        response = APIClient().get('/api/forum/questions/')
+        self.assertNotIn('X-Request-ID', response)
+
+def count_in_child(directory, amount):
+    """Run in a forked process by MetricsTests"""
+    registry = Registry(FileStore(directory))
+    MetricCounter('child_total', 'Child', registry=registry).inc(amount)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        view_counter.flush()
+        cache.clear()
+        self.user = User.objects.create_user(email='metrics@example.com', password='password123')
+        self.question = Question.objects.create(title='Measured', description='Description', author=self.user)
+        
+    def test_text_format(self):
+        registry = Registry(MemoryStore())
+        counter = MetricCounter('jobs_total', 'Jobs run', ['queue'], registry=registry)
+        gauge = Gauge('workers', 'Busy workers', registry=registry)
+        histogram = Histogram('job_seconds', 'Job time', ['queue'], registry=registry, buckets=(0.1, 1))
+        counter.inc(queue='mail "fast"')
+        counter.inc(2, queue='mail "fast"')
+        gauge.set(3)
+        gauge.dec()
+        for value in (0.05, 0.1, 0.5, 7):
+            histogram.observe(value, queue='mail')
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP job_seconds Job time',
+            '# TYPE job_seconds histogram',
+            'job_seconds_bucket{queue="mail",le="0.1"} 2',
+            'job_seconds_bucket{queue="mail",le="1"} 3',
+            'job_seconds_bucket{queue="mail",le="+Inf"} 4',
+            'job_seconds_sum{queue="mail"} 7.65',
+            'job_seconds_count{queue="mail"} 4',
+            '# HELP jobs_total Jobs run',
+            '# TYPE jobs_total counter',
+            'jobs_total{queue="mail \\"fast\\""} 3',
+            '# HELP workers Busy workers',
+            '# TYPE workers gauge',
+            'workers 2',
+        ]) + '\n')
+        with self.assertRaises(ValueError):
+            counter.inc(queue='mail', priority='high')
+        with self.assertRaises(ValueError):
+            counter.inc(-1, queue='mail')
+        with self.assertRaises(ValueError):
+            MetricCounter('jobs_total', 'Again', registry=registry)
+        
+    def test_concurrent_updates(self):
+        for store in (MemoryStore(), FileStore(tempfile.mkdtemp())):
+            counter = MetricCounter('hits_total', 'Hits', ['worker'], registry=Registry(store))
+            def work():
+                for i in range(1000):
+                    counter.inc(worker=i % 3)
+            threads = [threading.Thread(target=work) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sum(counter.value(worker=worker) for worker in range(3)), 8000)
+        
+    def test_multiprocess_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = Registry(FileStore(directory))
+            counter = MetricCounter('child_total', 'Child', registry=registry)
+            gauge = Gauge('streams', 'Streams', registry=registry)
+            counter.inc(2)
+            gauge.inc(5)
+            # Values written by forked workers are added up
+            context = multiprocessing.get_context('fork')
+            for amount in (3, 4):
+                child = context.Process(target=count_in_child, args=(directory, amount))
+                child.start()
+                child.join()
+                self.assertEqual(child.exitcode, 0)
+            self.assertEqual(counter.value(), 9)
+            # The gauges of an exited process no longer count
+            dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+            dead.wait()
+            os.replace(os.path.join(directory, f'live_{os.getpid()}.db'), os.path.join(directory, f'live_{dead.pid}.db'))
+            self.assertEqual(gauge.value(), 0)
+            self.assertIn('child_total 9\n', registry.render())
+        
+    @override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=60, FORUM_SHARED_CACHE=True, FORUM_OUTBOX_EAGER=False)
+    def test_views_and_receivers_record(self):
+        def snapshot():
+            return {
+                'list': requests_total.value(view='QuestionViewSet', action='list', method='GET', status=200),
+                'duration': request_duration.value(view='QuestionViewSet', action='list'),
+                'login': requests_total.value(view='LoginView', action='post', method='POST', status=200),
+                'answers': metrics.posts_written.value(type='answer', action='created'),
+                'votes': metrics.votes_cast.value(target='question', value='up'),
+                'notifications': metrics.notifications_written.value(type='answer', result='created'),
+                'hits': metrics.cache_requests.value(cache='question-list', result='hit'),
+                'misses': metrics.cache_requests.value(cache='question-list', result='miss'),
+            }
+
+        before = snapshot()
+        anonymous = APIClient()
+        anonymous.get('/api/forum/questions/')
+        anonymous.get('/api/forum/questions/')
+        anonymous.post('/api/auth/login/', {'email': 'metrics@example.com', 'password': 'password123'}, format='json')
+        other = User.objects.create_user(email='answerer@example.com', password='password123')
+        client = APIClient()
+        client.force_authenticate(other)
+        client.post(f'/api/forum/questions/{self.question.id}/answers/', {'content': 'Answer'}, format='json')
+        client.put(f'/api/forum/questions/{self.question.id}/vote/', {'value': 1}, format='json')
+        drain_outbox()
+
+        after = snapshot()
+        self.assertEqual({name: after[name] - before[name] for name in before}, {
+            'list': 2, 'duration': 2, 'login': 1, 'answers': 1, 'votes': 1, 'notifications': 1, 'hits': 1, 'misses': 1,
+        })
+        
+    def test_endpoint_is_staff_only(self):
+        self.assertEqual(APIClient().get('/metrics/').status_code, status.HTTP_401_UNAUTHORIZED)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get('/metrics/').status_code, status.HTTP_403_FORBIDDEN)
+
+        User.objects.create_superuser(email='admin@example.com', password='password123')
+        scraper = APIClient()
+        scraper.credentials(HTTP_AUTHORIZATION='Basic ' + base64.b64encode(b'admin@example.com:password123').decode())
+        scraper.get('/api/forum/questions/')
+        response = scraper.get('/metrics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('# TYPE stackit_http_requests_total counter', text)
+        self.assertIn('stackit_http_request_db_seconds_bucket{view="QuestionViewSet",action="list",le="+Inf"}', text)
+        self.assertIn('# TYPE forum_event_subscribers gauge', text)
+
+@override_settings(ROOT_URLCONF='StackIt.asgi_urls', FORUM_VIEW_COUNT_FLUSH_INTERVAL=3600,
+                   FORUM_RESPONSE_CACHE_TIMEOUT=0)
+class AsyncReadTests(TestCase):
+    def setUp(self):
+        view_counter.flush()
+        cache.clear()
+        self.user = User.objects.create_user(email='reader@example.com', password='password123')
+        self.other = User.objects.create_user(email='writer@example.com', password='password123')
+        self.question = Question.objects.create(title='Async', description='Description', author=self.user)
+        self.answer = Answer.objects.create(question=self.question, author=self.other, content='Answer')
+        Vote.objects.set_vote(self.user, self.answer, Vote.UPVOTE)
+        drain_outbox()
+        self.auth = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+        self.urls = [
+            '/api/forum/questions/',
+            '/api/forum/questions/?ordering=-hot&page_size=1',
+            f'/api/forum/questions/{self.question.id}/',
+            f'/api/forum/questions/{self.question.id}/?personalize=false',
+            f'/api/forum/questions/{self.question.id}/answers/',
+            '/api/forum/notifications/',
+            '/api/forum/notifications/unread_count/',
+        ]
+        
+    def tearDown(self):
+        view_counter.flush()
+        
+    def sync_get(self, url, **headers):
+        with override_settings(ROOT_URLCONF='StackIt.urls'):
+            return self.client.get(url, headers=headers)
+        
+    def test_routes_resolve_to_async_views(self):
+        for url in self.urls:
+            with self.subTest(url=url):
+                match = resolve(url.split('?')[0])
+                self.assertTrue(iscoroutinefunction(match.func))
+                self.assertEqual(match.route, resolve(url.split('?')[0], urlconf='StackIt.urls').route)
+        
+    async def test_responses_match_the_sync_views(self):
+        for headers in ({}, self.auth):
+            for url in self.urls:
+                with self.subTest(url=url, authenticated=bool(headers)):
+                    expected = await sync_to_async(self.sync_get)(url, **headers)
+                    response = await self.async_client.get(url, headers=headers)
+                    self.assertEqual(response.status_code, expected.status_code)
+                    # Each read counts a view, which the second one shows
+                    data, expected_data = response.json(), expected.json()
+                    if 'views_count' in data:
+                        self.assertEqual(data.pop('views_count'), expected_data.pop('views_count') + 1)
+                    self.assertEqual(data, expected_data)
+                    self.assertEqual(response.get('ETag'), expected.get('ETag'))
+                    self.assertEqual(response.get('Cache-Control'), expected.get('Cache-Control'))
+        detail = await self.async_client.get(f'/api/forum/questions/{self.question.id}/', headers=self.auth)
+        self.assertTrue(detail.json()['answers'][0]['is_upvoted'])
+        
+    async def test_conditional_gets_and_view_counts(self):
+        for url in self.urls[2:6]:
+            with self.subTest(url=url):
+                first = await self.async_client.get(url, headers=self.auth)
+                repeat = await self.async_client.get(url, headers={**self.auth, 'If-None-Match': first['ETag']})
+                self.assertEqual(repeat.status_code, status.HTTP_304_NOT_MODIFIED)
+        # Two full pages and two 304s
+        self.assertEqual(view_counter.pending(self.question.id), 4)
+        missing = await self.async_client.get('/api/forum/questions/0/')
+        self.assertEqual(missing.status_code, status.HTTP_404_NOT_FOUND)
+        
+    async def test_query_counts_match_the_sync_views(self):
+        # The async ORM runs its queries on this thread's connection
+        def count_queries(url, asynchronous):
+            with CaptureQueriesContext(connection) as queries:
+                if asynchronous:
+                    async_to_sync(self.async_client.get)(url, headers=self.auth)
+                else:
+                    self.sync_get(url, **self.auth)
+            return len(queries)
+        
+        for url in self.urls:
+            with self.subTest(url=url):
+                expected = await sync_to_async(count_queries)(url, False)
+                self.assertEqual(await sync_to_async(count_queries)(url, True), expected)
+        
+    @override_settings(FORUM_RESPONSE_CACHE_TIMEOUT=60, FORUM_SHARED_CACHE=True)
+    async def test_anonymous_cache_is_shared(self):
+        url = f'/api/forum/questions/{self.question.id}/'
+        await sync_to_async(self.sync_get)(url)
+        await sync_to_async(self.sync_get)('/api/forum/questions/')
+        response_cache.reset_stats()
+        await self.async_client.get(url)
+        await self.async_client.get('/api/forum/questions/')
+        self.assertEqual(response_cache.stats(), {
+            'question-list': {'hits': 1, 'misses': 0},
+            'question-retrieve': {'hits': 1, 'misses': 0},
+        })
+        
+    async def test_errors_and_writes(self):
+        response = await self.async_client.get('/api/forum/notifications/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = await self.async_client.post(
+            '/api/forum/questions/', {'title': 'Posted', 'description': 'Description', 'tag_ids': []},
+            content_type='application/json', headers=self.auth,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(await Question.objects.filter(title='Posted').aexists())
+        
+    def test_handler_routes_by_setting(self):
+        from StackIt.asgi import ForumASGIHandler
+        
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/forum/questions/', 'query_string': b'', 'headers': []}
+        request, _ = ForumASGIHandler().create_request(scope, StringIO())
+        self.assertFalse(hasattr(request, 'urlconf'))
+        with override_settings(FORUM_ASYNC_READS=True):
+            request, _ = ForumASGIHandler().create_request(scope, StringIO())
+        self.assertEqual(request.urlconf, 'StackIt.asgi_urls')
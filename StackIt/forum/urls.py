@@ -8,6 +8,7 @@ router.register('questions', views.QuestionViewSet)
 router.register('tags', views.TagViewSet)
 router.register('notifications', views.NotificationViewSet, basename='notification')
 router.register('direct-answers', views.AnswerViewSet, basename='direct-answer')
+router.register('votes', views.VoteViewSet, basename='vote')
 
 # Create nested routers for answers within questions, using pk instead of slug
 question_router = routers.NestedSimpleRouter(router, 'questions', lookup='question')
@@ -18,6 +19,8 @@ answer_router = routers.NestedSimpleRouter(question_router, 'answers', lookup='a
 answer_router.register('comments', views.CommentViewSet, basename='comment')
 
 urlpatterns = [
+    # Before the router, which would take "stream" for a notification id
+    path('notifications/stream/', views.notification_stream, name='notification-stream'),
     path('', include(router.urls)),
     path('', include(question_router.urls)),
     path('', include(answer_router.urls)),
@@ -0,0 +1,225 @@
+"""
+Write-behind buffer for question view counts.
+
+Page views are added to a process-local counter and written to the database
+as batched ``UPDATE ... SET views_count = views_count + n`` statements, one
+per distinct increment, instead of a full ``save()`` per request. Pending
+counts are flushed:
+
+- after the response to the request that finds the buffer older than
+  ``FORUM_VIEW_COUNT_FLUSH_INTERVAL`` seconds (``request_finished``),
+- by a background thread instead when ``FORUM_VIEW_COUNT_FLUSH_THREAD`` is
+  enabled,
+- at interpreter exit, so graceful worker shutdowns do not lose counts.
+
+An interval of 0 disables buffering and writes every view immediately.
+
+When a viewer key is passed along, the buffer also keeps the HyperLogLog
+register updates for that viewer. On flush they are merged into the
+question's sketch for the day and its all-time sketch, and the all-time
+estimate is copied to ``Question.unique_viewers``. The hot scores of the
+flushed questions are refreshed in the same transaction.
+
+A flush that fails keeps the counts for the next one and logs the error;
+it never fails the page view that triggered it.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .hyperloglog import HyperLogLog
+from .models import Question, QuestionViewerSketch
+from .ranking import refresh_hot_scores
+
+logger = logging.getLogger(__name__)
+
+# Keeps the IN (...) lists of the flush updates reasonably sized
+FLUSH_BATCH_SIZE = 500
+
+
+class ViewCountBuffer:
+    def __init__(self):
+        self._pending = Counter()
+        # (question_id, day) -> {register index: rank}
+        self._viewers = defaultdict(dict)
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        # Set by the request that found a flush due, see flush_after_response
+        self._flush_due = False
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'FORUM_VIEW_COUNT_FLUSH_INTERVAL', 10)
+
+    def add(self, question_id, count=1, viewer=None):
+        """Record ``count`` views of a question, optionally by an identified viewer"""
+        self.record(question_id, count, viewer)
+        if not self.flush_interval:
+            self.flush()
+
+    async def aadd(self, question_id, count=1, viewer=None):
+        """add() for async views, an unbuffered write runs in a thread"""
+        self.record(question_id, count, viewer)
+        if not self.flush_interval:
+            await sync_to_async(self.flush)()
+
+    def record(self, question_id, count, viewer):
+        """Buffer the views, and note when a flush is due"""
+        if viewer is not None:
+            index, rank = HyperLogLog.register_for(viewer)
+        with self._lock:
+            self._pending[question_id] += count
+            if viewer is not None:
+                registers = self._viewers[(question_id, timezone.localdate())]
+                if rank > registers.get(index, 0):
+                    registers[index] = rank
+            if getattr(settings, 'FORUM_VIEW_COUNT_FLUSH_THREAD', False):
+                if self._thread is None:
+                    self._start_thread()
+            elif time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_due = True
+
+    def flush_if_due(self):
+        with self._lock:
+            due, self._flush_due = self._flush_due, False
+        if due:
+            self.flush()
+
+    def pending(self, question_id):
+        """Views of a question that have not been written yet"""
+        with self._lock:
+            return self._pending.get(question_id, 0)
+
+    def flush(self):
+        """Write all pending counts to the database, returns the number of views written"""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            viewers, self._viewers = self._viewers, defaultdict(dict)
+            self._last_flush = time.monotonic()
+            self._flush_due = False
+        if not pending and not viewers:
+            return 0
+
+        # Questions with the same increment share one UPDATE
+        by_increment = defaultdict(list)
+        for question_id, count in pending.items():
+            by_increment[count].append(question_id)
+
+        try:
+            with transaction.atomic():
+                for count, question_ids in by_increment.items():
+                    for start in range(0, len(question_ids), FLUSH_BATCH_SIZE):
+                        Question.objects.filter(
+                            id__in=question_ids[start:start + FLUSH_BATCH_SIZE]
+                        ).update(views_count=F('views_count') + count)
+                refresh_hot_scores(pending)
+                if viewers:
+                    self._merge_viewers(viewers)
+        except DatabaseError:
+            logger.exception("Could not flush %d question view counts, keeping them for the next flush", len(pending))
+            # Keep the counts for the next attempt
+            with self._lock:
+                self._pending.update(pending)
+                for key, registers in viewers.items():
+                    current = self._viewers[key]
+                    for index, rank in registers.items():
+                        current[index] = max(rank, current.get(index, 0))
+            return 0
+        return sum(pending.values())
+
+    def _merge_viewers(self, viewers):
+        """Merge buffered register updates into the daily and all-time sketches"""
+        updates = defaultdict(dict)
+        for (question_id, day), registers in viewers.items():
+            for key in ((question_id, day), (question_id, None)):
+                merged = updates[key]
+                for index, rank in registers.items():
+                    merged[index] = max(rank, merged.get(index, 0))
+
+        # Questions deleted since they were viewed have nothing to update
+        question_ids = set(
+            Question.objects.filter(id__in={question_id for question_id, _ in updates}).values_list('id', flat=True)
+        )
+        days = {day for _, day in updates if day is not None}
+
+        # Make sure every row exists, then lock them so concurrent flushes
+        # from other workers merge one after the other
+        empty = HyperLogLog().to_bytes()
+        QuestionViewerSketch.objects.bulk_create(
+            [
+                QuestionViewerSketch(question_id=question_id, day=day, registers=empty)
+                for question_id, day in updates if question_id in question_ids
+            ],
+            ignore_conflicts=True,
+        )
+        rows = QuestionViewerSketch.objects.select_for_update().filter(
+            Q(day__in=days) | Q(day__isnull=True),
+            question_id__in=question_ids,
+        ).order_by('question_id', 'day')
+
+        changed = []
+        estimates = []
+        for row in rows:
+            registers = updates.get((row.question_id, row.day))
+            if registers is None:
+                continue
+            sketch = row.sketch
+            for index, rank in registers.items():
+                sketch.update_register(index, rank)
+            row.registers = sketch.to_bytes()
+            changed.append(row)
+            if row.day is None:
+                estimates.append(Question(id=row.question_id, unique_viewers=sketch.count()))
+
+        QuestionViewerSketch.objects.bulk_update(changed, ['registers'], batch_size=FLUSH_BATCH_SIZE)
+        Question.objects.bulk_update(estimates, ['unique_viewers'], batch_size=FLUSH_BATCH_SIZE)
+
+    def stop(self):
+        """Stop the background thread and write what is left"""
+        self._stopped.set()
+        self.flush()
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, name='view-count-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval or 1):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Periodic view count flush failed")
+            finally:
+                close_old_connections()
+
+
+def viewer_key(request):
+    """Identity used for unique-viewer counting: the user id, or the client IP for anonymous readers"""
+    if request.user.is_authenticated:
+        return f'user:{request.user.id}'
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def flush_after_response(sender, **kwargs):
+    """Run the flush a request found due once its response has been sent"""
+    view_counter.flush_if_due()
+
+
+view_counter = ViewCountBuffer()
+atexit.register(view_counter.stop)
+# Ahead of Django's close_old_connections: the flush reuses the request's
+# connection, and CONN_MAX_AGE still decides when that is closed
+request_finished.disconnect(close_old_connections)
+request_finished.connect(flush_after_response, dispatch_uid='view_counter_flush_after_response')
+request_finished.connect(close_old_connections)
@@ -1,87 +1,332 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
 from rest_framework import viewsets, status, mixins, generics, filters, serializers
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
 from rest_framework.response import Response
-from django.db.models import Count, Q
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
 from django.shortcuts import get_object_or_404
+from StackIt.metrics import MetricsMixin
 
-from .models import Question, Answer, Comment, Tag, Notification
+from .models import Question, Answer, Comment, Tag, Notification, NotificationState, Vote
 from .serializers import (
     QuestionListSerializer, QuestionDetailSerializer, AnswerSerializer, 
-    CommentSerializer, TagSerializer, NotificationSerializer
+    CommentSerializer, TagSerializer, NotificationSerializer, VoteSerializer,
+    VoteStateQuerySerializer
 )
 from .permissions import IsOwnerOrReadOnly, IsAdminUser
+from .view_counter import view_counter, viewer_key
+from .cache import QUESTION_LIST_VERSION_KEY, TAG_VERSION_KEY, question_version_key, response_cache, tag_catalogue
+from .search import QuestionSearchFilter, RelevanceOrderingFilter
+from .pagination import KeysetPagination
+from .conditional import (
+    add_validator_headers, anotifications_validator, aquestion_validator, comments_validator, is_conditional,
+    loaded_question_validator, not_modified, notifications_validator, question_validator
+)
+from .events import get_event_backend, publish_to_user, user_channel
+from .loaders import ANSWER_ORDERING, answer_queryset, attach_viewer_votes, load_question_detail, viewer_votes
+
+def wants_personalized(request):
+    """``?personalize=false`` leaves the caller's vote state out of the response"""
+    return request.query_params.get('personalize', 'true').lower() not in ('false', '0', 'no')
+
+class VoteActionsMixin:
+    """Vote endpoints shared by questions and answers"""
+    
+    def get_vote_target(self):
+        """Queryset narrowed to the object being voted on"""
+        raise NotImplementedError
+    
+    def url_id(self, *names):
+        """The first of the ``names`` URL kwargs present, as an id; 404 when it isn't one"""
+        value = next((self.kwargs[name] for name in names if name in self.kwargs), None)
+        try:
+            return Question._meta.pk.to_python(value)
+        except DjangoValidationError:
+            raise Http404('No object matches the given query.')
+    
+    def cast_vote(self, value, toggle=False):
+        return Vote.objects.set_vote(self.request.user, self.get_vote_target(), value, toggle=toggle)
+    
+    @action(detail=True, methods=['put'], permission_classes=[IsAuthenticated])
+    def vote(self, request, **kwargs):
+        """Set the current user's vote to 1, 0 or -1 (idempotent)"""
+        serializer = VoteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        result = self.cast_vote(serializer.validated_data['value'])
+        return Response(result._asdict())
+    
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def upvote(self, request, **kwargs):
+        """Upvote, or remove an existing upvote (toggle)"""
+        result = self.cast_vote(Vote.UPVOTE, toggle=True)
+        status_text = 'upvoted' if result.vote == Vote.UPVOTE else 'upvote removed'
+        return Response({'status': status_text, **result._asdict()})
+    
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def downvote(self, request, **kwargs):
+        """Downvote, or remove an existing downvote (toggle)"""
+        result = self.cast_vote(Vote.DOWNVOTE, toggle=True)
+        status_text = 'downvoted' if result.vote == Vote.DOWNVOTE else 'downvote removed'
+        return Response({'status': status_text, **result._asdict()})
+
+class ReloadAfterUpdateMixin:
+    """
+    Render updates from a freshly loaded object. DRF drops the prefetched
+    relations after saving, after which nested serializers query per row.
+    """
+    
+    def update(self, request, *args, **kwargs):
+        partial = kwargs.pop('partial', False)
+        serializer = self.get_serializer(self.get_object(), data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        return Response(self.get_serializer(self.reload(serializer.instance)).data)
+    
+    def reload(self, instance):
+        return self.get_object()
+
+class ConditionalGetMixin:
+    """ETag headers on list/retrieve, and 304 responses for unchanged resources"""
+    # Set when the rendered response carries its own ``validator``, so only
+    # conditional requests need get_validator() up front
+    validator_from_response = False
+    
+    def get_validator(self):
+        """Validator of the current response, None to skip conditional handling"""
+        return None
+    
+    async def aget_validator(self):
+        """get_validator() for the async read views (forum.async_views)"""
+        return await sync_to_async(self.get_validator)()
+    
+    def needs_validator(self, validator):
+        return validator is None and (is_conditional(self.request) or not self.validator_from_response)
+    
+    def not_modified_response(self, validator):
+        """304 response when the request already has the version ``validator`` describes, else None"""
+        if validator is None:
+            return None
+        response = not_modified(self.request, validator)
+        if response is not None:
+            add_validator_headers(self.request, response, validator)
+        return response
+    
+    def with_validator(self, response, validator):
+        validator = validator or getattr(response, 'validator', None)
+        if validator is not None and response.status_code == status.HTTP_200_OK:
+            add_validator_headers(self.request, response, validator)
+        return response
+    
+    def conditional_response(self, render, validator=None):
+        if self.needs_validator(validator):
+            validator = self.get_validator()
+        response = self.not_modified_response(validator)
+        if response is None:
+            response = self.with_validator(render(), validator)
+        return response
+    
+    async def aconditional_response(self, render, validator=None):
+        """conditional_response() with an async ``render``"""
+        if self.needs_validator(validator):
+            validator = await self.aget_validator()
+        response = self.not_modified_response(validator)
+        if response is None:
+            response = self.with_validator(await render(), validator)
+        return response
+    
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(
+            lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs), self.get_validator()
+        )
+    
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(
+            lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs), self.get_validator()
+        )
+
+class AnonymousCacheMixin(ConditionalGetMixin):
+    """
+    Serve list/retrieve to anonymous users from the shared response cache.
+    
+    The validator is cached along with the data, so cache hits and 304s for
+    anonymous readers don't touch the database.
+    """
+    
+    def get_cache_version_keys(self):
+        """Version keys the current response depends on, None when it can't be cached"""
+        raise NotImplementedError
+    
+    def get_response_cache_key(self):
+        version_keys = self.get_cache_version_keys()
+        if version_keys is None:
+            return None
+        return response_cache.cache_key(self.request, version_keys)
+    
+    async def aget_response_cache_key(self):
+        version_keys = self.get_cache_version_keys()
+        if version_keys is None:
+            return None
+        return await response_cache.acache_key(self.request, version_keys)
+    
+    @property
+    def cache_name(self):
+        return f'{self.basename}-{self.action}'
+    
+    def entry_response(self, entry):
+        data, validator = entry
+        return self.conditional_response(lambda: Response(data), validator)
+    
+    def cache_entry(self, response):
+        """What to cache of ``response``, None when it can't be"""
+        if response.status_code != status.HTTP_200_OK:
+            return None
+        return response.data, getattr(response, 'validator', None)
+    
+    def cached_response(self, render):
+        key = self.get_response_cache_key()
+        entry = response_cache.get(key, self.cache_name) if key is not None else None
+        if entry is not None:
+            return self.entry_response(entry)
+        response = self.conditional_response(render)
+        entry = self.cache_entry(response) if key is not None else None
+        if entry is not None:
+            response_cache.set(key, entry)
+        return response
+    
+    async def acached_response(self, render):
+        """cached_response() with an async ``render``, sharing its cache entries"""
+        key = await self.aget_response_cache_key()
+        entry = await response_cache.aget(key, self.cache_name) if key is not None else None
+        if entry is not None:
+            return self.entry_response(entry)
+        response = await self.aconditional_response(render)
+        entry = self.cache_entry(response) if key is not None else None
+        if entry is not None:
+            await response_cache.aset(key, entry)
+        return response
+    
+    # cached_response already validates, so these skip ConditionalGetMixin
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs))
+    
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs))
 
-class QuestionViewSet(viewsets.ModelViewSet):
+class QuestionViewSet(MetricsMixin, AnonymousCacheMixin, VoteActionsMixin, ReloadAfterUpdateMixin, viewsets.ModelViewSet):
     """ViewSet for questions with different serializers for list and detail"""
-    queryset = Question.objects.annotate(
-        vote_count=Count('upvotes', distinct=True) - Count('downvotes', distinct=True),
-        answer_count=Count('answers', distinct=True)
+    queryset = Question.objects.alias(
+        vote_count=F('score'),
+        # ordering=-hot reads forum_question_hot_idx once the pagination adds -pk
+        hot=F('hot_score'),
     )
     permission_classes = [IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly]
+    pagination_class = KeysetPagination
     lookup_field = 'id'
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['title', 'description', 'tags__name']
-    ordering_fields = ['created_at', 'vote_count', 'answer_count', 'views_count']
+    validator_from_response = True
+    filter_backends = [QuestionSearchFilter, RelevanceOrderingFilter]
+    ordering_fields = ['created_at', 'vote_count', 'answer_count', 'views_count', 'unique_viewers', 'hot']
     ordering = ['-created_at']
     
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            # Everything QuestionListSerializer reads, in a fixed number of queries
+            queryset = queryset.select_related('author').prefetch_related('tags').annotate(
+                is_answered=Exists(Answer.objects.filter(question=OuterRef('pk'), is_accepted=True))
+            )
+        return queryset
+    
     def get_serializer_class(self):
         if self.action == 'list':
             return QuestionListSerializer
         return QuestionDetailSerializer
     
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['personalize'] = wants_personalized(self.request)
+        return context
+    
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
     
+    def get_cache_version_keys(self):
+        if self.action == 'list':
+            return [QUESTION_LIST_VERSION_KEY]
+        if not self.kwargs['id'].isdigit():
+            return None
+        return [question_version_key(self.kwargs['id'])]
+    
+    def get_validator(self):
+        if self.action == 'retrieve' and self.kwargs['id'].isdigit():
+            return question_validator(self.request, self.kwargs['id'], wants_personalized(self.request))
+        return None
+    
+    async def aget_validator(self):
+        if self.action == 'retrieve' and self.kwargs['id'].isdigit():
+            return await aquestion_validator(self.request, self.kwargs['id'], wants_personalized(self.request))
+        return None
+    
     def retrieve(self, request, *args, **kwargs):
-        """Increment view count when question is viewed"""
-        instance = self.get_object()
-        instance.views_count += 1
-        instance.save()
-        return super().retrieve(request, *args, **kwargs)
+        """Return the question and count the view in the write-behind buffer"""
+        response = self.cached_response(self.render_detail)
+        # Cached copies and 304s count as views as well
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            view_counter.add(int(self.kwargs['id']), viewer=viewer_key(request))
+        return response
     
-    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
-    def upvote(self, request, pk=None):
-        """Upvote a question"""
-        question = self.get_object()
-        user = request.user
-        
-        # If already upvoted, remove upvote (toggle)
-        if question.upvotes.filter(id=user.id).exists():
-            question.upvotes.remove(user)
-            return Response({'status': 'upvote removed'})
-        
-        # Remove any downvote first
-        if question.downvotes.filter(id=user.id).exists():
-            question.downvotes.remove(user)
-            
-        # Add upvote
-        question.upvotes.add(user)
-        return Response({'status': 'upvoted'})
+    def render_detail(self):
+        try:
+            instance = load_question_detail(self.kwargs['id'], self.request.user, wants_personalized(self.request))
+        except (Question.DoesNotExist, ValueError):
+            raise Http404('No Question matches the given query.')
+        return self.detail_response(instance)
     
-    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
-    def downvote(self, request, pk=None):
-        """Downvote a question"""
-        question = self.get_object()
-        user = request.user
-        
-        # If already downvoted, remove downvote (toggle)
-        if question.downvotes.filter(id=user.id).exists():
-            question.downvotes.remove(user)
-            return Response({'status': 'downvote removed'})
-        
-        # Remove any upvote first
-        if question.upvotes.filter(id=user.id).exists():
-            question.upvotes.remove(user)
-            
-        # Add downvote
-        question.downvotes.add(user)
-        return Response({'status': 'downvoted'})
+    def detail_response(self, instance):
+        """Response for a question loaded by load_question_detail"""
+        self.check_object_permissions(self.request, instance)
+        # Including this view, which is counted once the response is ready
+        instance.views_count += view_counter.pending(instance.id) + 1
+        serializer = self.get_serializer(instance)
+        response = Response(serializer.data)
+        response.validator = loaded_question_validator(self.request, instance)
+        return response
+    
+    def reload(self, instance):
+        return load_question_detail(instance.id, self.request.user, wants_personalized(self.request))
+    
+    def get_vote_target(self):
+        # Plain queryset: the list annotations would add a GROUP BY to the locking read
+        return Question.objects.filter(id=self.url_id('id'))
 
-class AnswerViewSet(viewsets.ModelViewSet):
+class AnswerViewSet(MetricsMixin, ConditionalGetMixin, VoteActionsMixin, ReloadAfterUpdateMixin, viewsets.ModelViewSet):
     """ViewSet for answers"""
     serializer_class = AnswerSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly]
+    pagination_class = KeysetPagination
+    
+    def get_validator(self):
+        # Answers of one question change together with the question's validator
+        question_id = self.kwargs.get('question_pk') or self.kwargs.get('question_id')
+        if self.action == 'list' and question_id and question_id.isdigit():
+            return question_validator(self.request, question_id, wants_personalized(self.request))
+        return None
+    
+    async def aget_validator(self):
+        question_id = self.kwargs.get('question_pk') or self.kwargs.get('question_id')
+        if self.action == 'list' and question_id and question_id.isdigit():
+            return await aquestion_validator(self.request, question_id, wants_personalized(self.request))
+        return None
     
     def get_queryset(self):
         # If we're accessing through the nested route
@@ -91,18 +336,28 @@ class AnswerViewSet(viewsets.ModelViewSet):
             question_id = self.kwargs['question_id']
         else:
             # If we're accessing through the direct route
-            return Answer.objects.all().annotate(
-                vote_count=Count('upvotes', distinct=True) - Count('downvotes', distinct=True)
-            ).order_by('-is_accepted', '-vote_count', '-created_at')
+            return answer_queryset().order_by(*ANSWER_ORDERING)
             
         # Filter by question ID
-        return Answer.objects.filter(
+        return answer_queryset().filter(
             question_id=question_id
-        ).annotate(
-            vote_count=Count('upvotes', distinct=True) - Count('downvotes', distinct=True)
-        ).order_by('-is_accepted', '-vote_count', '-created_at')
+        ).order_by(*ANSWER_ORDERING)
     
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['personalize'] = wants_personalized(self.request)
+        return context
+    
+    def paginate_queryset(self, queryset):
+        # Vote state for the whole page in one query
+        page = super().paginate_queryset(queryset)
+        if page is not None and wants_personalized(self.request):
+            attach_viewer_votes(self.request.user, answers=page)
+        return page
+    
+    @transaction.atomic
     def perform_create(self, serializer):
+        # The answer and its outbox event are written together
         # If question_id is provided in request body, it's already set in validated_data
         if 'question' not in serializer.validated_data:
             # If not in request body, get it from the URL parameter
@@ -119,6 +374,13 @@ class AnswerViewSet(viewsets.ModelViewSet):
             # Question already set from request body, just set the author
             serializer.save(author=self.request.user)
     
+    def get_vote_target(self):
+        # Plain queryset, like QuestionViewSet's: a join would lock the author too
+        target = Answer.objects.filter(pk=self.url_id('pk'))
+        if 'question_pk' in self.kwargs or 'question_id' in self.kwargs:
+            target = target.filter(question_id=self.url_id('question_pk', 'question_id'))
+        return target
+    
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
     def accept(self, request, question_pk=None, question_id=None, pk=None):
         """Mark an answer as accepted (only by question owner)"""
@@ -134,53 +396,23 @@ class AnswerViewSet(viewsets.ModelViewSet):
         
         # Toggle accept status
         answer.is_accepted = not answer.is_accepted
-        answer.save()
+        with transaction.atomic():
+            answer.save()
         
         return Response({'status': 'accepted' if answer.is_accepted else 'unaccepted'})
     
-    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
-    def upvote(self, request, question_pk=None, question_id=None, pk=None):
-        """Upvote an answer"""
-        answer = self.get_object()
-        user = request.user
-        
-        # If already upvoted, remove upvote (toggle)
-        if answer.upvotes.filter(id=user.id).exists():
-            answer.upvotes.remove(user)
-            return Response({'status': 'upvote removed'})
-        
-        # Remove any downvote first
-        if answer.downvotes.filter(id=user.id).exists():
-            answer.downvotes.remove(user)
-            
-        # Add upvote
-        answer.upvotes.add(user)
-        return Response({'status': 'upvoted'})
-    
-    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
-    def downvote(self, request, question_pk=None, question_id=None, pk=None):
-        """Downvote an answer"""
-        answer = self.get_object()
-        user = request.user
-        
-        # If already downvoted, remove downvote (toggle)
-        if answer.downvotes.filter(id=user.id).exists():
-            answer.downvotes.remove(user)
-            return Response({'status': 'downvote removed'})
-        
-        # Remove any upvote first
-        if answer.upvotes.filter(id=user.id).exists():
-            answer.upvotes.remove(user)
-            
-        # Add downvote
-        answer.downvotes.add(user)
-        return Response({'status': 'downvoted'})
-
-class CommentViewSet(viewsets.ModelViewSet):
+class CommentViewSet(MetricsMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """ViewSet for comments on answers"""
     serializer_class = CommentSerializer
     permission_classes = [IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly]
     
+    def get_validator(self):
+        answer_param = self.kwargs.get('answer_pk') or self.kwargs.get('answer_id')
+        question_param = self.kwargs.get('question_pk') or self.kwargs.get('question_id')
+        if self.action == 'list' and answer_param.isdigit() and question_param.isdigit():
+            return comments_validator(self.request, question_param, answer_param)
+        return None
+    
     def get_queryset(self):
         answer_param = self.kwargs.get('answer_pk') or self.kwargs.get('answer_id')
         question_param = self.kwargs.get('question_pk') or self.kwargs.get('question_id')
@@ -188,8 +420,9 @@ class CommentViewSet(viewsets.ModelViewSet):
         return Comment.objects.filter(
             answer__id=answer_param,
             answer__question__id=question_param
-        )
+        ).select_related('author')
     
+    @transaction.atomic
     def perform_create(self, serializer):
         answer_param = self.kwargs.get('answer_pk') or self.kwargs.get('answer_id')
         question_param = self.kwargs.get('question_pk') or self.kwargs.get('question_id')
@@ -201,12 +434,26 @@ class CommentViewSet(viewsets.ModelViewSet):
         )
         serializer.save(author=self.request.user, answer=answer)
 
-class TagViewSet(viewsets.ModelViewSet):
+class TagViewSet(MetricsMixin, AnonymousCacheMixin, viewsets.ModelViewSet):
     """ViewSet for tags"""
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     
+    def get_cache_version_keys(self):
+        return [TAG_VERSION_KEY]
+    
+    def list(self, request, *args, **kwargs):
+        """Serve the tag list from the process-local catalogue"""
+        return self.cached_response(lambda: self.list_catalogue())
+    
+    def list_catalogue(self):
+        tags = tag_catalogue.get()
+        page = self.paginate_queryset(tags)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(tags)
+    
     def get_permissions(self):
         """Custom permissions: anyone can view, only admins can create/edit/delete"""
         if self.action in ['list', 'retrieve']:
@@ -215,30 +462,130 @@ class TagViewSet(viewsets.ModelViewSet):
             permission_classes = [IsAdminUser]
         return [permission() for permission in permission_classes]
 
-class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
+class VoteViewSet(MetricsMixin, viewsets.ViewSet):
+    """The current user's votes"""
+    permission_classes = [IsAuthenticated]
+    
+    @action(detail=False)
+    def mine(self, request):
+        """Votes on the given question and answer ids in one query, ids without a vote are left out"""
+        serializer = VoteStateQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        votes = viewer_votes(
+            request.user,
+            question_ids=serializer.validated_data.get('questions', []),
+            answer_ids=serializer.validated_data.get('answers', []),
+        )
+        result = {'questions': {}, 'answers': {}}
+        for (kind, object_id), value in votes.items():
+            result[f'{kind}s'][str(object_id)] = value
+        return Response(result)
+
+class NotificationViewSet(MetricsMixin, ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """ViewSet for user notifications"""
     serializer_class = NotificationSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    
+    def get_validator(self):
+        if self.action == 'list':
+            return notifications_validator(self.request)
+        return None
+    
+    async def aget_validator(self):
+        if self.action == 'list':
+            return await anotifications_validator(self.request)
+        return None
     
     def get_queryset(self):
-        return Notification.objects.filter(recipient=self.request.user).order_by('-created_at')
+        return Notification.objects.filter(recipient=self.request.user).select_related('sender').order_by('-last_activity_at')
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in ('list', 'retrieve'):
+            # Set ahead by the async list view
+            if not hasattr(self, 'read_before'):
+                self.read_before = NotificationState.objects.read_before(self.request.user)
+            context['read_before'] = self.read_before
+        return context
     
     @action(detail=True, methods=['post'])
     def mark_as_read(self, request, pk=None):
         """Mark a notification as read"""
-        notification = self.get_object()
-        notification.is_read = True
-        notification.save()
+        NotificationState.objects.mark_read(self.get_object())
+        transaction.on_commit(lambda: publish_to_user(request.user.id, {'type': 'read'}))
         return Response({'status': 'notification marked as read'})
     
     @action(detail=False, methods=['post'])
     def mark_all_as_read(self, request):
-        """Mark all notifications as read"""
-        Notification.objects.filter(recipient=request.user, is_read=False).update(is_read=True)
+        """Mark all notifications as read by moving the read watermark"""
+        NotificationState.objects.mark_all_read(request.user)
+        transaction.on_commit(lambda: publish_to_user(request.user.id, {'type': 'read'}))
         return Response({'status': 'all notifications marked as read'})
     
     @action(detail=False)
     def unread_count(self, request):
-        """Get count of unread notifications"""
-        count = Notification.objects.filter(recipient=request.user, is_read=False).count()
-        return Response({'count': count})
+        """Get count of unread notifications from the stored counter"""
+        return Response({'count': NotificationState.objects.unread_count(request.user)})
+
+
+def stream_user(request):
+    """User of a stream request from a JWT in the Authorization header or ``?token=``, else the session"""
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else request.GET.get('token')
+    if raw_token:
+        try:
+            return authentication.get_user(authentication.get_validated_token(raw_token))
+        except (InvalidToken, AuthenticationFailed):
+            return None
+    return request.user if request.user.is_authenticated else None
+
+
+def sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+async def notification_stream(request):
+    """
+    Server-sent events with the user's new notifications and unread count.
+    
+    Sends ``unread_count`` on connect and after every change, and
+    ``notification`` for each new notification. Needs an ASGI server: the
+    connection waits on an asyncio queue, not a thread. Streams end after
+    ``FORUM_STREAM_MAX_AGE`` seconds and EventSource reconnects by itself.
+    """
+    user = await sync_to_async(stream_user)(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    
+    keepalive = getattr(settings, 'FORUM_STREAM_KEEPALIVE', 15)
+    max_age = getattr(settings, 'FORUM_STREAM_MAX_AGE', 300)
+    unread_count = sync_to_async(NotificationState.objects.unread_count)
+    
+    async def events():
+        subscription = get_event_backend().subscribe(user_channel(user.id))
+        deadline = time.monotonic() + max_age
+        try:
+            yield f'retry: {keepalive * 1000}\n\n'
+            yield sse_event('unread_count', {'count': await unread_count(user)})
+            while time.monotonic() < deadline:
+                try:
+                    message = await asyncio.wait_for(subscription.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                # Send everything that queued up, then the count once
+                while message is not None:
+                    if message['type'] == 'notification':
+                        yield sse_event('notification', message['notification'])
+                    message = subscription.get_nowait()
+                yield sse_event('unread_count', {'count': await unread_count(user)})
+        finally:
+            subscription.close()
+    
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response